@@ -0,0 +1,93 @@
+import unittest as ut
+
+from PyQt4.QtGui import QApplication
+
+from volumina.cinePlayer import CinePlayer
+from volumina.positionModel import PositionModel
+
+class _Scene( object ):
+    '''Stands in for an ImageScene2D.'''
+    levelCount = 3
+
+    def __init__( self ):
+        self.lodBias = 0
+        self.ready = True
+        self.prefetched = []
+
+    def frameReady( self, pos5d ):
+        return self.ready
+
+    def prefetchFrames( self, positions5d ):
+        self.prefetched.extend(tuple(pos5d) for pos5d in positions5d)
+
+#*******************************************************************************
+# C i n e P l a y e r T e s t                                                  *
+#*******************************************************************************
+
+class CinePlayerTest( ut.TestCase ):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = None
+        if QApplication.instance():
+            cls.app = QApplication.instance()
+        else:
+            cls.app = QApplication([], False)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.app
+
+    def setUp( self ):
+        self.posModel = PositionModel()
+        self.posModel.shape5D = (5, 10, 10, 10, 1)
+        self.scene = _Scene()
+        self.player = CinePlayer(self.posModel, [self.scene], bufferFrames=8)
+
+    def tearDown( self ):
+        self.player.stop()
+
+    def testPlayback( self ):
+        fps = []
+        self.player.fpsChanged.connect(lambda achieved, target: fps.append((achieved, target)))
+        self.player.play(axis=0, fps=8)
+        self.assertTrue(self.player.isPlaying)
+        # the whole movie is buffered ahead of the playhead
+        self.assertEqual(sorted(set(p[0] for p in self.scene.prefetched)), [1, 2, 3, 4])
+
+        for i in range(1, 13):
+            self.player._tick(now=0.125 * i)
+        # wrapped around at the end
+        self.assertEqual(self.posModel.time, 12 % 5)
+        self.assertEqual(fps[-1], (8., 8.))
+        self.assertEqual(self.scene.lodBias, 0)
+
+        self.player.stop()
+        self.assertFalse(self.player.isPlaying)
+
+    def testLevelOfDetail( self ):
+        self.player.play(axis=3, fps=8)
+        self.scene.ready = False
+        for i in range(1, 13):
+            self.player._tick(now=0.125 * i)
+        # stalled instead of showing incomplete frames...
+        self.assertEqual(self.posModel.slicingPos[2], 0)
+        # ...and renders coarser to catch up
+        self.assertEqual(self.player.achievedFps, 0.)
+        self.assertEqual(self.scene.lodBias, 1)
+
+        # back to full detail once playback keeps up
+        self.scene.ready = True
+        for i in range(13, 41):
+            self.player._tick(now=0.125 * i)
+        self.assertEqual(self.posModel.slicingPos[2], 28 % 10)
+        self.assertEqual(self.player.achievedFps, 8.)
+        self.assertEqual(self.scene.lodBias, 0)
+
+        self.player.stop()
+
+#*******************************************************************************
+# i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
+#*******************************************************************************
+
+if __name__ == '__main__':
+    ut.main()
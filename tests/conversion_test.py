@@ -0,0 +1,86 @@
+import unittest as ut
+import numpy as np
+
+from PyQt4.QtCore import QRect
+from PyQt4.QtGui import QColor
+from qimage2ndarray import byte_view
+
+from volumina.pixelpipeline.conversion import ConversionPool
+from volumina.pixelpipeline.imagesources import GrayscaleImageRequest, AlphaModulatedImageRequest, \
+                                                ColortableImageRequest, RGBAImageRequest
+from volumina.pixelpipeline.datasources import ArrayRequest
+
+#*******************************************************************************
+# C o n v e r s i o n P o o l T e s t                                          *
+#*******************************************************************************
+
+class ConversionPoolTest( ut.TestCase ):
+    '''The worker processes have to produce the same images as the render threads.'''
+
+    @classmethod
+    def setUpClass( cls ):
+        cls.pool = ConversionPool(2, bufferBytes=2**20)
+
+    @classmethod
+    def tearDownClass( cls ):
+        cls.pool.close()
+
+    def setUp( self ):
+        np.random.seed(0)
+        self.a = np.random.randint(0, 1000, size=(50, 70)).astype(np.uint16)
+        self.b = np.random.randint(0, 256, size=(50, 70)).astype(np.uint8)
+
+    def _req( self, a ):
+        return ArrayRequest(a, (slice(None), slice(None)))
+
+    def assertSameImage( self, img, ref ):
+        self.assertEqual(img.format(), ref.format())
+        self.assertEqual(img.size(), ref.size())
+        self.assertTrue(np.all(byte_view(img) == byte_view(ref)))
+
+    def testGrayscale( self ):
+        for normalize in [(0, 1000), (100, 600), True]:
+            ref = GrayscaleImageRequest(self._req(self.a), normalize).wait()
+            self.assertSameImage(self.pool.toImage('grayscale', [self.a], normalize), ref)
+        ref = GrayscaleImageRequest(self._req(self.b)).wait()
+        self.assertSameImage(self.pool.toImage('grayscale', [self.b]), ref)
+
+    def testAlphaModulated( self ):
+        tint = QColor(255, 128, 0)
+        ref = AlphaModulatedImageRequest(self._req(self.a), tint, (0, 1000)).wait()
+        params = ((tint.redF(), tint.greenF(), tint.blueF()), (0, 1000))
+        self.assertSameImage(self.pool.toImage('alphamodulated', [self.a], params), ref)
+
+    def testColortable( self ):
+        colorTable = np.random.randint(0, 256, size=(17, 4)).astype(np.uint8)
+        ref = ColortableImageRequest(self._req(self.a), colorTable).wait()
+        self.assertSameImage(self.pool.toImage('colortable', [self.a, colorTable]), ref)
+
+    def testRgba( self ):
+        channels = [self.a, self.b, self.b[::-1], self.a[:,::-1]]
+        normalize = [(0, 1000), None, None, (0, 1000)]
+        ref = RGBAImageRequest(*([self._req(c) for c in channels] + [list(self.a.shape)] + normalize)).wait()
+        self.assertSameImage(self.pool.toImage('rgba', channels, normalize), ref)
+
+    def testTooLarge( self ):
+        a = np.zeros((1024, 1024), dtype=np.uint8)
+        self.assertTrue(self.pool.toImage('grayscale', [a]) is None)
+
+    def testKernelError( self ):
+        self.assertRaises(RuntimeError, self.pool.toImage, 'grayscale', [self.a], 'nonsense')
+        # the worker survives errors
+        self.assertTrue(self.pool.toImage('grayscale', [self.b]) is not None)
+
+    def testInputError( self ):
+        a = np.empty((5, 7), dtype=object)
+        # more failures than workers: no worker may get lost
+        for i in range(len(self.pool) + 1):
+            self.assertRaises(Exception, self.pool.toImage, 'grayscale', [a])
+        self.assertTrue(self.pool.toImage('grayscale', [self.b]) is not None)
+
+#*******************************************************************************
+# i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
+#*******************************************************************************
+
+if __name__ == '__main__':
+    ut.main()
@@ -2,7 +2,7 @@ import unittest as ut
 import os
 from abc import ABCMeta, abstractmethod
 import volumina._testing
-from volumina.pixelpipeline.datasources import ArraySource, RelabelingArraySource, NormalizingSource
+from volumina.pixelpipeline.datasources import ArraySource, ArraySinkSource, RelabelingArraySource, NormalizingSource
 import numpy as np
 from volumina.slicingtools import sl, slicing2shape
 try:
@@ -70,6 +70,52 @@ class ArraySourceTest( ut.TestCase, GenericArraySourceTest ):
         self.samesource = ArraySource( self.raw )
         self.othersource = ArraySource( np.array(self.raw) )
 
+class ArraySinkSourceTest( ut.TestCase, GenericArraySourceTest ):
+    def setUp( self ):
+        GenericArraySourceTest.setUp(self)
+        self.lena = np.load(os.path.join(volumina._testing.__path__[0], 'lena.npy'))
+        self.raw = np.zeros((1,512,512,1,1))
+        self.raw[0,:,:,0,0] = self.lena
+        self.source = ArraySinkSource( self.raw )
+
+        self.samesource = ArraySinkSource( self.raw )
+        self.othersource = ArraySinkSource( np.array(self.raw) )
+
+    def testOccupancy( self ):
+        labels = np.zeros((1,200,200,300,1), dtype=np.uint8)
+        source = ArraySinkSource( labels )
+        self.assertTrue(source.isEmpty(sl[:,:,:,:,:]))
+        self.assertTrue(np.all(source.request(sl[0:1,0:100,0:100,5:6,0:1]).wait() == 0))
+
+        source.put(sl[0:1,10:12,150:152,170:171,0:1], np.ones((1,2,2,1,1), dtype=np.uint8))
+        self.assertFalse(source.isEmpty(sl[:,:,:,:,:]))
+        self.assertTrue(source.isEmpty(sl[0:1,:,:,0:128,0:1]))
+        self.assertFalse(source.isEmpty(sl[0:1,0:64,128:192,170:171,0:1]))
+        result = source.request(sl[0:1,0:100,100:200,170:171,0:1]).wait()
+        self.assertEqual(result.shape, (1,100,100,1,1))
+        self.assertEqual(result.sum(), 4)
+
+        # changed behind the source's back
+        labels[0,199,199,20,0] = 3
+        self.assertTrue(source.isEmpty(sl[0:1,:,:,20:21,0:1]))
+        source.setDirty(sl[0:1,199:200,199:200,20:21,0:1])
+        self.assertFalse(source.isEmpty(sl[0:1,:,:,20:21,0:1]))
+
+        # strided requests of pyramid levels
+        result = source.request(sl[0:1,0:200:2,0:200:2,20:21,0:1]).wait()
+        self.assertEqual(result.shape, (1,100,100,1,1))
+
+    def testNextNonzeroIndex( self ):
+        labels = np.zeros((1,50,50,300,1), dtype=np.uint8)
+        labels[0,3,4,10,0] = 1
+        labels[0,30,40,250,0] = 2
+        source = ArraySinkSource( labels )
+        self.assertEqual(source.nextNonzeroIndex(3, 0), 10)
+        self.assertEqual(source.nextNonzeroIndex(3, 10), 250)
+        self.assertEqual(source.nextNonzeroIndex(3, 250), None)
+        self.assertEqual(source.nextNonzeroIndex(3, 249, direction=-1), 10)
+        self.assertEqual(source.nextNonzeroIndex(3, 10, direction=-1), None)
+
 class RelabelingArraySourceTest( ut.TestCase, GenericArraySourceTest ):
     def setUp( self ):
         GenericArraySourceTest.setUp(self)
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest as ut
+import numpy as np
+
+from volumina.pixelpipeline.diskcache import DiskCache, slicingName, parseSlicingName
+from volumina.pixelpipeline.datasources import ArraySource, DiskCacheSource
+from volumina.slicingtools import sl
+
+#*******************************************************************************
+# D i s k C a c h e T e s t                                                    *
+#*******************************************************************************
+
+class DiskCacheTest( ut.TestCase ):
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+        self.a = np.random.randint(0, 255, size=(1, 50, 40, 3, 1)).astype(np.uint8)
+
+    def tearDown( self ):
+        shutil.rmtree(self.dir)
+
+    def testSlicingName( self ):
+        slicing = (slice(0,1), slice(0,256,2), slice(None,None), slice(3,4), slice(0,1))
+        self.assertEqual(parseSlicingName(slicingName(slicing)), slicing)
+
+    def testPersistence( self ):
+        cache = DiskCache(self.dir, 2**20)
+        s = sl[0:1, 0:50, 0:40, 1:2, 0:1]
+        self.assertTrue(cache.get('raw', s) is None)
+        cache.put('raw', s, self.a[s])
+        self.assertTrue(np.all(cache.get('raw', s) == self.a[s]))
+        self.assertTrue(cache.get('other', s) is None)
+
+        # a new session finds the entry
+        cache = DiskCache(self.dir, 2**20)
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(np.all(cache.get('raw', s) == self.a[s]))
+
+    def testEviction( self ):
+        cache = DiskCache(self.dir, 2**20)
+        slicings = [sl[0:1, 0:50, 0:40, z:z+1, 0:1] for z in range(3)]
+        for z, s in enumerate(slicings):
+            cache.put('raw', s, self.a[s])
+            os.utime(cache._path('raw', s), (1000 + z, 1000 + z))
+        size = cache.stats()['bytes']
+        # marks the entry as most recently used
+        cache.get('raw', slicings[0])
+
+        # room for two entries: the least recently used one goes
+        cache = DiskCache(self.dir, size - 1)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.get('raw', slicings[1]) is None)
+        self.assertTrue(cache.get('raw', slicings[0]) is not None)
+
+    def testInvalidate( self ):
+        cache = DiskCache(self.dir, 2**20)
+        slicings = [sl[0:1, 0:50, 0:40, z:z+1, 0:1] for z in range(3)]
+        for s in slicings:
+            cache.put('raw', s, self.a[s])
+        generation = cache.generation('raw')
+        cache.invalidate('raw', sl[0:1, 10:20, 10:20, 1:2, 0:1])
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.get('raw', slicings[1]) is None)
+
+        # results computed before the invalidation are not stored
+        cache.put('raw', slicings[1], self.a[slicings[1]], generation)
+        self.assertTrue(cache.get('raw', slicings[1]) is None)
+
+        cache.invalidate('raw', sl[:,:,:,:,:])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(os.listdir(os.path.join(self.dir, os.listdir(self.dir)[0])), [])
+
+    def testDiskCacheSource( self ):
+        cache = DiskCache(self.dir, 2**20)
+        raw = ArraySource(self.a)
+        source = DiskCacheSource(raw, 'raw', cache)
+        s = sl[0:1, 0:50, 0:40, 2:3, 0:1]
+        self.assertTrue(np.all(source.request(s).wait() == self.a[s]))
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertTrue(np.all(source.request(s).wait() == self.a[s]))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        dirty = []
+        source.isDirty.connect(dirty.append)
+        self.a[0, 0, 0, 2, 0] += 1
+        raw.setDirty(sl[0:1, 0:1, 0:1, 2:3, 0:1])
+        self.assertEqual(len(dirty), 1)
+        self.assertTrue(np.all(source.request(s).wait() == self.a[s]))
+        self.assertEqual(cache.stats()['misses'], 2)
+
+#*******************************************************************************
+# i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
+#*******************************************************************************
+
+if __name__ == '__main__':
+    ut.main()
@@ -1,14 +1,17 @@
 import unittest as ut
 import os
 
+from PyQt4.QtCore import QRectF
 from PyQt4.QtGui import QImage, QPainter, QApplication
 
 from qimage2ndarray import byte_view
 import numpy as np
 
-from volumina.imageScene2D import ImageScene2D
+from volumina.imageScene2D import ImageScene2D, ScrollVelocity, prefetchDepth, \
+                                 PanVelocity, panAheadRect
 from volumina.positionModel import PositionModel
 from volumina.pixelpipeline.datasources import ConstantSource
+from volumina._testing.tiling_benchmark import DelayedArraySource
 from volumina.pixelpipeline.imagepump import StackedImageSources
 from volumina.layerstack import LayerStackModel
 from volumina.layer import GrayscaleLayer
@@ -102,5 +105,93 @@ class ImageScene2D_RenderTest( ut.TestCase ):
         self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY))
         self.assertTrue(np.all(aimg[:,:,3] == 255))
 
+class ImageScene2D_ProgressiveTest( ut.TestCase ):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = None
+        if QApplication.instance():
+            cls.app = QApplication.instance()
+        else:
+            cls.app = QApplication([], False)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.app
+
+    def setUp( self ):
+        self.layerstack = LayerStackModel()
+        self.sims = StackedImageSources( self.layerstack )
+        # a slow source: about 65 ms per full resolution tile
+        self.ds = DelayedArraySource( np.zeros((310, 290), dtype=np.uint8), 1e-6 )
+        self.layer = GrayscaleLayer( self.ds )
+        self.layerstack.append(self.layer)
+        self.ims = imsfac.createImageSource( self.layer, [self.ds] )
+        self.sims.register(self.layer, self.ims)
+
+        self.scene = ImageScene2D(PositionModel(), (0,3,4), preemptive_fetch_number=0)
+        self.scene.stackedImageSources = self.sims
+        self.scene.dataShape = (310,290)
+
+    def tearDown( self ):
+        self.scene._tileProvider.notifyThreadsToStop()
+        self.scene._tileProvider.joinThreads()
+
+    def testPreviewIsRequested( self ):
+        self.assertTrue(self.scene.levelCount > 1)
+        img = QImage(310,290,QImage.Format_ARGB32_Premultiplied)
+        p = QPainter(img)
+        self.scene.render(p)
+        self.scene.joinRendering()
+        p.end()
+
+        # the incomplete tiles requested their coarser preview
+        tp = self.scene._tileProvider
+        cache = tp._caches[1]
+        self.assertFalse(cache.layerDirty(tp._current_stack_id, self.ims, 0))
+
+class PrefetchDepthTest( ut.TestCase ):
+    def testScrollVelocity( self ):
+        v = ScrollVelocity(halfLife=0.25, timeout=0.5)
+        self.assertEqual(v.speed(0.), 0.)
+        for i in range(40):
+            v.step(1, 1, now=0.05 * i)
+        self.assertAlmostEqual(v.speed(2.), 20., delta=0.5)
+        # stopped scrolling
+        self.assertEqual(v.speed(3.), 0.)
+        # another axis starts a new measurement
+        v.step(0, 1, now=2.)
+        self.assertEqual(v.speed(2.), 2.)
+
+    def testPrefetchDepth( self ):
+        self.assertEqual(prefetchDepth(0., 0.01, 16), 0)
+        self.assertEqual(prefetchDepth(0.5, 0., 16), 1)
+        self.assertEqual(prefetchDepth(10., 0., 16), 10)
+        self.assertEqual(prefetchDepth(100., 0., 16), 16)
+        # the render threads can finish only four slices per second
+        self.assertEqual(prefetchDepth(10., 0.25, 16), 4)
+        self.assertEqual(prefetchDepth(10., 5., 16), 1)
+        self.assertEqual(prefetchDepth(10., 0., 0), 0)
+
+class PanAheadTest( ut.TestCase ):
+    def testPanVelocity( self ):
+        v = PanVelocity(halfLife=0.1, timeout=0.2)
+        self.assertEqual(v.velocity(0.), (0., 0.))
+        for i in range(40):
+            v.step(10, -5, now=0.02 * i)
+        vx, vy = v.velocity(0.8)
+        self.assertAlmostEqual(vx, 500., delta=5.)
+        self.assertAlmostEqual(vy, -250., delta=5.)
+        # stopped panning
+        self.assertEqual(v.velocity(1.5), (0., 0.))
+
+    def testPanAheadRect( self ):
+        view = QRectF(0, 0, 400, 300)
+        self.assertTrue(panAheadRect(view, (0., 0.), 64) is None)
+        self.assertEqual(panAheadRect(view, (200., 0.), 64), QRectF(100, 0, 400, 300))
+        # at least a tile ahead
+        self.assertEqual(panAheadRect(view, (0., -10.), 64), QRectF(0, -64, 400, 300))
+        # at most a viewport ahead
+        self.assertEqual(panAheadRect(view, (1e4, 1e4), 64), QRectF(400, 300, 400, 300))
+
 if __name__ == '__main__':
     ut.main()
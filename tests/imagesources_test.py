@@ -5,12 +5,14 @@ sys.path.append("../.")
 import numpy
 import os.path
 
-from PyQt4.QtCore import QRect, pyqtSignal
-from PyQt4.QtGui import QImage
+from PyQt4.QtCore import QRect, QSize, pyqtSignal
+from PyQt4.QtGui import QImage, QTransform, QPainter
+from qimage2ndarray import byte_view
 from PyQt4.QtGui import QColor
 
 import volumina._testing
-from volumina.pixelpipeline.imagesources import GrayscaleImageSource, RGBAImageSource, ColortableImageSource
+from volumina.pixelpipeline.imagesources import GrayscaleImageSource, RGBAImageSource, ColortableImageSource, orient, \
+                                                UniformImage, isUniform
 from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
 from volumina.layer import GrayscaleLayer, RGBALayer, ColortableLayer
 
@@ -166,6 +168,91 @@ class RGBAImageSourceTest( ut.TestCase ):
         self.assertFalse( ims_notopaque.isOpaque() )
         
 
+#*******************************************************************************
+# U n i f o r m I m a g e T e s t                                              *
+#*******************************************************************************
+
+class UniformImageTest( ut.TestCase ):
+    def testIsUniform( self ):
+        a = np.zeros((7, 9), dtype=np.uint8)
+        self.assertTrue(isUniform(a))
+        a[3, 1] = 1
+        self.assertFalse(isUniform(a))
+        self.assertFalse(isUniform(np.zeros((0, 3))))
+
+    def testEmptyLabels( self ):
+        labels = _ArraySource2d(np.zeros((50, 50), dtype=np.uint8))
+        colorTable = [QColor(0,0,0,0).rgba(), QColor(255,0,0).rgba()]
+        ims = ColortableImageSource(labels, ColortableLayer(labels, colorTable))
+        img = ims.request(QRect(0,0,50,50)).wait()
+        self.assertTrue(isinstance(img, UniformImage))
+        self.assertTrue(img.transparent)
+        self.assertEqual(img.size(), QSize(50,50))
+        # shared by all tiles of that size
+        self.assertTrue(ims.request(QRect(0,0,50,50)).wait() is img)
+
+    def testSemiTransparent( self ):
+        labels = _ArraySource2d(np.zeros((50, 50), dtype=np.uint8))
+        colorTable = [QColor(255,128,0,100).rgba()]
+        ims = ColortableImageSource(labels, ColortableLayer(labels, colorTable))
+        img = ims.request(QRect(0,0,50,50)).wait()
+        self.assertTrue(isinstance(img, UniformImage))
+        self.assertEqual(img.color.alpha(), 100)
+        # filling with the color looks like drawing the image
+        filled, drawn = [QImage(50, 50, QImage.Format_ARGB32_Premultiplied) for i in range(2)]
+        for target in (filled, drawn):
+            target.fill(QColor(255,255,255).rgba())
+        p = QPainter(filled)
+        p.fillRect(0, 0, 50, 50, img.color)
+        p.end()
+        p = QPainter(drawn)
+        p.drawImage(0, 0, img)
+        p.end()
+        diff = byte_view(filled).astype(int) - byte_view(drawn)
+        self.assertTrue(np.abs(diff).max() <= 1)
+
+    def testSameAsConverted( self ):
+        for constant in [0, 77, 255]:
+            source = _ArraySource2d(np.ones((40, 40), dtype=np.uint8) * constant)
+            ims = GrayscaleImageSource(source, GrayscaleLayer(source))
+            req = ims.request(QRect(0,0,40,40))
+            img = req.wait()
+            self.assertTrue(isinstance(img, UniformImage))
+            self.assertFalse(img.transparent)
+            expected = req._convert(source.request((slice(0,40), slice(0,40))).wait())
+            self.assertTrue(np.all(byte_view(img) == byte_view(expected)))
+
+    def testRegular( self ):
+        raw = numpy.load(os.path.join(volumina._testing.__path__[0], 'lena.npy'))
+        ars = _ArraySource2d(raw)
+        img = GrayscaleImageSource(ars, GrayscaleLayer(ars)).request(QRect(0,0,64,64)).wait()
+        self.assertFalse(isinstance(img, UniformImage))
+
+#*******************************************************************************
+# O r i e n t T e s t                                                          *
+#*******************************************************************************
+
+class OrientTest( ut.TestCase ):
+    def setUp( self ):
+        self.raw = np.random.randint(0, 255, size=(6, 9)).astype(np.uint8)
+        self.ars = _ArraySource2d(self.raw)
+        self.ims = GrayscaleImageSource( self.ars, GrayscaleLayer( self.ars ) )
+
+    def testMatchesTransformedImages( self ):
+        swap = QTransform(0,1,0,1,0,0,1,1,1)
+        transforms = [swap, QTransform().rotate(90).scale(1,-1)]
+        for rotation in range(4):
+            transforms.append(swap * QTransform().rotate(90 * rotation))
+        rect = QRect(0,0,6,9)
+        for t in transforms:
+            expected = self.ims.request(rect).wait().transformed(t)
+            img = self.ims.request(rect, transform=t).wait()
+            self.assertEqual(img.size(), expected.size())
+            self.assertTrue(np.all(byte_view(img) == byte_view(expected)))
+
+    def testOnlyAxisAligned( self ):
+        self.assertRaises(ValueError, orient, self.raw, QTransform().rotate(45))
+
 #*******************************************************************************
 # i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
 #*******************************************************************************
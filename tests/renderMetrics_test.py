@@ -0,0 +1,67 @@
+import time
+import unittest as ut
+
+from volumina.renderMetrics import LatencyHistogram, RenderMetrics, formatMetrics
+
+class LatencyHistogramTest( ut.TestCase ):
+    def testBuckets( self ):
+        h = LatencyHistogram()
+        for seconds in [0.0005, 0.001, 0.003, 0.003, 0.04, 10.]:
+            h.add(seconds)
+        self.assertEqual(h.count, 6)
+        self.assertEqual(h.counts[0], 2)
+        self.assertEqual(h.counts[2], 2)
+        self.assertEqual(h.counts[5], 1)
+        self.assertEqual(h.counts[-1], 1)
+        self.assertAlmostEqual(h.mean, 10.0475 / 6)
+        self.assertEqual(h.percentile(0.5), 0.005)
+        self.assertEqual(h.percentile(1.0), 10.)
+
+    def testEmpty( self ):
+        h = LatencyHistogram()
+        self.assertEqual(h.mean, 0.)
+        self.assertEqual(h.percentile(0.9), 0.)
+
+class RenderMetricsTest( ut.TestCase ):
+    def testSnapshot( self ):
+        m = RenderMetrics(2)
+        m.layerTileDone('raw', 0.05, 0.01)
+        m.layerTileDone('raw', 0.15, 0.02)
+        m.viewportRendered(False)
+        snapshot = m.snapshot()
+        self.assertEqual(snapshot['layers']['raw']['latency'].count, 2)
+        self.assertAlmostEqual(snapshot['layers']['raw']['compute'].mean, 0.015)
+        self.assertTrue(snapshot['viewport']['pending'])
+        self.assertEqual(snapshot['viewport']['last'], None)
+
+        m.viewportRendered(True)
+        snapshot = m.snapshot()
+        self.assertFalse(snapshot['viewport']['pending'])
+        self.assertTrue(snapshot['viewport']['last'] >= 0.)
+
+    def testUtilization( self ):
+        m = RenderMetrics(2)
+        m.snapshot()
+        time.sleep(0.05)
+        m.workerBusy(10.)
+        self.assertEqual(m.snapshot()['utilization'], 1.)
+        time.sleep(0.01)
+        self.assertEqual(m.snapshot()['utilization'], 0.)
+
+    def testFormat( self ):
+        m = RenderMetrics(1)
+        m.layerTileDone('fast', 0.001, 0.001)
+        m.layerTileDone('slow', 0.5, 0.4)
+        metrics = m.snapshot()
+        metrics['queue'] = {'display' : 3, 'prefetch' : 7, 'running' : 1}
+        metrics['cache'] = {'hits' : 3, 'misses' : 1, 'evictions' : 0,
+                            'bytes' : 2**21, 'maxbytes' : None}
+        lines = formatMetrics(metrics)
+        self.assertEqual(lines[0], 'queue: 3 display, 7 prefetch, 1 running')
+        self.assertEqual(lines[2], 'cache: 75% hits, 2 MiB, 0 evictions')
+        # the slowest layer comes first
+        self.assertTrue(lines[4].startswith('slow: 500 ms latency'))
+        self.assertTrue(lines[5].startswith('fast:'))
+
+if __name__ == '__main__':
+    ut.main()
@@ -32,6 +32,51 @@ class SlicingToolsTest(unittest.TestCase):
 
         self.assertEquals(a, c)
 
+    def test_rect2slicing_step(self):
+        slicing = st.rect2slicing(self.qrect, step=2)
+        self.assertEquals(slicing, (slice(5, 7, 2), slice(10, 18, 2)))
+        self.assertEquals(st.rect2slicing(self.qrect, step=1), self.slicing)
+
+    def test_slicing2shape_step(self):
+        self.assertEquals(st.slicing2shape((slice(0, 10, 3), slice(4, 8))), (4, 4))
+        a = np.zeros((10, 8))
+        s = (slice(1, 10, 4), slice(0, 7, 2))
+        self.assertEquals(st.slicing2shape(s), a[s].shape)
+
+    def test_unstrided(self):
+        s = (slice(1, 10, 4), slice(0, 7))
+        self.assertTrue(st.is_strided(s))
+        self.assertFalse(st.is_strided(self.slicing))
+        bounding, strides = st.unstrided(s)
+        self.assertEquals(bounding, (slice(1, 10), slice(0, 7)))
+        a = np.random.random((10, 8))
+        self.assertTrue(np.all(a[bounding][strides] == a[s]))
+
+    def test_coalesce_slicings(self):
+        tiles = [(slice(x, min(x + 4, 10), 2), slice(y, y + 4, 2))
+                 for x in (0, 4, 8) for y in (0, 4)]
+        # a tile on its own
+        tiles.append((slice(20, 24, 2), slice(0, 4, 2)))
+        merged = st.coalesce_slicings(tiles)
+        self.assertEquals(len(merged), 2)
+        merged = dict((st.slicing_key(m), parts) for m, parts in merged)
+        block = merged[((0, 10, 2), (0, 8, 2))]
+        self.assertEquals(sorted(block), sorted(tiles[:-1]))
+        self.assertEquals(merged[((20, 24, 2), (0, 4, 2))], tiles[-1:])
+
+        a = np.random.random((10, 8))
+        for tile in tiles[:-1]:
+            offset = [(p.start - m.start) // m.step for p, m in zip(tile, (slice(0, 10, 2), slice(0, 8, 2)))]
+            shape = st.slicing2shape(tile)
+            part = tuple(slice(o, o + n) for o, n in zip(offset, shape))
+            self.assertTrue(np.all(a[0:10:2, 0:8:2][part] == a[tile]))
+
+    def test_coalesce_slicings_max_size(self):
+        tiles = [(slice(x, x + 2), slice(y, y + 2)) for x in (0, 2, 4) for y in (0, 2)]
+        merged = st.coalesce_slicings(tiles, max_size=12)
+        self.assertEquals(sorted(st.slicing_key(m) for m, parts in merged),
+                          [((0, 6, None), (0, 2, None)), ((0, 6, None), (2, 4, None))])
+
 
 if __name__=='__main__':
     unittest.main()
@@ -0,0 +1,50 @@
+import json
+import unittest as ut
+import numpy as np
+
+from volumina.pixelpipeline.datasources import ArraySource
+from volumina._testing.tiling_benchmark import TilingBenchmark, DelayedArraySource, \
+                                               labelVolume, SCENARIOS
+
+#*******************************************************************************
+# T i l i n g B e n c h m a r k T e s t                                        *
+#*******************************************************************************
+
+class TilingBenchmarkTest( ut.TestCase ):
+    def setUp( self ):
+        self.benchmark = TilingBenchmark(shape=(300, 300, 3), layers=('labels', 'delay'),
+                                         delay_factor=1e-9, viewport=(200, 150), blockSize=100)
+
+    def testDelayedSource( self ):
+        a = np.arange(24).reshape(2, 3, 4)
+        slicing = (slice(0, 1), slice(None), slice(1, 3))
+        self.assertTrue(np.all(DelayedArraySource(a, 1e-9).request(slicing).wait() ==
+                               ArraySource(a).request(slicing).wait()))
+
+    def testLabelVolume( self ):
+        a = labelVolume((50, 40, 3), nlabels=5)
+        self.assertEqual(a.shape, (1, 50, 40, 3, 1))
+        self.assertTrue(a.max() <= 5)
+        self.assertTrue(np.any(a == 0) and np.any(a > 0))
+
+    def testScenarios( self ):
+        report = self.benchmark.runAll(SCENARIOS)
+        json.dumps(report)
+        self.assertEqual([r['scenario'] for r in report['scenarios']], SCENARIOS)
+        for r in report['scenarios']:
+            self.assertTrue(r['tiles'] > 0)
+            self.assertTrue(r['layerTiles'] > 0)
+            self.assertTrue(0 <= r['cache']['hitRate'] <= 1)
+            self.assertEqual(set(r['layers']), set(['labels', 'delay']))
+        scroll = report['scenarios'][0]
+        # initial view, two slices down and two back up
+        self.assertEqual(scroll['steps'], 5)
+        # scrolling back finds the slices in the cache
+        self.assertTrue(scroll['cache']['hits'] > 0)
+
+#*******************************************************************************
+# i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
+#*******************************************************************************
+
+if __name__ == '__main__':
+    ut.main()
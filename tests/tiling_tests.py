@@ -1,15 +1,20 @@
 import os
+import time
+import weakref
 import unittest as ut
+from threading import Thread
+from Queue import Empty
 import numpy as np
-from PyQt4.QtCore import QRectF, QPoint, QRect
-from PyQt4.QtGui import QTransform, qApp
+from PyQt4.QtCore import QRectF, QPoint, QPointF, QRect, QSize
+from PyQt4.QtGui import QTransform, QImage, qApp
 from qimage2ndarray import byte_view
 
-from volumina.tiling import TileProvider, Tiling
+from volumina.tiling import TileProvider, Tiling, _TilesCache, _InFlightRequest, \
+                           _RenderQueue, _LayerTileRequest, LayerTileRegistry, RenderExecutor
 from volumina.layerstack import LayerStackModel
 from volumina.layer import GrayscaleLayer
 from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
-from volumina.pixelpipeline.imagesources import GrayscaleImageSource
+from volumina.pixelpipeline.imagesources import GrayscaleImageSource, UniformImage
 from volumina.pixelpipeline.imagepump import StackedImageSources, ImagePump
 from volumina.pixelpipeline.slicesources import SliceSource
 from volumina.slicingtools import SliceProjection
@@ -44,6 +49,116 @@ class TilingTest ( ut.TestCase ):
         with self.assertRaises(AssertionError):
             t.data2scene = trans
 
+    def testIntersected( self ):
+        t = Tiling((900,400), blockSize=100)
+        self.assertEqual(t.intersected(QRectF(150,50,100,100)), [1, 2, 10, 11])
+        self.assertEqual(t.intersectedData(QRect(100,100,100,100)), [10])
+        self.assertEqual(t.intersectedData(QRect(100,100,100,100), margin=1),
+                         [0, 1, 2, 9, 10, 11, 18, 19, 20])
+
+        # the last column absorbs the remaining 20 pixels
+        t = Tiling((1020,400), blockSize=100)
+        self.assertEqual(len(t), 10*4)
+        self.assertEqual(t.intersected(QRectF(1005,10,10,10)), [9])
+
+    def testPyramid( self ):
+        t = Tiling((900,400), blockSize=100, levels=3)
+        self.assertEqual(t.levelCount, 3)
+        self.assertTrue(t.level(0) is t)
+        self.assertEqual(len(t.level(1)), 5*2)
+        self.assertEqual(len(t.level(2)), 2*1)
+        self.assertEqual(t.level(1).imageRects[0], QRect(0,0,200,200))
+        self.assertEqual(t.level(1).imageSizes[0], QSize(100,100))
+
+        trans = QTransform.fromTranslate(10, 0)
+        t.data2scene = trans
+        self.assertEqual(t.level(2).data2scene, trans)
+
+    def testPyramidDepth( self ):
+        self.assertEqual(Tiling.pyramidDepth((0,0)), 1)
+        self.assertEqual(Tiling.pyramidDepth((256,100)), 1)
+        self.assertEqual(Tiling.pyramidDepth((257,100)), 2)
+        self.assertEqual(Tiling.pyramidDepth((20000,20000)), 8)
+
+    def testLevelForScale( self ):
+        t = Tiling((900,400), blockSize=100, levels=3)
+        self.assertEqual(t.levelForScale(2.0), 0)
+        self.assertEqual(t.levelForScale(0.6), 0)
+        self.assertEqual(t.levelForScale(0.5), 1)
+        self.assertEqual(t.levelForScale(0.3), 1)
+        self.assertEqual(t.levelForScale(0.01), 2)
+
+
+class TilesCacheTest( ut.TestCase ):
+    def setUp( self ):
+        self.sims = StackedImageSources( LayerStackModel() )
+        self.stack_id = (None, (0,0,0))
+
+    def _img( self ):
+        img = QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+        img.fill(0)
+        return img
+
+    def testCostAwareEviction( self ):
+        nbytes = self._img().byteCount()
+        cache = _TilesCache(self.stack_id, self.sims, maxbytes=2*nbytes)
+        sid = self.stack_id
+        cache.updateTileIfNecessary(sid, 'cheap', 0, 1.0, self._img(), 0.0)
+        cache.updateTileIfNecessary(sid, 'slow', 0, 1.0, self._img(), 2.0)
+        cache.updateTileIfNecessary(sid, 'medium', 0, 1.0, self._img(), 0.5)
+
+        self.assertEqual(cache.layer(sid, 'cheap', 0), None)
+        self.assertTrue(cache.layerDirty(sid, 'cheap', 0))
+        self.assertNotEqual(cache.layer(sid, 'slow', 0), None)
+        self.assertNotEqual(cache.layer(sid, 'medium', 0), None)
+
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['bytes'], 2*nbytes)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def testStackEvictionReleasesBytes( self ):
+        cache = _TilesCache(self.stack_id, self.sims, maxstacks=1)
+        cache.updateTileIfNecessary(self.stack_id, 'l', 0, 1.0, self._img())
+        self.assertTrue(cache.stats()['bytes'] > 0)
+        cache.addStack((None, (0,1,0)))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def testGenerations( self ):
+        cache = _TilesCache(self.stack_id, self.sims)
+        other_id = (None, (0,1,0))
+        cache.addStack(other_id)
+        for sid in (self.stack_id, other_id):
+            for tile_id in range(3):
+                cache.setTileDirty(sid, tile_id, False)
+        cache.setTileDirty(self.stack_id, 1, True)
+        self.assertEqual([cache.tileDirty(self.stack_id, t) for t in range(3)],
+                         [False, True, False])
+
+        cache.setAllTilesDirty()
+        for sid in (self.stack_id, other_id):
+            self.assertTrue(all(cache.tileDirty(sid, t) for t in range(3)))
+        cache.setTileDirty(other_id, 2, False)
+        self.assertFalse(cache.tileDirty(other_id, 2))
+        self.assertTrue(cache.tileDirty(self.stack_id, 2))
+
+    def testLookupsDoNotBlockOnWriters( self ):
+        cache = _TilesCache(self.stack_id, self.sims)
+        img = self._img()
+        cache.updateTileIfNecessary(self.stack_id, 'l', 0, 1.0, img)
+
+        # simulate a worker that is in the middle of an insertion
+        cache._stacks[self.stack_id].lock.acquire()
+        cache._accountLock.acquire()
+        try:
+            self.assertTrue(cache.layer(self.stack_id, 'l', 0) is img)
+            self.assertFalse(cache.layerDirty(self.stack_id, 'l', 0))
+            self.assertEqual(cache.tile(self.stack_id, 0), (None, 0.))
+        finally:
+            cache._accountLock.release()
+            cache._stacks[self.stack_id].lock.release()
+
 
 class TileProviderTest( ut.TestCase ):
     def setUp( self ):
@@ -119,6 +234,103 @@ class TileProviderTest( ut.TestCase ):
             tp.notifyThreadsToStop()
             tp.joinThreads()
 
+    def testDownsampledLevel( self ):
+        tiling = Tiling((900,400), blockSize=100, levels=2)
+        tp = TileProvider(tiling, self.sims)
+        try:
+            tp.requestRefresh(QRectF(100,100,200,200), level=1)
+            tp.join()
+            tiles = tp.getTiles(QRectF(100,100,200,200), level=1)
+            for tile in tiles:
+                self.assertTrue(tile.tiling is tiling.level(1))
+                self.assertEqual(tile.qimg.width(), tile.rectF.width() / 2)
+                self.assertEqual(tile.qimg.height(), tile.rectF.height() / 2)
+                aimg = byte_view(tile.qimg)
+                self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY3))
+                self.assertTrue(np.all(aimg[:,:,3] == 255))
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testUniformTiles( self ):
+        # tiles of constant layers share their images and take no room
+        # in the cache
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        try:
+            tp.requestRefresh(QRectF(100,100,200,200))
+            tp.join()
+            tiles = list(tp.getTiles(QRectF(100,100,200,200)))
+            for tile in tiles:
+                self.assertTrue(isinstance(tile.qimg, UniformImage))
+                self.assertTrue(tile.qimg is tiles[0].qimg)
+                aimg = byte_view(tile.qimg)
+                self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY3))
+            self.assertEqual(tp.cacheStats()['bytes'], 0)
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testIncrementalCompositing( self ):
+        self.layer1.visible = True
+        self.layer3.opacity = 0.5
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        rect = QRectF(100,100,200,200)
+        try:
+            tp.requestRefresh(rect)
+            tp.join()
+            list(tp.getTiles(rect))
+            stack_id = tp._current_stack_id
+            for opacity in [0.2, 0.6, 0.9]:
+                self.layer2.opacity = opacity
+                for tile in tp.getTiles(rect):
+                    partial = tp._cache.partialComposite(stack_id, tile.id)
+                    self.assertTrue(partial is not None)
+                    self.assertEqual(partial.pivot, 1)
+                    layers = tp._layerStates(stack_id, tile.id, tp._cache)
+                    full = tp._composite(tile.qimg.size(), layers)
+                    diff = byte_view(tile.qimg).astype(int) - byte_view(full)
+                    self.assertTrue(np.all(np.abs(diff) <= 2))
+
+            # another layer changes; the partial composites are rebuilt
+            self.layer1.opacity = 0.7
+            for tile in tp.getTiles(rect):
+                self.assertEqual(tp._cache.partialComposite(stack_id, tile.id).pivot, 2)
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testMetrics( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        rect = QRectF(100,100,200,200)
+        try:
+            tp.requestRefresh(rect)
+            tp.join()
+            self.assertFalse(tp.viewportRendered(rect))
+            list(tp.getTiles(rect))
+            self.assertTrue(tp.viewportRendered(rect))
+
+            metrics = tp.metrics()
+            self.assertEqual(metrics['queue'], {'display' : 0, 'prefetch' : 0, 'running' : 0})
+            n_tiles = len(tiling.intersected(rect))
+            # layer1 is invisible and layer2 is occluded by layer3
+            self.assertEqual(metrics['layers'].keys(), [self.layer3.name])
+            self.assertEqual(metrics['layers'][self.layer3.name]['latency'].count, n_tiles)
+            self.assertTrue(metrics['viewport']['last'] is not None)
+            self.assertTrue(0. <= metrics['utilization'] <= 1.)
+            self.assertTrue(metrics['cache']['hits'] > 0)
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testIdleThreadsStopPromptly( self ):
+        tp = TileProvider(Tiling((900,400), blockSize=100), self.sims)
+        tp.notifyThreadsToStop()
+        tp.joinThreads(1.)
+        self.assertFalse(any(tp.aliveThreads().values()))
+
 
 class DirtyPropagationTest( ut.TestCase ):
 
@@ -239,5 +451,622 @@ class DirtyPropagationTest( ut.TestCase ):
             tp.joinThreads()
 
 
+    def testDirtyRectOnlyTouchesIntersectingTiles( self ):
+        self.lsm.append(self.layer1)
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources)
+        try:
+            tp.requestRefresh(QRectF(0,0,900,400))
+            tp.join()
+            list(tp.getTiles(QRectF(0,0,900,400)))
+
+            slicing = (slice(None), slice(110,120), slice(210,220), slice(None), slice(None))
+            self.ds1.setDirty( slicing )
+
+            stack_id = tp._current_stack_id
+            ims = list(self.pump.stackedImageSources.viewImageSources())[0]
+            for tile_no in range(len(tiling)):
+                self.assertEqual(tp._cache.layerDirty(stack_id, ims, tile_no), tile_no == 19)
+                self.assertEqual(tp._cache.tileDirty(stack_id, tile_no), tile_no == 19)
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
+class StaleRequestTest( ut.TestCase ):
+    def setUp( self ):
+        dataShape = (1, 900, 400, 10, 1) # t,x,y,z,c
+        self.ds = ArraySource( np.indices(dataShape)[3] )
+        self.layer = GrayscaleLayer( self.ds )
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection() )
+        self.lsm.append(self.layer)
+
+    def testLeftSliceRequestsAreDropped( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        # no render threads: requests stay queued until we process them
+        tp = TileProvider(tiling, self.pump.stackedImageSources, n_threads=0)
+        worker = Thread(target=tp._dirtyLayersWorker)
+        try:
+            self.pump.syncedSliceSources.through = [0,1,0]
+            left_id = self.pump.stackedImageSources.stackId
+            tp.requestRefresh(QRectF(100,100,200,200))
+            self.assertTrue(tp._renderQueue.qsize() > 0)
+
+            self.pump.syncedSliceSources.through = [0,2,0]
+            worker.start()
+            tp.join()
+
+            ims = self.pump.stackedImageSources.getImageSource(0)
+            for tile_no in tiling.intersected(QRectF(100,100,200,200)):
+                self.assertTrue(tp._cache.layerDirty(left_id, ims, tile_no))
+                # must be requested again when the slice is revisited
+                self.assertTrue(tp._cache.tileDirty(left_id, tile_no))
+        finally:
+            tp.notifyThreadsToStop()
+            if worker.ident:
+                worker.join()
+
+    def testRunningDisplayRequestsAreCancelled( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources, n_threads=0)
+        try:
+            class Request(object):
+                cancelled = False
+                def cancel(self):
+                    self.cancelled = True
+            display, prefetch = Request(), Request()
+            old_id = tp._current_stack_id
+            tp._inFlight = {1 : _InFlightRequest(old_id, display, False),
+                            2 : _InFlightRequest(old_id, prefetch, True)}
+            self.pump.syncedSliceSources.through = [0,3,0]
+            self.assertTrue(display.cancelled)
+            self.assertFalse(prefetch.cancelled)
+        finally:
+            tp.notifyThreadsToStop()
+
+
+class RenderQueueTest( ut.TestCase ):
+    class ImageRequest( object ):
+        def __init__( self ):
+            self.priority = 0
+            self.cancelled = False
+        def adjustPriority( self, delta ):
+            self.priority += delta
+        def cancel( self ):
+            self.cancelled = True
+
+    def _req( self, tile_nr, priority, prefetch=False ):
+        req = _LayerTileRequest(None, tile_nr, None, self.ImageRequest(),
+                                0., None, 0, prefetch)
+        req.priority = priority
+        return req
+
+    def testOrder( self ):
+        q = _RenderQueue()
+        q.put(self._req(0, 5.))
+        q.put(self._req(1, 1.))
+        q.put(self._req(2, 1.))
+        q.put(self._req(3, 0.5, prefetch=True))
+        self.assertEqual([q.get().tile_nr for i in range(4)], [3, 2, 1, 0])
+        self.assertRaises(Empty, q.get, 0)
+
+    def testReprioritize( self ):
+        q = _RenderQueue()
+        reqs = [self._req(i, float(i)) for i in range(3)]
+        for req in reqs:
+            q.put(req)
+        q.reprioritize(lambda req: -req.tile_nr)
+        self.assertEqual(q.get().tile_nr, 2)
+        self.assertEqual(reqs[2].image_req.priority, -4)
+
+    def testJoinIgnoresPrefetch( self ):
+        q = _RenderQueue()
+        q.put(self._req(0, 0., prefetch=True))
+        display = self._req(1, 0.)
+        q.put(display)
+        self.assertEqual(q.discard(lambda req: req is display), 1)
+        q.join() # must not block
+        self.assertEqual(q.qsize(), 1)
+        self.assertTrue(display.image_req.cancelled)
+
+    def testCloseWakesConsumers( self ):
+        q = _RenderQueue()
+        got = []
+        consumer = Thread(target=lambda: got.append(q.get()))
+        consumer.start()
+        q.close()
+        consumer.join(1.)
+        self.assertFalse(consumer.is_alive())
+        self.assertEqual(got, [None])
+        late = self._req(0, 0.)
+        q.put(late)
+        self.assertEqual(q.qsize(), 0)
+        self.assertTrue(late.image_req.cancelled)
+
+    def testCloseCancelsWaitingRequests( self ):
+        q = _RenderQueue()
+        reqs = [self._req(i, 0.) for i in range(3)]
+        for req in reqs:
+            q.put(req)
+        q.close()
+        self.assertTrue(all(req.image_req.cancelled for req in reqs))
+
+
+class RenderPriorityTest( ut.TestCase ):
+    def setUp( self ):
+        dataShape = (1, 900, 400, 10, 1) # t,x,y,z,c
+        self.ds = ArraySource( np.indices(dataShape)[3] )
+        self.layer = GrayscaleLayer( self.ds )
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection() )
+        self.lsm.append(self.layer)
+
+    def testTilesNearCenterFirst( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources, n_threads=0)
+        try:
+            tp.setPriorityCenter(QPointF(750, 350))
+            tp.requestRefresh(QRectF(0,0,900,400))
+            first = tp._renderQueue.get(0)
+            self.assertEqual(first.tile_nr, tiling.containsF(QPointF(750, 350)))
+            tp._renderQueue.task_done(first)
+
+            # moving the center reorders the waiting requests
+            tp.setPriorityCenter(QPointF(50, 50))
+            first = tp._renderQueue.get(0)
+            self.assertEqual(first.tile_nr, 0)
+            tp._renderQueue.task_done(first)
+        finally:
+            tp.notifyThreadsToStop()
+
+    def testPrefetchedSlicesInGivenOrder( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources, n_threads=0,
+                          registry=LayerTileRegistry(0))
+        try:
+            # wrapped around: slice 9 is shown before slice 1
+            tp.prefetchSlices(QRectF(0,0,200,200), [(0,9,0), (0,1,0)])
+            throughs = []
+            while tp._renderQueue.qsize():
+                req = tp._renderQueue.get(0)
+                throughs.append(req.stack_id[1])
+                tp._renderQueue.task_done(req)
+            self.assertEqual(throughs, sorted(throughs, reverse=True))
+            self.assertEqual(throughs[0], (0,9,0))
+        finally:
+            tp.notifyThreadsToStop()
+
+    def testSkippedRequestsAreCancelled( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources, n_threads=0)
+        try:
+            ims = self.pump.stackedImageSources.getImageSource(0)
+            stack_id = tp._current_stack_id
+
+            # superseded and not prefetched: dropped
+            left = _LayerTileRequest(ims, 0, (stack_id[0], (0,7,0)), RenderQueueTest.ImageRequest(),
+                                     time.time(), tp._cache, 0, False)
+            tp._renderLayerTile(left)
+            self.assertTrue(left.image_req.cancelled)
+
+            # a newer image is cached already
+            tp._cache.updateTileIfNecessary(stack_id, ims, 0, time.time(), QImage(100, 100, QImage.Format_ARGB32))
+            old = _LayerTileRequest(ims, 0, stack_id, RenderQueueTest.ImageRequest(),
+                                    0., tp._cache, 0, False)
+            tp._renderLayerTile(old)
+            self.assertTrue(old.image_req.cancelled)
+        finally:
+            tp.notifyThreadsToStop()
+
+    def testCancelPrefetchKeepsFrames( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources, n_threads=0,
+                          registry=LayerTileRegistry(0))
+        try:
+            tp.prefetch(QRectF(0,0,200,200), (0,4,0))
+            tp.prefetch(QRectF(0,0,200,200), (0,5,0))
+            tp.cancelPrefetch(keep=[(0,5,0)])
+            self.assertTrue(tp._renderQueue.qsize() > 0)
+            while tp._renderQueue.qsize():
+                req = tp._renderQueue.get(0)
+                self.assertEqual(req.stack_id[1], (0,5,0))
+                tp._renderQueue.task_done(req)
+        finally:
+            tp.notifyThreadsToStop()
+
+    def testPriorityChangesArePassedOn( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources, n_threads=0)
+        try:
+            tp.setPriorityCenter(QPointF(750, 350))
+            ims = self.pump.stackedImageSources.getImageSource(0)
+            image_req = RenderQueueTest.ImageRequest()
+            stack_id = tp._current_stack_id
+            tp._enqueue(_LayerTileRequest(ims, 0, stack_id, image_req, 0., tp._cache, 0, False))
+            req = tp._renderQueue.get(0)
+            self.assertEqual(image_req.priority, req.priority)
+            tp._renderQueue.task_done(req)
+
+            # demoted to a prefetch request: the image request follows
+            tp._prefetchStacks[stack_id] = 1
+            tp._supersede(req)
+            demoted = tp._renderQueue.get(0)
+            self.assertTrue(demoted.prefetch)
+            self.assertEqual(image_req.priority, demoted.priority)
+            tp._renderQueue.task_done(demoted)
+        finally:
+            tp.notifyThreadsToStop()
+
+class _CountingArraySource( ArraySource ):
+    def __init__( self, array ):
+        super(_CountingArraySource, self).__init__(array)
+        self.requests = 0
+
+    def request( self, slicing ):
+        self.requests += 1
+        return super(_CountingArraySource, self).request(slicing)
+
+class SharedTilesTest( ut.TestCase ):
+    '''Two editors showing the same data share their layer tiles.'''
+    def setUp( self ):
+        dataShape = (1, 900, 400, 10, 1) # t,x,y,z,c
+        self.data = np.indices(dataShape)[3]
+        self.ds = _CountingArraySource( self.data )
+        self.pumps = []
+        for i in range(2):
+            lsm = LayerStackModel()
+            pump = ImagePump( lsm, SliceProjection() )
+            lsm.append( GrayscaleLayer( self.ds ) )
+            self.pumps.append((lsm, pump))
+        self.registry = LayerTileRegistry(2**30)
+        self.tiling = Tiling((900,400), blockSize=100)
+        self.rect = QRectF(100,100,200,200)
+
+    def _providers( self ):
+        return [TileProvider(self.tiling, pump.stackedImageSources, registry=self.registry)
+                for lsm, pump in self.pumps]
+
+    def _render( self, tp ):
+        tp.requestRefresh(self.rect)
+        tp.join()
+        return list(tp.getTiles(self.rect))
+
+    def testComputedOnce( self ):
+        tps = self._providers()
+        try:
+            tiles = [self._render(tp) for tp in tps]
+            # the adjacent tiles are read at once
+            self.assertEqual(self.ds.requests, 1)
+            ims = [list(pump.stackedImageSources.viewImageSources())[0] for lsm, pump in self.pumps]
+            for tile in tiles[0]:
+                images = [tp._cache.layer(tp._current_stack_id, i, tile.id) for tp, i in zip(tps, ims)]
+                self.assertTrue(images[0] is not None and images[0] is images[1])
+
+            # the other slice is not shared with anything
+            for lsm, pump in self.pumps:
+                pump.syncedSliceSources.through = [0,2,0]
+            tiles = [self._render(tp) for tp in tps]
+            self.assertEqual(self.ds.requests, 2)
+            for tile in tiles[1]:
+                self.assertTrue(np.all(byte_view(tile.qimg)[:,:,0:3] == 2))
+        finally:
+            for tp in tps:
+                tp.notifyThreadsToStop()
+                tp.joinThreads()
+
+    def testDirty( self ):
+        tps = self._providers()
+        try:
+            for tp in tps:
+                self._render(tp)
+            self.data[0,:,:,0,0] = 7
+            self.ds.setDirty(5*(slice(None),))
+            for tp in tps:
+                for tile in self._render(tp):
+                    self.assertTrue(np.all(byte_view(tile.qimg)[:,:,0:3] == 7))
+        finally:
+            for tp in tps:
+                tp.notifyThreadsToStop()
+                tp.joinThreads()
+
+    def testCancelledByOneProvider( self ):
+        registry = LayerTileRegistry(2**30)
+        ims = list(self.pumps[0][1].stackedImageSources.viewImageSources())[0]
+        args = (ims, [0,0,0], QRect(0,0,100,100))
+        first = registry.request(*args)
+        second = registry.request(*args)
+        self.assertTrue(first.shared is second.shared)
+        first.cancel()
+        self.assertFalse(first.cancelled)
+        self.assertTrue(second.wait() is not None)
+        self.assertEqual(registry.stats()['entries'], 1)
+
+    def testDiscardedPrefetchIsReleased( self ):
+        registry = LayerTileRegistry(2**30)
+        tp = TileProvider(self.tiling, self.pumps[0][1].stackedImageSources,
+                          n_threads=0, registry=registry)
+        try:
+            tp.prefetch(self.rect, (0, 5, 0))
+            self.assertTrue(registry.stats()['entries'] > 0)
+            tp.cancelPrefetch()
+            self.assertEqual(registry.stats()['entries'], 0)
+        finally:
+            tp.notifyThreadsToStop()
+
+    def testPendingEntriesAreBounded( self ):
+        registry = LayerTileRegistry(2**30, maxpending=3)
+        ims = list(self.pumps[0][1].stackedImageSources.viewImageSources())[0]
+        reqs = [registry.request(ims, [0,0,0], QRect(0,100*i,100,100)) for i in range(5)]
+        self.assertEqual(registry.stats()['entries'], 3)
+        # forgotten, not cancelled
+        self.assertFalse(reqs[0].cancelled)
+        self.assertTrue(reqs[0].wait() is not None)
+
+    def testFinishedEntriesAreNotPending( self ):
+        registry = LayerTileRegistry(2**30, maxpending=2)
+        ims = list(self.pumps[0][1].stackedImageSources.viewImageSources())[0]
+        rects = [QRect(0,100*i,100,100) for i in range(4)]
+        registry.request(ims, [0,0,0], rects[0]).wait()
+        registry.request(ims, [0,0,0], rects[1])
+        registry.request(ims, [0,0,0], rects[2])
+        # a hit makes the pending entry recently used
+        registry.request(ims, [0,0,0], rects[1])
+        registry.request(ims, [0,0,0], rects[3])
+        self.assertEqual(registry.stats()['entries'], 3)
+        hits = registry.stats()['hits']
+        for i in (0, 1, 3):
+            registry.request(ims, [0,0,0], rects[i])
+        self.assertEqual(registry.stats()['hits'], hits + 3)
+
+    def testPriorityOfMostUrgentUser( self ):
+        class ImageRequest( object ):
+            priority = 0
+            def adjustPriority( self, delta ):
+                self.priority += delta
+        registry = LayerTileRegistry(2**30)
+        ims = list(self.pumps[0][1].stackedImageSources.viewImageSources())[0]
+        args = (ims, [0,0,0], QRect(0,0,100,100))
+        first = registry.request(*args)
+        image_req = first.shared._request = ImageRequest()
+        second = registry.request(*args)
+        third = registry.request(*args)
+        # the priorities of the users do not add up; the most urgent one counts
+        for i in range(3):
+            first.adjustPriority(5)
+            second.adjustPriority(2)
+            third.adjustPriority(3)
+        self.assertEqual(image_req.priority, 6)
+        second.cancel()
+        self.assertEqual(image_req.priority, 9)
+
+class RenderExecutorTest( ut.TestCase ):
+    '''TileProviders of several views share the render threads fairly.'''
+    class Owner( object ):
+        pass
+
+    def setUp( self ):
+        dataShape = (1, 900, 400, 10, 1) # t,x,y,z,c
+        self.ds = ArraySource( np.indices(dataShape)[3] )
+        self.pumps = []
+        for i in range(2):
+            lsm = LayerStackModel()
+            pump = ImagePump( lsm, SliceProjection() )
+            lsm.append( GrayscaleLayer( self.ds ) )
+            self.pumps.append((lsm, pump))
+        self.tiling = Tiling((900,400), blockSize=100)
+        self.rect = QRectF(0,0,400,400)
+
+    def _providers( self, executor, owners ):
+        return [TileProvider(self.tiling, pump.stackedImageSources,
+                             registry=LayerTileRegistry(0), executor=executor, owner=owner)
+                for (lsm, pump), owner in zip(self.pumps, owners)]
+
+    def testFairnessAndFocus( self ):
+        # no threads: requests stay queued until we pick them
+        executor = RenderExecutor(0)
+        owners = [self.Owner(), self.Owner()]
+        tps = self._providers(executor, owners)
+        try:
+            for tp in tps:
+                tp.requestRefresh(self.rect)
+            n = len(self.tiling.intersected(self.rect))
+
+            # the views take turns
+            picked = [executor._pick()[0] for i in range(4)]
+            self.assertTrue(all(a is not b for a, b in zip(picked, picked[1:])))
+
+            # the focused view comes first
+            executor.setFocus(owners[1])
+            picked = [executor._pick()[0] for i in range(n - 2)]
+            self.assertTrue(all(tp is tps[1] for tp in picked))
+            self.assertTrue(executor._pick()[0] is tps[0])
+        finally:
+            for tp in tps:
+                tp.notifyThreadsToStop()
+
+    def testOwnerNotKeptAlive( self ):
+        executor = RenderExecutor(0)
+        owner = self.Owner()
+        tp, = self._providers(executor, [owner])
+        try:
+            tp.requestRefresh(self.rect)
+            ref = weakref.ref(owner)
+            del owner
+            self.assertTrue(ref() is None)
+            # the provider of a collected owner is dropped, not served
+            self.assertTrue(executor._pick() is None)
+            self.assertEqual(executor._entries, {})
+        finally:
+            tp.notifyThreadsToStop()
+
+    def testRender( self ):
+        executor = RenderExecutor(2)
+        tps = self._providers(executor, [None, None])
+        try:
+            for tp in tps:
+                tp.requestRefresh(self.rect)
+            for tp in tps:
+                tp.join()
+                for tile in tp.getTiles(self.rect):
+                    self.assertEqual(tile.progress, 1.0)
+            self.assertEqual(tps[0].aliveThreads(), {})
+        finally:
+            for tp in tps:
+                tp.notifyThreadsToStop()
+                tp.joinThreads()
+            executor.close()
+            executor.join()
+
+class AxesChangeTest( ut.TestCase ):
+    '''Rotating or swapping the axes reuses the cached layer tiles.'''
+    def setUp( self ):
+        dataShape = (1, 900, 400, 1, 1) # t,x,y,z,c
+        x, y = np.indices(dataShape)[1:3]
+        self.data = ((x + 3 * y) % 256).astype(np.uint8)
+        self.ds = _CountingArraySource( self.data )
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection() )
+        self.lsm.append( GrayscaleLayer( self.ds ) )
+        self.tiling = Tiling((900,400), blockSize=100)
+        self.tps = []
+
+    def tearDown( self ):
+        for tp in self.tps:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def _provider( self, swapped ):
+        tp = TileProvider(self.tiling, self.pump.stackedImageSources,
+                          registry=LayerTileRegistry(0))
+        tp.axesSwapped = swapped
+        self.tps.append(tp)
+        return tp
+
+    def _render( self, tp ):
+        rect = self.tiling.data2scene.mapRect(QRectF(0, 0, 900, 400))
+        tp.requestRefresh(rect)
+        tp.join()
+        return dict((tile.id, byte_view(tile.qimg).copy()) for tile in tp.getTiles(rect))
+
+    def _changeAxes( self, tp, data2scene, swapped ):
+        self.tiling.data2scene = data2scene
+        tp.axesSwapped = swapped
+        tp.axesChanged()
+
+    def testReuseLayerTiles( self ):
+        tp = self._provider(False)
+        self._render(tp)
+        n_requests = self.ds.requests
+
+        for data2scene, swapped in [(QTransform(0,1,0,1,0,0,0,0,1), True),
+                                    (QTransform().rotate(90) * QTransform.fromTranslate(400, 0), False)]:
+            self._changeAxes(tp, data2scene, swapped)
+            tiles = self._render(tp)
+            self.assertEqual(self.ds.requests, n_requests)
+
+            # same tiles as rendered from scratch in the new orientation
+            fresh = self._render(self._provider(swapped))
+            n_requests = self.ds.requests
+            self.assertEqual(sorted(tiles), sorted(fresh))
+            for tile_id in tiles:
+                self.assertTrue(np.all(tiles[tile_id] == fresh[tile_id]))
+
+
+class CoalescingTest( ut.TestCase ):
+    '''Adjacent layer tiles are read from their source at once.'''
+    def setUp( self ):
+        dataShape = (1, 900, 400, 10, 1) # t,x,y,z,c
+        x, y, z = np.indices(dataShape)[1:4]
+        self.data = ((x + 3 * y + 7 * z) % 256).astype(np.uint8)
+        self.ds = _CountingArraySource( self.data )
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection() )
+        self.lsm.append( GrayscaleLayer( self.ds ) )
+        self.tiling = Tiling((900,400), blockSize=100)
+        self.rect = self.tiling.data2scene.mapRect(QRectF(0, 0, 900, 400))
+
+    def _render( self ):
+        tp = TileProvider(self.tiling, self.pump.stackedImageSources,
+                          registry=LayerTileRegistry(0))
+        try:
+            tp.requestRefresh(self.rect)
+            tp.join()
+            return dict((tile.id, byte_view(tile.qimg).copy()) for tile in tp.getTiles(self.rect))
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testSameTiles( self ):
+        tiles = self._render()
+        self.assertEqual(self.ds.requests, 1)
+
+        maxSize = SliceSource.maxCoalescedSize
+        SliceSource.maxCoalescedSize = 0
+        try:
+            single = self._render()
+        finally:
+            SliceSource.maxCoalescedSize = maxSize
+        self.assertEqual(self.ds.requests, 1 + len(tiles))
+        self.assertEqual(sorted(tiles), sorted(single))
+        for tile_id in tiles:
+            self.assertTrue(np.all(tiles[tile_id] == single[tile_id]))
+
+    def testLimitedSize( self ):
+        maxSize = SliceSource.maxCoalescedSize
+        SliceSource.maxCoalescedSize = 900 * 200
+        try:
+            self._render()
+        finally:
+            SliceSource.maxCoalescedSize = maxSize
+        # two reads of two rows of tiles each
+        self.assertEqual(self.ds.requests, 2)
+
+    def testPriority( self ):
+        adjusted = []
+        class Source( ArraySource ):
+            def request( self, slicing ):
+                req = super(Source, self).request(slicing)
+                req.adjustPriority = adjusted.append
+                return req
+        ss = SliceSource(Source(self.data))
+        slicings = [(slice(0,100), slice(y,y+100)) for y in (0,100,200)]
+        with ss.coalesced([(s, None) for s in slicings]):
+            parts = [ss.request(s) for s in slicings]
+        # the shared read follows its most urgent part
+        for i, part in enumerate(parts):
+            part.adjustPriority(5 + i)
+        self.assertEqual(sum(adjusted), 5)
+        parts[0].cancel()
+        self.assertEqual(sum(adjusted), 6)
+
+    def testSlab( self ):
+        tp = TileProvider(self.tiling, self.pump.stackedImageSources,
+                          registry=LayerTileRegistry(0))
+        try:
+            throughs = [(0, z, 0) for z in range(1, 5)]
+            tp.prefetchSlices(self.rect, throughs)
+            deadline = time.time() + 10
+            while not all(tp.prefetched(self.rect, through) for through in throughs):
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.01)
+            # one read of the whole view through four slices
+            self.assertEqual(self.ds.requests, 1)
+
+            self.pump.syncedSliceSources.through = [0, 3, 0]
+            tp.requestRefresh(self.rect)
+            tp.join()
+            tiles = dict((tile.id, byte_view(tile.qimg).copy()) for tile in tp.getTiles(self.rect))
+            self.assertEqual(self.ds.requests, 1)
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+        # same tiles as read slice by slice
+        single = self._render()
+        self.assertEqual(sorted(tiles), sorted(single))
+        for tile_id in tiles:
+            self.assertTrue(np.all(tiles[tile_id] == single[tile_id]))
+
 if __name__=='__main__':
     ut.main()
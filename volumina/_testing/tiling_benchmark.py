@@ -0,0 +1,330 @@
+'''Headless end-to-end benchmark of the tile rendering pipeline.
+
+Builds a LayerStackModel of synthetic layers, pumps it through
+StackedImageSources into a TileProvider and replays scripted scroll,
+zoom and pan sequences offscreen. For every scenario the time to
+complete the viewport, the layer tile throughput, the cache efficiency
+and the peak memory of the process are reported as JSON:
+
+  python -m volumina._testing.tiling_benchmark --layers labels,delay \\
+                                               --scenario all --output before.json
+
+Run it before and after a change of the scheduler or the caches and
+compare the outputs.
+
+'''
+import sys
+import json
+import time
+import resource
+from optparse import OptionParser
+
+import numpy as np
+from PyQt4.QtCore import QRectF
+
+from volumina.tiling import Tiling, TileProvider
+from volumina.layerstack import LayerStackModel
+from volumina.layer import GrayscaleLayer, ColortableLayer, generateRandomColors
+from volumina.pixelpipeline.datasources import ArraySource, ArrayRequest
+from volumina.pixelpipeline.imagepump import ImagePump
+from volumina.slicingtools import SliceProjection
+
+#*******************************************************************************
+# S y n t h e t i c   s o u r c e s                                            *
+#*******************************************************************************
+
+class DelayedArrayRequest( ArrayRequest ):
+    def __init__( self, array, slicing, delay_factor ):
+        super(DelayedArrayRequest, self).__init__(array, slicing)
+        self._delay_factor = delay_factor
+
+    def wait( self ):
+        if self._result is None:
+            result = super(DelayedArrayRequest, self).wait()
+            time.sleep(self._delay_factor*result.nbytes)
+        return self._result
+
+class DelayedArraySource( ArraySource ):
+    '''An ArraySource that takes delay_factor seconds per requested byte.
+
+    Simulates a slow backend like from_lazyflow.OpDelay does, but
+    without depending on lazyflow.
+
+    '''
+    def __init__( self, array, delay_factor=1e-6 ):
+        super(DelayedArraySource, self).__init__(array)
+        self._delay_factor = delay_factor
+
+    def request( self, slicing ):
+        super(DelayedArraySource, self).request(slicing)  # checks the slicing
+        return DelayedArrayRequest(self._array, slicing, self._delay_factor)
+
+def grayVolume( shape, seed=0 ):
+    '''Random uint8 data of shape (1, x, y, z, 1).'''
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 256, size=(1,) + tuple(shape) + (1,)).astype(np.uint8)
+
+def labelVolume( shape, nlabels=10, nstrokes=200, seed=0 ):
+    '''Sparse label data of shape (1, x, y, z, 1) like labeled3d.py.
+
+    Mostly zero (unlabeled) with nstrokes small boxes of random labels
+    1..nlabels, similar to brush strokes of a user.
+
+    '''
+    rng = np.random.RandomState(seed)
+    a = np.zeros((1,) + tuple(shape) + (1,), dtype=np.uint8)
+    for i in range(nstrokes):
+        start = [rng.randint(0, s) for s in shape]
+        size = [rng.randint(1, max(2, s // 10)) for s in shape[:2]] + [rng.randint(1, 3)]
+        box = tuple(slice(b, b + e) for b, e in zip(start, size))
+        a[(0,) + box + (0,)] = rng.randint(1, nlabels + 1)
+    return a
+
+def makeLayer( kind, shape, delay_factor=1e-6, seed=0 ):
+    '''Create a layer of the given kind: 'array', 'delay' or 'labels'.'''
+    if kind == 'array':
+        layer = GrayscaleLayer(ArraySource(grayVolume(shape, seed)))
+    elif kind == 'delay':
+        layer = GrayscaleLayer(DelayedArraySource(grayVolume(shape, seed), delay_factor))
+    elif kind == 'labels':
+        nlabels = 10
+        np.random.seed(seed)
+        colorTable = generateRandomColors(nlabels + 1, "hsv", {"v": 1.0}, True)
+        layer = ColortableLayer(ArraySource(labelVolume(shape, nlabels, seed=seed)), colorTable)
+    else:
+        raise ValueError("unknown layer kind '%s'" % kind)
+    layer.name = kind
+    return layer
+
+#*******************************************************************************
+# S c e n a r i o s                                                            *
+#*******************************************************************************
+
+# A scenario is a list of steps, each one of
+#   ('scroll', dz)     -- move the slice by dz
+#   ('zoom', factor)   -- multiply the view scale by factor
+#   ('pan', dx, dy)    -- move the viewport by dx, dy device pixels
+# The viewport is rendered completely before and after every step.
+
+def scrollScenario( depth ):
+    '''Scroll through all slices and back again.'''
+    return [('scroll', 1)]*(depth - 1) + [('scroll', -1)]*(depth - 1)
+
+def zoomScenario( levels ):
+    '''Zoom out through all pyramid levels and back in.'''
+    return [('zoom', 0.5)]*(levels - 1) + [('zoom', 2.)]*(levels - 1)
+
+def panScenario( steps, stride=200 ):
+    '''Pan right, down, left and up again.'''
+    return [('pan', stride, 0)]*steps + [('pan', 0, stride)]*steps + \
+           [('pan', -stride, 0)]*steps + [('pan', 0, -stride)]*steps
+
+SCENARIOS = ['scroll', 'zoom', 'pan']
+
+#*******************************************************************************
+# B e n c h m a r k                                                            *
+#*******************************************************************************
+
+class _View( object ):
+    '''Viewport of width x height device pixels centered on (x, y)
+    in scene coordinates, looking at slice z with the given scale.'''
+    def __init__( self, x, y, z, scale, width, height ):
+        self.x, self.y, self.z = x, y, z
+        self.scale = scale
+        self.width, self.height = width, height
+
+    def rectF( self ):
+        w, h = self.width / self.scale, self.height / self.scale
+        return QRectF(self.x - w/2., self.y - h/2., w, h)
+
+    def apply( self, step, shape ):
+        if step[0] == 'scroll':
+            self.z = max(0, min(self.z + step[1], shape[2] - 1))
+        elif step[0] == 'zoom':
+            self.scale *= step[1]
+        elif step[0] == 'pan':
+            self.x += step[1] / self.scale
+            self.y += step[2] / self.scale
+        else:
+            raise ValueError("unknown step '%s'" % step[0])
+
+def peakMemory():
+    '''Peak resident set size of this process in bytes.'''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def renderViewport( tp, rectF, level, timeout=60. ):
+    '''Render rectF completely; returns the time it took and the number
+    of tiles in the viewport.'''
+    start = time.time()
+    while True:
+        tiles = list(tp.getTiles(rectF, level))
+        if tp.viewportRendered(rectF, level):
+            return time.time() - start, len(tiles)
+        if time.time() - start > timeout:
+            raise RuntimeError("viewport not rendered within %g seconds" % timeout)
+        tp.join()
+
+class TilingBenchmark( object ):
+    '''Renders a layer stack offscreen while replaying scenarios.
+
+    shape        -- (x, y, z) shape of the synthetic volumes
+    layers       -- kinds of layers, see makeLayer(); the first one is
+                    at the top of the stack. Grayscale layers are opaque
+                    and hide all layers below them.
+    n_threads    -- render threads of the TileProvider
+    cache_size   -- number of slices cached by the TileProvider
+    cache_bytes  -- byte budget per pyramid level of the caches
+    delay_factor -- seconds per byte of 'delay' layers
+    viewport     -- (width, height) of the viewport in device pixels
+
+    '''
+    def __init__( self, shape=(1024, 1024, 16), layers=('labels', 'array'),
+                  n_threads=2, cache_size=100, cache_bytes=None,
+                  delay_factor=1e-6, viewport=(800, 600), blockSize=256 ):
+        self.shape = tuple(shape)
+        self.layers = list(layers)
+        self.n_threads = n_threads
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.delay_factor = delay_factor
+        self.viewport = tuple(viewport)
+        self.blockSize = blockSize
+
+    def config( self ):
+        return {'shape' : list(self.shape),
+                'layers' : self.layers,
+                'n_threads' : self.n_threads,
+                'cache_size' : self.cache_size,
+                'cache_bytes' : self.cache_bytes,
+                'delay_factor' : self.delay_factor,
+                'viewport' : list(self.viewport),
+                'blockSize' : self.blockSize}
+
+    def steps( self, scenario, tiling ):
+        if scenario == 'scroll':
+            return scrollScenario(self.shape[2])
+        elif scenario == 'zoom':
+            return zoomScenario(tiling.levelCount)
+        elif scenario == 'pan':
+            return panScenario(3)
+        raise ValueError("unknown scenario '%s'" % scenario)
+
+    def run( self, scenario, steps=None ):
+        '''Run a scenario on a freshly created layer stack and
+        TileProvider and return its results as a dict.'''
+        lsm = LayerStackModel()
+        # append() puts a layer on top of the stack
+        for i, kind in reversed(list(enumerate(self.layers))):
+            lsm.append(makeLayer(kind, self.shape, self.delay_factor, seed=i))
+        pump = ImagePump(lsm, SliceProjection())
+        sliceShape = self.shape[:2]
+        tiling = Tiling(sliceShape, blockSize=self.blockSize,
+                        levels=Tiling.pyramidDepth(sliceShape, self.blockSize))
+        tp = TileProvider(tiling, pump.stackedImageSources, cache_size=self.cache_size,
+                          n_threads=self.n_threads, cache_bytes=self.cache_bytes)
+        if steps is None:
+            steps = self.steps(scenario, tiling)
+        try:
+            view = _View(sliceShape[0]/2., sliceShape[1]/2., 0, 1., *self.viewport)
+            tp.metrics()  # start measuring the utilization
+            times = []
+            tiles = 0
+            peakBytes = 0
+            for step in [None] + list(steps):
+                if step is not None:
+                    view.apply(step, self.shape)
+                    if step[0] == 'scroll':
+                        pump.syncedSliceSources.through = [0, view.z, 0]
+                seconds, n = renderViewport(tp, view.rectF(), tiling.levelForScale(view.scale))
+                times.append(seconds)
+                tiles += n
+                peakBytes = max(peakBytes, tp.cacheStats()['bytes'])
+            metrics = tp.metrics()
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+        return self._report(scenario, times, tiles, peakBytes, metrics)
+
+    @staticmethod
+    def _report( scenario, times, tiles, peakBytes, metrics ):
+        total = sum(times)
+        cache = metrics['cache']
+        lookups = cache['hits'] + cache['misses']
+        layerTiles = sum(h['latency'].count for h in metrics['layers'].values())
+        return {'scenario' : scenario,
+                'steps' : len(times),
+                'viewport' : {'total' : total,
+                              'mean' : total / len(times),
+                              'median' : float(np.median(times)),
+                              'max' : max(times),
+                              'times' : times},
+                'tiles' : tiles,
+                'layerTiles' : layerTiles,
+                'tilesPerSecond' : tiles / total if total else 0.,
+                'layerTilesPerSecond' : layerTiles / total if total else 0.,
+                'utilization' : metrics['utilization'],
+                'cache' : {'hits' : cache['hits'],
+                           'misses' : cache['misses'],
+                           'evictions' : cache['evictions'],
+                           'hitRate' : float(cache['hits']) / lookups if lookups else 0.,
+                           'bytes' : cache['bytes'],
+                           'peakBytes' : peakBytes},
+                'layers' : dict((name, {'latencyMean' : h['latency'].mean,
+                                        'latency90' : h['latency'].percentile(0.9),
+                                        'computeMean' : h['compute'].mean,
+                                        'tiles' : h['latency'].count})
+                                for name, h in metrics['layers'].items()),
+                'peakMemory' : peakMemory()}
+
+    def runAll( self, scenarios=SCENARIOS ):
+        '''Run several scenarios; returns the config and their results.'''
+        return {'config' : self.config(),
+                'scenarios' : [self.run(s) for s in scenarios],
+                'peakMemory' : peakMemory()}
+
+#*******************************************************************************
+# i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
+#*******************************************************************************
+
+def main( argv=None ):
+    parser = OptionParser(usage="%prog [options]", description=__doc__.split('\n\n')[0])
+    parser.add_option("--scenario", default="all",
+                      help="one of %s or 'all' [default: %%default]" % ", ".join(SCENARIOS))
+    parser.add_option("--layers", default="labels,array",
+                      help="comma separated layer kinds from top to bottom: "
+                           "array, delay, labels [default: %default]")
+    parser.add_option("--shape", default="1024,1024,16",
+                      help="x,y,z shape of the volumes [default: %default]")
+    parser.add_option("--threads", type="int", default=2,
+                      help="render threads [default: %default]")
+    parser.add_option("--cache-size", type="int", default=100,
+                      help="number of cached slices [default: %default]")
+    parser.add_option("--cache-mb", type="float", default=None,
+                      help="byte budget per pyramid level in MiB [default: unlimited]")
+    parser.add_option("--delay", type="float", default=1e-6,
+                      help="seconds per byte of 'delay' layers [default: %default]")
+    parser.add_option("--viewport", default="800,600",
+                      help="width,height of the viewport [default: %default]")
+    parser.add_option("--output", default=None,
+                      help="write the JSON report to this file instead of stdout")
+    options, args = parser.parse_args(argv)
+
+    scenarios = SCENARIOS if options.scenario == 'all' else [options.scenario]
+    cache_bytes = int(options.cache_mb * 2**20) if options.cache_mb is not None else None
+    benchmark = TilingBenchmark(shape=[int(s) for s in options.shape.split(',')],
+                                layers=options.layers.split(','),
+                                n_threads=options.threads,
+                                cache_size=options.cache_size,
+                                cache_bytes=cache_bytes,
+                                delay_factor=options.delay,
+                                viewport=[int(s) for s in options.viewport.split(',')])
+    report = json.dumps(benchmark.runAll(scenarios), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import copy
+import time
+from collections import deque
+
+from PyQt4.QtCore import QObject, QTimer, pyqtSignal
+
+#*******************************************************************************
+# C i n e P l a y e r                                                          *
+#*******************************************************************************
+
+class CinePlayer(QObject):
+    """
+    Plays through time (or along a spatial axis) at a target frame rate.
+
+    The frames ahead of the playhead are prefetched into the tile caches of
+    the scenes, which serve as a ring buffer of frames. The playhead only
+    advances when all scenes can show the next frame completely. When the
+    achieved frame rate stays below the target, the scenes render at a
+    coarser pyramid level (see ImageScene2D.lodBias); once all buffered
+    frames are ready ahead of time, they go back to finer levels.
+
+    The achieved and the target frame rate are reported by fpsChanged about
+    once a second.
+    """
+    fpsChanged = pyqtSignal(float, float) # achieved, target
+    playingChanged = pyqtSignal(bool)
+
+    WINDOW = 1.0 # seconds over which the frame rate is measured
+
+    def __init__(self, posModel, imageScenes, bufferFrames=8, parent=None):
+        """
+        * posModel -- PositionModel whose position is played
+        * imageScenes -- the ImageScene2Ds showing the position
+        * bufferFrames -- number of frames prefetched ahead of the playhead
+        """
+        QObject.__init__(self, parent)
+        self._posModel = posModel
+        self._scenes = imageScenes
+        self.bufferFrames = bufferFrames
+
+        self._axis = 0
+        self._fps = 10.
+        self._achievedFps = 0.
+        self._lodBias = 0
+        self._shown = deque() # times at which frames were shown
+        self._lastAdapt = None
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._tick)
+
+    @property
+    def isPlaying(self):
+        return self._timer.isActive()
+
+    @property
+    def targetFps(self):
+        return self._fps
+
+    @property
+    def achievedFps(self):
+        return self._achievedFps
+
+    @property
+    def lodBias(self):
+        return self._lodBias
+
+    def play(self, axis=0, fps=10.):
+        """
+        Start playing.
+
+        * axis -- index into PositionModel.slicingPos5D: 0 plays through time,
+                  1, 2 and 3 along x, y and z
+        * fps -- target frame rate
+        """
+        assert 0 <= axis <= 3
+        self._axis = axis
+        self._fps = float(fps)
+        self._achievedFps = 0.
+        self._shown.clear()
+        self._lastAdapt = None
+        self._timer.start(max(1, int(round(1000. / self._fps))))
+        self._prefetch()
+        self.playingChanged.emit(True)
+
+    def stop(self):
+        if not self.isPlaying:
+            return
+        self._timer.stop()
+        self._setLodBias(0)
+        self.playingChanged.emit(False)
+
+    def _frameCount(self):
+        return self._posModel.shape5D[self._axis]
+
+    def _position(self, offset):
+        """5d position offset frames ahead of the playhead; wraps around."""
+        pos = list(self._posModel.slicingPos5D)
+        pos[self._axis] = (pos[self._axis] + offset) % self._frameCount()
+        return pos
+
+    def _setPlayhead(self, frame):
+        if self._axis == 0:
+            self._posModel.time = frame
+        else:
+            pos = copy.copy(self._posModel.slicingPos)
+            pos[self._axis - 1] = frame
+            self._posModel.slicingPos = pos
+
+    def _bufferPositions(self):
+        n = min(self.bufferFrames, self._frameCount() - 1)
+        return [self._position(offset) for offset in xrange(1, n + 1)]
+
+    def _prefetch(self):
+        if self._frameCount() < 2:
+            return
+        # prefetchFrames() renders the frames in the given order, so the
+        # nearest ones come first, even when playback wraps around
+        positions = self._bufferPositions()
+        for scene in self._scenes:
+            scene.prefetchFrames(positions)
+
+    def _setLodBias(self, bias):
+        self._lodBias = bias
+        for scene in self._scenes:
+            scene.lodBias = min(bias, scene.levelCount - 1)
+
+    def _tick(self, now=None):
+        now = time.time() if now is None else now
+        if self._frameCount() < 2:
+            self.stop()
+            return
+        if self._lastAdapt is None:
+            self._lastAdapt = now
+
+        nextPos = self._position(1)
+        if all(scene.frameReady(nextPos) for scene in self._scenes):
+            self._setPlayhead(nextPos[self._axis])
+            self._shown.append(now)
+        self._prefetch()
+        self._adapt(now)
+
+    def _adapt(self, now):
+        """Measure the frame rate and adjust the level of detail."""
+        while self._shown and now - self._shown[0] >= self.WINDOW:
+            self._shown.popleft()
+        if now - self._lastAdapt < self.WINDOW:
+            return
+        self._lastAdapt = now
+        self._achievedFps = len(self._shown) / self.WINDOW
+        self.fpsChanged.emit(self._achievedFps, self._fps)
+
+        maxBias = max(scene.levelCount for scene in self._scenes) - 1
+        if self._achievedFps < 0.9 * self._fps:
+            if self._lodBias < maxBias:
+                self._setLodBias(self._lodBias + 1)
+        elif self._lodBias > 0:
+            if all(scene.frameReady(pos) for pos in self._bufferPositions()
+                                         for scene in self._scenes):
+                self._setLodBias(self._lodBias - 1)
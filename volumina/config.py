@@ -4,6 +4,24 @@ import io, os
 default_config = """
 [pixelpipeline]
 verbose: false
+# number of worker processes that convert arrays to images;
+# 0 converts in the render threads
+conversion_processes: 0
+
+[tiling]
+# byte budget of the tile cache of each 2D view in MiB
+cache_size_mb: 512
+# byte budget in MiB of the layer tiles shared by all 2D views of
+# the same data (see tiling.LayerTileRegistry); 0 disables sharing
+shared_tiles_mb: 256
+# number of threads rendering the layer tiles of all 2D views;
+# 0 chooses it from the number of cores
+render_threads: 0
+
+[diskcache]
+# persistent cache of the data sources wrapped in a DiskCacheSource
+directory: ~/.volumina/diskcache
+size_mb: 2048
 """
 
 cfg = ConfigParser.SafeConfigParser()
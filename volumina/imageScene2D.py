@@ -1,15 +1,123 @@
 import numpy, math
 
-from PyQt4.QtCore import QRect, QRectF, QPointF, Qt, QSizeF, QLineF, QObject, pyqtSignal, SIGNAL
+from PyQt4.QtCore import QRect, QRectF, QPointF, Qt, QSizeF, QLineF, QObject, pyqtSignal, SIGNAL, QTimer
 from PyQt4.QtGui import QGraphicsScene, QTransform, QPen, QColor, QBrush, QPolygonF, QPainter, QGraphicsItem, \
                         QGraphicsItemGroup, QGraphicsLineItem, QGraphicsTextItem, QGraphicsPolygonItem, \
                         QGraphicsRectItem
 
-from volumina.tiling import Tiling, TileProvider, TiledImageLayer
+from volumina.tiling import Tiling, TileProvider, TiledImageLayer, renderExecutor
+from volumina.renderMetrics import formatMetrics
 from volumina.layerstack import LayerStackModel
 from volumina.pixelpipeline.imagepump import StackedImageSources
+from volumina.config import cfg
 
 import datetime
+import time
+
+#*******************************************************************************
+# S c r o l l V e l o c i t y                                                  *
+#*******************************************************************************
+class ScrollVelocity(object):
+    """
+    Smoothed speed of scrolling through slices, in slices per second.
+
+    Steps along another axis than the previous ones or after a pause longer
+    than timeout seconds start a new measurement. The speed drops to zero
+    when no step arrives for timeout seconds.
+    """
+    def __init__(self, halfLife=0.25, timeout=0.5):
+        self.halfLife = halfLife
+        self.timeout = timeout
+        self._axis = None
+        self._last = None
+        self._speed = 0.
+
+    def step(self, axis, delta, now=None):
+        now = time.time() if now is None else now
+        if axis != self._axis or self._last is None or now - self._last > self.timeout:
+            self._speed = abs(delta) / self.timeout
+        else:
+            dt = max(now - self._last, 1e-3)
+            w = 0.5 ** (dt / self.halfLife)
+            self._speed = w * self._speed + (1 - w) * abs(delta) / dt
+        self._axis = axis
+        self._last = now
+
+    def speed(self, now=None):
+        now = time.time() if now is None else now
+        if self._last is None or now - self._last > self.timeout:
+            return 0.
+        return self._speed
+
+def prefetchDepth(speed, cost, maximum, horizon=1.0):
+    """
+    Number of slices to prefetch ahead of the current one.
+
+    * speed -- scrolling speed in slices per second
+    * cost -- seconds needed to render one slice (0 if unknown)
+    * maximum -- upper bound of the depth
+
+    Prefetch enough slices to stay horizon seconds ahead of the user, but
+    no more than the render threads can finish in that time. Nothing is
+    prefetched while not scrolling.
+    """
+    if speed <= 0 or maximum <= 0:
+        return 0
+    depth = int(math.ceil(speed * horizon))
+    if cost > 0:
+        depth = min(depth, max(1, int(horizon / cost)))
+    return max(1, min(depth, maximum))
+
+#*******************************************************************************
+# P a n V e l o c i t y                                                        *
+#*******************************************************************************
+class PanVelocity(object):
+    """
+    Smoothed velocity of the viewport in scene pixels per second.
+
+    The velocity drops to zero when the viewport did not move for timeout
+    seconds.
+    """
+    def __init__(self, halfLife=0.1, timeout=0.2):
+        self.halfLife = halfLife
+        self.timeout = timeout
+        self._last = None
+        self._velocity = (0., 0.)
+
+    def step(self, dx, dy, now=None):
+        now = time.time() if now is None else now
+        if self._last is None or now - self._last > self.timeout:
+            self._velocity = (dx / self.timeout, dy / self.timeout)
+        else:
+            dt = max(now - self._last, 1e-3)
+            w = 0.5 ** (dt / self.halfLife)
+            vx, vy = self._velocity
+            self._velocity = (w * vx + (1 - w) * dx / dt, w * vy + (1 - w) * dy / dt)
+        self._last = now
+
+    def velocity(self, now=None):
+        now = time.time() if now is None else now
+        if self._last is None or now - self._last > self.timeout:
+            return (0., 0.)
+        return self._velocity
+
+def panAheadRect(viewRect, velocity, margin, horizon=0.5):
+    """
+    Rect the viewport moving with velocity (scene pixels per second) will
+    show in horizon seconds, or None if it does not move.
+
+    The viewport is moved at least margin (e.g. a tile) and at most its own
+    size ahead.
+    """
+    def ahead(v, size):
+        if v == 0:
+            return 0.
+        d = max(abs(v) * horizon, margin)
+        return math.copysign(min(d, size), v)
+    vx, vy = velocity
+    if vx == 0 and vy == 0:
+        return None
+    return viewRect.translated(ahead(vx, viewRect.width()), ahead(vy, viewRect.height()))
 
 #*******************************************************************************
 # D i r t y I n d i c a t o r                                                  *
@@ -23,9 +131,20 @@ class DirtyIndicator(QGraphicsItem):
     """
     def __init__(self, tiling):
         QGraphicsItem.__init__(self, parent=None)
+        self._tiling = None
+        self.setTiling(tiling)
+
+    def setTiling(self, tiling):
+        """
+        Switch to the tiling whose tiles are reported, e.g. when the
+        displayed level of the resolution pyramid changes.
+        """
+        if tiling is self._tiling:
+            return
         self._tiling = tiling
         self._indicate = numpy.zeros(len(tiling))
         self._zeroProgressTimestamp = [None] * len(tiling)
+        self.update()
 
     def boundingRect(self):
         return self._tiling.boundingRectF()
@@ -74,6 +193,11 @@ class ImageScene2D(QGraphicsScene):
     """
     axesChanged = pyqtSignal(int, bool)
 
+    # incomplete tiles are previewed from a pyramid level this many
+    # levels coarser (i.e. with 4**previewLevels times fewer pixels);
+    # 0 turns previews off
+    previewLevels = 2
+
     @property
     def stackedImageSources(self):
         return self._stackedImageSources
@@ -91,6 +215,20 @@ class ImageScene2D(QGraphicsScene):
         self._showTileOutlines = show
         self.invalidate()
 
+    @property
+    def showMetrics(self):
+        """Overlay each view with live metrics of the tile rendering."""
+        return self._showMetrics
+    @showMetrics.setter
+    def showMetrics(self, show):
+        self._showMetrics = show
+        if show:
+            self._updateMetrics()
+            self._metricsTimer.start()
+        else:
+            self._metricsTimer.stop()
+            self._invalidateForeground()
+
     @property
     def showTileProgress(self):
         return self._showTileProgress
@@ -176,7 +314,7 @@ class ImageScene2D(QGraphicsScene):
         self.scene2data, isInvertible = self.data2scene.inverted()
         self._setSceneRect()
         self._tiling.data2scene = self.data2scene
-        self._tileProvider._onSizeChanged()
+        self._tileProvider.axesChanged()
         QGraphicsScene.invalidate(self, self.sceneRect())
 
     @property
@@ -211,13 +349,26 @@ class ImageScene2D(QGraphicsScene):
 
     def setCacheSize(self, cache_size):
         if cache_size != self._tileProvider._cache_size:
-            self._tileProvider = TileProvider(self._tiling, self._stackedImageSources, cache_size=cache_size)
-            self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+            self._tileProvider.notifyThreadsToStop()
+            self._tileProvider = self._createTileProvider(cache_size)
+
+    def _createTileProvider(self, cache_size=100):
+        cache_bytes = cfg.getint('tiling', 'cache_size_mb') * 2**20
+        # all views share the render threads
+        tileProvider = TileProvider(self._tiling, self._stackedImageSources,
+                                    cache_size=cache_size,
+                                    cache_bytes=cache_bytes,
+                                    executor=renderExecutor(),
+                                    owner=self)
+        tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+        return tileProvider
 
     def cacheSize(self):
         return self._tileProvider._cache_size
 
     def setPreemptiveFetchNumber(self, n):
+        """Maximal number of prefetched slices; the actual number follows
+        the scrolling speed and the rendering costs."""
         if n > self.cacheSize() - 1:
             self._n_preemptive = self.cacheSize() - 1
         else:
@@ -225,6 +376,43 @@ class ImageScene2D(QGraphicsScene):
     def preemptiveFetchNumber(self):
         return self._n_preemptive
 
+    @property
+    def lodBias(self):
+        """Number of pyramid levels rendered coarser than the view scale
+        requires, e.g. to keep up with cine playback."""
+        return self._lodBias
+    @lodBias.setter
+    def lodBias(self, bias):
+        if bias != self._lodBias:
+            self._lodBias = bias
+            self.invalidateViewports(QRectF())
+
+    @property
+    def levelCount(self):
+        return self._tiling.levelCount
+
+    def _through(self, pos5d):
+        return tuple(pos5d[self._along[i]] for i in xrange(3))
+
+    def prefetchFrames(self, positions5d):
+        """Prefetch the viewport as shown at the 5d positions, nearest first."""
+        if self._tileProvider is not None:
+            throughs = [self._through(pos5d) for pos5d in positions5d]
+            self._frameThroughs.update(throughs)
+            self._tileProvider.prefetchSlices(self._viewportRect(), throughs, self._level)
+
+    def frameReady(self, pos5d):
+        """Whether the viewport can be shown completely at the 5d position
+        pos5d without waiting for rendering. Scenes without a visible view
+        are always ready."""
+        if self._tileProvider is None or not any(v.isVisible() for v in self.views()):
+            return True
+        return self._tileProvider.prefetched(self._viewportRect(), self._through(pos5d), self._level)
+
+    def takeRenderFocus(self):
+        """Render the tiles of this scene before those of other scenes."""
+        renderExecutor().setFocus(self)
+
     def invalidateViewports(self, sceneRectF):
         '''Call invalidate on the intersection of all observing viewport-rects and rectF.'''
         sceneRectF = sceneRectF if sceneRectF.isValid() else self.sceneRect()
@@ -238,13 +426,13 @@ class ImageScene2D(QGraphicsScene):
         """
         self.resetAxes(finish=False)
 
-        self._tiling = Tiling(self._dataShape, self.data2scene, name=self.name)
+        self._tiling = Tiling(self._dataShape, self.data2scene, name=self.name,
+                              levels=Tiling.pyramidDepth(self._dataShape))
         self._brushingLayer  = TiledImageLayer(self._tiling)
 
         if self._tileProvider:
             self._tileProvider.notifyThreadsToStop() # prevent ref cycle
-        self._tileProvider = TileProvider(self._tiling, self._stackedImageSources)
-        self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+        self._tileProvider = self._createTileProvider()
 
         if self._dirtyIndicator:
             self.removeItem(self._dirtyIndicator)
@@ -253,11 +441,11 @@ class ImageScene2D(QGraphicsScene):
         self.addItem(self._dirtyIndicator)
 
 
-    def __init__(self, posModel, along, preemptive_fetch_number=5,
+    def __init__(self, posModel, along, preemptive_fetch_number=16,
                  parent=None, name="Unnamed Scene",
                  swapped_default=False):
         """
-        * preemptive_fetch_number -- number of prefetched slices; 0 turns the feature off
+        * preemptive_fetch_number -- maximal number of prefetched slices; 0 turns the feature off
         * swapped_default -- whether axes should be swapped by default.
 
         """
@@ -274,9 +462,17 @@ class ImageScene2D(QGraphicsScene):
         self._stackedImageSources = StackedImageSources(LayerStackModel())
         self._showTileOutlines = False
         self._showTileProgress = True
+        self._showMetrics = False
+        self._metricsLines = []
+        self._metricsTimer = QTimer(self)
+        self._metricsTimer.setInterval(500)
+        self._metricsTimer.timeout.connect(self._updateMetrics)
 
         self._tileProvider = None
         self._dirtyIndicator = None
+        self._lodBias = 0
+        self._level = 0
+        self._mouseScenePos = None
 
         self._swappedDefault = swapped_default
         self.reset()
@@ -284,13 +480,24 @@ class ImageScene2D(QGraphicsScene):
         # BowWave preemptive caching
         self.setPreemptiveFetchNumber(preemptive_fetch_number)
         self._course = (1,1) # (along, pos or neg direction)
+        self._velocity = ScrollVelocity()
+        self._panVelocity = PanVelocity()
+        self._slicingSettled = True
+        self._frameThroughs = set() # slices prefetched by prefetchFrames() since the last settling
         self._time = self._posModel.time
         self._channel = self._posModel.channel
         self._posModel.timeChanged.connect(self._onTimeChanged)
         self._posModel.channelChanged.connect(self._onChannelChanged)
         self._posModel.slicingPositionChanged.connect(self._onSlicingPositionChanged)
+        self._posModel.slicingPositionSettled.connect(self._onSlicingPositionSettled)
 
     def __del__(self):
+        self.stopRendering()
+
+    def stopRendering(self):
+        """Stop the tile provider and release it from the shared render
+        threads. Call this when the scene is closed; the render threads
+        must not depend on the garbage collector to let go of it."""
         if self._tileProvider:
             self._tileProvider.notifyThreadsToStop()
 
@@ -298,6 +505,9 @@ class ImageScene2D(QGraphicsScene):
         self._brushingLayer  = TiledImageLayer(self._tiling)
 
     def drawForeground(self, painter, rect):
+        if self._showMetrics:
+            self._drawMetrics(painter)
+
         if self._tiling is None:
             return
 
@@ -327,6 +537,33 @@ class ImageScene2D(QGraphicsScene):
                 painter.setPen(pen)
                 painter.drawRect(self._tiling.imageRects[tileId])
 
+    def _updateMetrics(self):
+        if self._tileProvider is not None:
+            self._metricsLines = formatMetrics(self._tileProvider.metrics())
+            self._invalidateForeground()
+
+    def _invalidateForeground(self):
+        for view in self.views():
+            QGraphicsScene.invalidate(self, view.viewportRect(), QGraphicsScene.ForegroundLayer)
+
+    def _drawMetrics(self, painter):
+        """Draw the metrics in the top left corner of the view."""
+        if not self._metricsLines:
+            return
+        painter.save()
+        painter.resetTransform()
+        fm = painter.fontMetrics()
+        lineHeight = fm.height()
+        width = max(fm.width(line) for line in self._metricsLines)
+        painter.setOpacity(0.6)
+        painter.fillRect(QRectF(5, 5, width + 10, lineHeight * len(self._metricsLines) + 10),
+                         QColor(0, 0, 0))
+        painter.setOpacity(1.0)
+        painter.setPen(QColor(Qt.white))
+        for i, line in enumerate(self._metricsLines):
+            painter.drawText(QPointF(10, 10 + fm.ascent() + i * lineHeight), line)
+        painter.restore()
+
     def indicateSlicingPositionSettled(self, settled):
         if self._showTileProgress:
             self._dirtyIndicator.setVisible(settled)
@@ -338,17 +575,81 @@ class ImageScene2D(QGraphicsScene):
         if self._tileProvider is None:
             return
 
-        tiles = self._tileProvider.getTiles(sceneRectF)
+        # render at the coarsest pyramid level that still provides
+        # the resolution of the viewport
+        level = self._tiling.levelForScale(self._viewScale(painter))
+        level = min(level + self._lodBias, self._tiling.levelCount - 1)
+        self._level = level
+        if self._showTileProgress:
+            self._dirtyIndicator.setTiling(self._tiling.level(level))
+
+        self._updatePriorityCenter()
+        tiles = list(self._tileProvider.getTiles(sceneRectF, level))
+
+        # progressive rendering: until all layers of a tile are done,
+        # its preview from a coarser pyramid level shows through. The
+        # preview tiles are few and cheap and are served first (their
+        # distances to the priority center count in bigger tiles).
+        if any(tile.progress < 1.0 for tile in tiles):
+            preview = min(level + self.previewLevels, self._tiling.levelCount - 1)
+            if preview > level:
+                for tile in self._tileProvider.getTiles(sceneRectF, preview):
+                    if not tile.progress < 1.0:
+                        painter.drawImage(tile.rectF, tile.qimg)
+
         for tile in tiles:
             # prevent flickering
             if not tile.progress < 1.0:
                 painter.drawImage(tile.rectF, tile.qimg)
             if self._showTileProgress:
                 self._dirtyIndicator.setTileProgress(tile.id, tile.progress)
+        self._tileProvider.viewportRendered(self._viewportRect(), level)
+
+        # prefetch the tiles the viewport is panned towards
+        tiling = self._tiling.level(level)
+        ahead = panAheadRect(self._viewportRect(), self._panVelocity.velocity(),
+                             tiling.blockSize * tiling.downsample)
+        if ahead is not None:
+            self._tileProvider.prefetch(ahead, None, level)
 
         # preemptive fetching
-        for through in self._bowWave(self._n_preemptive):
-            self._tileProvider.prefetch(sceneRectF, through)
+        throughs = self._bowWave(self._prefetchDepth(sceneRectF, level))
+        if throughs:
+            self._tileProvider.prefetchSlices(sceneRectF, throughs, level)
+
+    def _prefetchDepth(self, sceneRectF, level):
+        if self._slicingSettled and self._course[0] == 1:
+            return 0
+        cost = self._tileProvider.estimatedRenderTime(sceneRectF, level)
+        return prefetchDepth(self._velocity.speed(), cost, self._n_preemptive)
+
+    def panned(self, dx, dy):
+        """The viewport moved by (dx, dy) scene pixels."""
+        self._panVelocity.step(dx, dy)
+
+    def setMousePos(self, dataPos):
+        """Tiles under the mouse are rendered first."""
+        self._mouseScenePos = self.data2scene.map(QPointF(dataPos))
+        self._updatePriorityCenter()
+
+    def _updatePriorityCenter(self):
+        if self._tileProvider is None:
+            return
+        viewRect = self._viewportRect()
+        if self._mouseScenePos is not None and viewRect.contains(self._mouseScenePos):
+            center = self._mouseScenePos
+        else:
+            center = viewRect.center()
+        self._tileProvider.setPriorityCenter(center)
+
+    def _viewportRect(self):
+        views = self.views()
+        return views[0].viewportRect() if views else self.sceneRect()
+
+    def _viewScale(self, painter):
+        """Number of device pixels per scene pixel."""
+        t = painter.transform()
+        return math.sqrt(abs(t.m11()*t.m22() - t.m12()*t.m21()))
 
     def joinRendering(self):
         return self._tileProvider.join()
@@ -371,16 +672,30 @@ class ImageScene2D(QGraphicsScene):
         return BowWave
 
     def _onSlicingPositionChanged(self, new, old):
-        if (new[self._along[1] - 1] - old[self._along[1] - 1]) < 0:
+        delta = new[self._along[1] - 1] - old[self._along[1] - 1]
+        if delta < 0:
             self._course = (1, -1)
         else:
             self._course = (1, 1)
+        if delta != 0:
+            self._velocity.step(1, delta)
+
+    def _onSlicingPositionSettled(self, settled):
+        self._slicingSettled = settled
+        if settled and self._tileProvider is not None:
+            # the user stopped scrolling; don't burn cpu on slices
+            # that are probably never shown. Frames prefetched for cine
+            # playback are shown soon, since playback settles the
+            # position after every frame.
+            self._tileProvider.cancelPrefetch(keep=self._frameThroughs)
+            self._frameThroughs = set()
 
     def _onChannelChanged(self, new):
         if (new - self._channel) < 0:
             self._course = (2, -1)
         else:
             self._course = (2, 1)
+        self._velocity.step(2, new - self._channel)
         self._channel = new
 
     def _onTimeChanged(self, new):
@@ -388,4 +703,5 @@ class ImageScene2D(QGraphicsScene):
             self._course = (0, -1)
         else:
             self._course = (0, 1)
+        self._velocity.step(0, new - self._time)
         self._time = new
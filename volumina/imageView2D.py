@@ -33,6 +33,19 @@ class ImageView2D(QGraphicsView):
         self._crossHairCursor.dataShape = s
         self._sliceIntersectionMarker.dataShape = s
 
+    @property
+    def mousePos(self):
+        """
+        Last known mouse position in data coordinates.
+        The scene renders the tiles under the mouse first.
+        """
+        return self._mousePos
+
+    @mousePos.setter
+    def mousePos(self, pos):
+        self._mousePos = pos
+        self.scene().setMousePos(pos)
+
     @property
     def hud(self):
         return self._hud
@@ -155,6 +168,7 @@ class ImageView2D(QGraphicsView):
         return self.mapScene2Data(self.mapToScene(pos))
 
     def _panning(self):
+        origin = self.mapToScene(QPoint(0, 0))
         hBar = self.horizontalScrollBar()
         vBar = self.verticalScrollBar()
         vBar.setValue(vBar.value() - self._deltaPan.y())
@@ -162,6 +176,9 @@ class ImageView2D(QGraphicsView):
             hBar.setValue(hBar.value() + self._deltaPan.x())
         else:
             hBar.setValue(hBar.value() - self._deltaPan.x())
+        # lets the scene prefetch the tiles ahead of the viewport
+        moved = self.mapToScene(QPoint(0, 0)) - origin
+        self.scene().panned(moved.x(), moved.y())
 
     def _deaccelerate(self, speed, a=1, maxVal=64):
         x = self._qBound(-maxVal, speed.x(), maxVal)
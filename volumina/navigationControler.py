@@ -262,6 +262,7 @@ class NavigationControler(QObject):
         self._endStackIndex   = 1
         self._view3d = view3d
         self._navigationEnabled = True
+        self.cinePlayer = None # set by the VolumeEditor
 
         self.axisColors = [QColor(255,0,0,255), QColor(0,255,0,255), QColor(0,0,255,255)]
 
@@ -313,9 +314,29 @@ class NavigationControler(QObject):
         for i in range(3):
             self._sliceSources[i].setThrough(0, newTime)
 
+    def togglePlayback(self, axis=0, fps=10.):
+        """
+        Start or stop cine playback.
+
+        axis -- 0 plays through time, 1, 2 and 3 along x, y and z
+        fps  -- target frame rate
+        """
+        if self.cinePlayer is None:
+            return
+        if self.cinePlayer.isPlaying:
+            self.cinePlayer.stop()
+        else:
+            self.cinePlayer.play(axis, fps)
+
+    def stopPlayback(self):
+        if self.cinePlayer is not None:
+            self.cinePlayer.stop()
+
     def changeTimeRelative( self, delta ):
         if self._model.shape5D is None or delta == 0:
             return
+        # stepping by hand ends the playback
+        self.stopPlayback()
         cur_t = self._sliceSources[0].through[0]
         new_t = cur_t + delta
 
@@ -342,6 +363,7 @@ class NavigationControler(QObject):
 
         if delta == 0:
             return
+        self.stopPlayback()
         newSlice = self._model.slicingPos[axis] + delta
         if newSlice < 0 or newSlice >= self._model.volumeExtent(axis):
             return
@@ -75,6 +75,13 @@ class PatchAccessor():
         sy = int(numpy.floor(1.0 * starty / self._blockSize))
         ey = int(numpy.ceil(1.0 * endy / self._blockSize))
 
+        # the last patch along an axis may absorb a small remainder
+        # of the shape
+        if startx < self.size_x:
+            sx = min(sx, self._cX - 1)
+        if starty < self.size_y:
+            sy = min(sy, self._cY - 1)
+
         # Clip to rect bounds
         sx = max(sx, 0)
         sy = max(sy, 0)
@@ -0,0 +1,257 @@
+'''Conversion of arrays to ARGB32 images in worker processes.
+
+Converting the arrays of the data sources to images is CPU bound
+NumPy work that holds the GIL most of the time, so the render threads
+of a TileProvider hardly run in parallel. A ConversionPool moves the
+conversion to worker processes: the arrays are copied to a shared memory
+buffer, a worker writes the ARGB32 pixels to a second shared buffer and
+only the final pixels are copied into a QImage in this process. While
+waiting for the worker, the calling thread does not hold the GIL.
+
+The kernels reproduce the conversions done in the image requests of
+volumina.pixelpipeline.imagesources with qimage2ndarray.
+
+'''
+import atexit
+import threading
+import traceback
+import Queue
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from PyQt4.QtGui import QImage
+from qimage2ndarray import raw_view
+
+from volumina.config import cfg
+
+#*******************************************************************************
+# K e r n e l s                                                                *
+#*******************************************************************************
+
+def _normalize255( a, normalize ):
+    '''Scale and clip to 0..255 like qimage2ndarray does.'''
+    if normalize:
+        if normalize is True:
+            normalize = a.min(), a.max()
+        elif np.isscalar(normalize):
+            normalize = (0, normalize)
+        nmin, nmax = normalize
+        if nmin:
+            a = a - nmin
+        if nmax != nmin:
+            scale = 255. / (nmax - nmin)
+            if scale != 1.0:
+                a = a * scale
+    return np.clip(a, 0, 255).astype(np.uint32)
+
+def _premultiply( c, alpha ):
+    '''Exactly what Qt does when converting to ARGB32_Premultiplied.'''
+    t = c * alpha
+    return (t + (t >> 8) + 0x80) >> 8
+
+def _pack( out, r, g, b, alpha, premultiply ):
+    if premultiply:
+        r, g, b = [_premultiply(c, alpha) for c in (r, g, b)]
+    out[:] = alpha << 24
+    out |= r << 16
+    out |= g << 8
+    out |= b
+
+def grayscaleKernel( arrays, normalize, out ):
+    v = _normalize255(arrays[0], normalize)
+    out[:] = v << 16
+    out |= v << 8
+    out |= v
+    out |= 0xff000000
+
+def alphaModulatedKernel( arrays, params, out ):
+    tint, normalize = params
+    a = arrays[0]
+    channels = [(a * f).astype(np.float32) for f in tint] + [a.astype(np.float32)]
+    if normalize is True:
+        # the channels are normalized together
+        normalize = min(c.min() for c in channels), max(c.max() for c in channels)
+    _pack(out, *[_normalize255(c, normalize) for c in channels], premultiply=True)
+
+def colortableKernel( arrays, params, out ):
+    a, colorTable = arrays
+    rgba = colorTable[np.remainder(a, len(colorTable))].astype(np.uint32)
+    _pack(out, rgba[...,0], rgba[...,1], rgba[...,2], rgba[...,3], premultiply=False)
+
+def rgbaKernel( arrays, normalize, out ):
+    channels = []
+    for a, n in zip(arrays, normalize):
+        if n is not None:
+            a = a.astype(np.float32)
+            a = (a - n[0])*255.0 / (n[1]-n[0])
+            a = np.clip(a, 0, 255)
+        channels.append(a.astype(np.uint8).astype(np.uint32))
+    _pack(out, *channels, premultiply=True)
+
+# kernel name -> (kernel, format of the resulting image)
+KERNELS = { 'grayscale':      (grayscaleKernel, QImage.Format_ARGB32_Premultiplied),
+            'alphamodulated': (alphaModulatedKernel, QImage.Format_ARGB32_Premultiplied),
+            'colortable':     (colortableKernel, QImage.Format_ARGB32),
+            'rgba':           (rgbaKernel, QImage.Format_ARGB32_Premultiplied) }
+
+#*******************************************************************************
+# C o n v e r s i o n P o o l                                                  *
+#*******************************************************************************
+
+_ALIGN = 64
+
+def _view( buf, offset, dtype, shape ):
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    return buf[offset:offset + count*dtype.itemsize].view(dtype).reshape(shape)
+
+def _serve( conn, inBuffer, outBuffer ):
+    '''Main loop of a worker process.'''
+    inBytes = np.frombuffer(inBuffer, dtype=np.uint8)
+    outBytes = np.frombuffer(outBuffer, dtype=np.uint8)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        if msg is None:
+            return
+        kernel, layout, params, shape = msg
+        try:
+            arrays = [_view(inBytes, offset, dtype, s) for offset, dtype, s in layout]
+            KERNELS[kernel][0](arrays, params, _view(outBytes, 0, np.uint32, shape))
+            conn.send(None)
+        except Exception:
+            conn.send(traceback.format_exc())
+
+class _Worker( object ):
+    def __init__( self, bufferBytes ):
+        self.bufferBytes = bufferBytes
+        self._inBuffer = RawArray('B', bufferBytes)
+        self._outBuffer = RawArray('B', bufferBytes)
+        self.inBytes = np.frombuffer(self._inBuffer, dtype=np.uint8)
+        self.outBytes = np.frombuffer(self._outBuffer, dtype=np.uint8)
+        self.conn, childConn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(childConn, self._inBuffer, self._outBuffer))
+        self.process.daemon = True
+        self.process.start()
+        childConn.close()
+
+    def stop( self ):
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.process.join(1.)
+        if self.process.is_alive():
+            self.process.terminate()
+
+class ConversionPool( object ):
+    '''Converts arrays to ARGB32 images in worker processes.
+
+    Every worker process owns an input and an output buffer of
+    bufferBytes bytes in shared memory. toImage() blocks the calling
+    thread until a worker is free and the conversion is done. Several
+    threads may call toImage() at the same time; up to processes
+    conversions run in parallel.
+
+    '''
+    def __init__( self, processes, bufferBytes=2**22 ):
+        assert processes > 0
+        self.bufferBytes = bufferBytes
+        self._workers = [_Worker(bufferBytes) for i in range(processes)]
+        self._idle = Queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def __len__( self ):
+        return len(self._workers)
+
+    def toImage( self, kernel, arrays, params=None ):
+        '''Convert arrays to a QImage with the given kernel.
+
+        kernel -- a key of KERNELS
+        arrays -- list of arrays, the first one determines the shape
+                  of the image
+        params -- picklable parameters passed on to the kernel
+
+        Returns None if the arrays or the image do not fit into the
+        shared buffers or if the worker died; the caller has to
+        convert by itself then.
+
+        '''
+        shape = arrays[0].shape[:2]
+        layout = []
+        offset = 0
+        for a in arrays:
+            layout.append((offset, a.dtype.str, a.shape))
+            offset += -(-a.nbytes // _ALIGN) * _ALIGN
+        if offset > self.bufferBytes or 4*shape[0]*shape[1] > self.bufferBytes:
+            return None
+
+        worker = self._idle.get()
+        try:
+            for a, (o, dtype, s) in zip(arrays, layout):
+                _view(worker.inBytes, o, dtype, s)[...] = a
+            worker.conn.send((kernel, layout, params, shape))
+            error = worker.conn.recv()
+        except (EOFError, IOError):
+            # the worker process died; replace it
+            self._replace(worker)
+            return None
+        except:
+            self._idle.put(worker)
+            raise
+        try:
+            if error is not None:
+                raise RuntimeError("ConversionPool: kernel '%s' failed:\n%s" % (kernel, error))
+            # copy the result before the worker may be reused
+            img = QImage(shape[1], shape[0], KERNELS[kernel][1])
+            raw_view(img)[:] = _view(worker.outBytes, 0, np.uint32, shape)
+            return img
+        finally:
+            self._idle.put(worker)
+
+    def _replace( self, worker ):
+        worker.stop()
+        new = _Worker(self.bufferBytes)
+        self._workers[self._workers.index(worker)] = new
+        self._idle.put(new)
+
+    def close( self ):
+        '''Stop all worker processes.'''
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+
+_pool = None
+_poolLock = threading.Lock()
+
+def conversionPool():
+    '''Return the ConversionPool shared by all image requests.
+
+    The pool is started on first use with as many processes as
+    configured by the 'conversion_processes' option of the
+    'pixelpipeline' section. Returns None if that option is 0,
+    i.e. images are converted in the render threads.
+
+    '''
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            processes = cfg.getint('pixelpipeline', 'conversion_processes')
+            if processes > 0:
+                _pool = ConversionPool(processes)
+                atexit.register(_pool.close)
+            else:
+                _pool = False
+        return _pool or None
+
+def convertInPool( kernel, arrays, params=None ):
+    '''Convert with the shared pool; returns None if that is not possible.'''
+    pool = conversionPool()
+    if pool is None:
+        return None
+    return pool.toImage(kernel, arrays, params)
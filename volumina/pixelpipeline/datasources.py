@@ -3,8 +3,10 @@ from functools import partial
 from PyQt4.QtCore import QObject, pyqtSignal
 from asyncabcs import RequestABC, SourceABC
 import volumina
-from volumina.slicingtools import is_pure_slicing, slicing2shape, is_bounded, index2slice, sl
+from volumina.slicingtools import is_pure_slicing, slicing2shape, is_bounded, index2slice, sl, \
+                                 is_strided, unstrided
 from volumina.config import cfg
+from volumina.pixelpipeline import diskcache
 import numpy as np
 
 import volumina.adaptors
@@ -38,6 +40,9 @@ class ArrayRequest( object ):
 
     def submit( self ):
         pass
+
+    def adjustPriority( self, delta ):
+        pass
         
     # callback( result = result, **kwargs )
     def notify( self, callback, **kwargs ):
@@ -87,6 +92,35 @@ assert issubclass(ArraySource, SourceABC)
 #*******************************************************************************
 
 class ArraySinkSource( ArraySource ):
+    '''An ArraySource that can be written to, e.g. for labels.
+
+    Keeps a coarse occupancy index of the wrapped array: for every block
+    of BLOCKSIZE elements along each axis, whether it contains non-zero
+    elements. Requests for regions that only cover empty blocks are
+    answered with zeros without touching the array, which makes
+    scrolling through sparsely labeled volumes cheap. The index is
+    built lazily and blocks are re-examined after put() or setDirty().
+
+    '''
+    BLOCKSIZE = 64
+
+    _UNKNOWN, _EMPTY, _OCCUPIED = -1, 0, 1
+
+    def __init__( self, array ):
+        super(ArraySinkSource, self).__init__(array)
+        self._blockShape = tuple(min(self.BLOCKSIZE, max(1, n)) for n in array.shape)
+        self._occupancy = np.empty([-(-n // b) for n, b in zip(array.shape, self._blockShape)],
+                                   dtype=np.int8)
+        self._occupancy[...] = self._UNKNOWN
+        self._occupancyLock = threading.Lock()
+
+    def request( self, slicing ):
+        if is_pure_slicing(slicing) and len(slicing) == len(self._array.shape) \
+           and self.isEmpty(slicing):
+            shape = tuple(len(xrange(*s.indices(n))) for s, n in zip(slicing, self._array.shape))
+            return ConstantRequest( np.zeros(shape, dtype=self._array.dtype) )
+        return super(ArraySinkSource, self).request(slicing)
+
     def put( self, slicing, subarray, neutral = 0 ):
         '''Make an update of the wrapped arrays content.
 
@@ -96,10 +130,77 @@ class ArraySinkSource( ArraySource ):
         '''
         assert(len(slicing) == len(self._array.shape)), \
             "slicing into an array of shape=%r requested, but the slicing object is %r" % (slicing, self._array.shape)  
-        self._array[slicing] = np.where(subarray!=neutral, subarray, self._array[slicing])
         pure = index2slice(slicing)
+        with self._occupancyLock:
+            self._array[slicing] = np.where(subarray!=neutral, subarray, self._array[slicing])
+            self._invalidate(pure)
         self.setDirty(pure)
 
+    def setDirty( self, slicing ):
+        if is_pure_slicing(slicing) and len(slicing) == len(self._array.shape):
+            # the array may have been changed directly
+            with self._occupancyLock:
+                self._invalidate(slicing)
+        super(ArraySinkSource, self).setDirty(slicing)
+
+    def isEmpty( self, slicing ):
+        '''Check whether the region given by the pure slicing only
+        contains zeros.
+
+        Looks at whole blocks, so a region is only considered empty
+        if all blocks it intersects are empty.
+
+        '''
+        blocks = self._blocks(slicing)
+        with self._occupancyLock:
+            occupancy = self._occupancy[blocks]
+            if (occupancy == self._OCCUPIED).any():
+                return False
+            for index in zip(*np.nonzero(occupancy == self._UNKNOWN)):
+                block = tuple(i + s.start for i, s in zip(index, blocks))
+                region = tuple(slice(i*b, (i+1)*b) for i, b in zip(block, self._blockShape))
+                state = self._OCCUPIED if self._array[region].any() else self._EMPTY
+                self._occupancy[block] = state
+                if state == self._OCCUPIED:
+                    return False
+            return True
+
+    def nextNonzeroIndex( self, axis, start, direction=1 ):
+        '''Return the next index after start along axis whose slice
+        contains non-zero elements, or None.
+
+        direction -- 1 to search upwards, -1 downwards
+
+        Runs of empty blocks are skipped, e.g. to jump to the next
+        labeled slice of a sparsely labeled volume.
+
+        '''
+        n = self._array.shape[axis]
+        b = self._blockShape[axis]
+        slicing = [slice(None)] * len(self._array.shape)
+        i = start + direction
+        while 0 <= i < n:
+            slicing[axis] = slice(i, i + 1)
+            if self.isEmpty(slicing):
+                # the other slices of the block layer are empty, too
+                i = (i // b + 1) * b if direction > 0 else (i // b) * b - 1
+                continue
+            if self._array[tuple(slicing)].any():
+                return i
+            i += direction
+        return None
+
+    def _blocks( self, slicing ):
+        '''Slicing of the occupancy index covering the region.'''
+        blocks = []
+        for s, n, b in zip(slicing, self._array.shape, self._blockShape):
+            start, stop, step = s.indices(n)
+            blocks.append(slice(start // b, -(-max(start, stop) // b)))
+        return tuple(blocks)
+
+    def _invalidate( self, slicing ):
+        self._occupancy[self._blocks(slicing)] = self._UNKNOWN
+
 #*******************************************************************************
 # R e l a b e l i n g A r r a y S o u r c e                                    * 
 #*******************************************************************************
@@ -178,10 +279,19 @@ class LazyflowRequest( object ):
         return self._req[0].getResult()
 
     def adjustPriority(self,delta):
-        self._req[0].adjustPriority(delta)
+        if 0 in self._req:
+            self._req[0].adjustPriority(delta)
+        else:
+            # not started yet; the lazyflow request will be
+            # created with the adjusted priority
+            op, slicing, prio = self._req.p
+            self._req.p = (op, slicing, prio + delta)
         
     def cancel( self ):
-        self._req[0].cancel()
+        # don't create (and thereby start) a lazyflow request
+        # just to cancel it
+        if 0 in self._req:
+            self._req[0].cancel()
 
     def submit( self ):
         self._req[0].submit()
@@ -190,6 +300,43 @@ class LazyflowRequest( object ):
         self._req[0].notify( callback, **kwargs)
 assert issubclass(LazyflowRequest, RequestABC)
 
+#*******************************************************************************
+# S t r i d e d R e q u e s t                                                  *
+#*******************************************************************************
+
+class StridedRequest( object ):
+    '''Applies slice steps to the result of a wrapped request.
+
+    Used by sources whose backend cannot read strided regions
+    directly: the bounding region is requested and subsampled
+    afterwards.
+
+    '''
+    def __init__( self, request, strides ):
+        self._req = request
+        self._strides = strides
+
+    def wait( self ):
+        return self._req.wait()[self._strides]
+
+    def getResult( self ):
+        return self._req.getResult()[self._strides]
+
+    def adjustPriority( self, delta ):
+        self._req.adjustPriority(delta)
+
+    def cancel( self ):
+        self._req.cancel()
+
+    def submit( self ):
+        self._req.submit()
+
+    def notify( self, callback, **kwargs ):
+        def handleResult(result, **kw):
+            callback(result[self._strides], **kw)
+        self._req.notify( handleResult, **kwargs )
+assert issubclass(StridedRequest, RequestABC)
+
 #*******************************************************************************
 # L a z y f l o w S o u r c e                                                  *
 #*******************************************************************************
@@ -220,8 +367,16 @@ class LazyflowSource( QObject ):
             volumina.printLock.release()
         if not is_pure_slicing(slicing):
             raise Exception('LazyflowSource: slicing is not pure')
+        if is_strided(slicing):
+            # lazyflow rois have no notion of steps
+            bounding, strides = unstrided(slicing)
+            return StridedRequest( LazyflowRequest( self._op5, bounding, self._priority ), strides )
         return LazyflowRequest( self._op5, slicing, self._priority )
 
+    def sharingKey( self ):
+        # sources of the same slot deliver the same data
+        return ('lazyflow', self._orig_outslot)
+
     def _setDirtyLF(self, slot, roi):
         self.setDirty(roi.toSlice())
 
@@ -322,6 +477,9 @@ class ConstantSource( QObject ):
     def id( self ):
         return id(self)
 
+    def sharingKey( self ):
+        return ('constant', self._constant, np.dtype(self._dtype).str)
+
     def request( self, slicing, through=None ):
         assert is_pure_slicing(slicing)
         assert is_bounded(slicing)
@@ -366,6 +524,12 @@ class NormalizingRequest( object ):
     def getResult(self):
         return self._result
 
+    def cancel( self ):
+        self._rawRequest.cancel()
+
+    def adjustPriority( self, delta ):
+        self._rawRequest.adjustPriority(delta)
+
 assert issubclass(NormalizingRequest, RequestABC)
 
 
@@ -473,3 +637,113 @@ class NormalizingSource( QObject ):
 
 assert issubclass(NormalizingSource, SourceABC)
 
+
+#*******************************************************************************
+# D i s k C a c h e R e q u e s t                                              *
+#*******************************************************************************
+class DiskCacheRequest( object ):
+    '''Serves a request from a DiskCache or stores the result of the
+    raw request in it.'''
+    def __init__( self, rawRequest, cache, identity, slicing ):
+        self._rawRequest = rawRequest
+        self._cache = cache
+        self._identity = identity
+        self._slicing = slicing
+        # results computed from data that becomes dirty in the
+        # meantime must not be stored
+        self._generation = cache.generation(identity)
+        self._result = None
+
+    def wait( self ):
+        if self._result is None:
+            self._result = self._cache.get(self._identity, self._slicing)
+            if self._result is None:
+                self._result = self._store(self._rawRequest.wait())
+        return self._result
+
+    # callback( result = result, **kwargs )
+    def notify( self, callback, **kwargs ):
+        self._result = self._cache.get(self._identity, self._slicing)
+        if self._result is not None:
+            t = threading.Thread(target=callback, args=(self._result,), kwargs=kwargs)
+            t.start()
+            return
+        def handleResult(rawResult, **kw):
+            self._result = self._store(rawResult)
+            callback( self._result, **kw )
+        self._rawRequest.notify( handleResult, **kwargs )
+
+    def _store( self, result ):
+        self._cache.put(self._identity, self._slicing, result, self._generation)
+        return result
+
+    def getResult(self):
+        return self._result
+
+    def cancel( self ):
+        self._rawRequest.cancel()
+
+    def submit( self ):
+        if hasattr(self._rawRequest, 'submit'):
+            self._rawRequest.submit()
+
+    def adjustPriority( self, delta ):
+        self._rawRequest.adjustPriority(delta)
+
+assert issubclass(DiskCacheRequest, RequestABC)
+
+#*******************************************************************************
+# D i s k C a c h e S o u r c e                                                *
+#*******************************************************************************
+class DiskCacheSource( QObject ):
+    """
+    A datasource that caches the data of another datasource on disk.
+
+    Meant for expensive sources, e.g. LazyflowSources of classifier
+    predictions: data requested once is read from a compressed file
+    in later requests and in later sessions. Dirty regions of the raw
+    source are removed from the cache.
+    """
+    isDirty = pyqtSignal( object )
+
+    def __init__( self, rawSource, identity, cache=None, parent=None ):
+        """
+        rawSource: The original datasource whose data will be cached
+
+        identity: A string that identifies the data of rawSource across
+                  sessions, e.g. project file, operator name and a version
+                  of its parameters. Change it whenever the data may have
+                  changed while no one was listening to the isDirty signal.
+
+        cache: The volumina.pixelpipeline.diskcache.DiskCache to use;
+               by default the shared one configured in the 'diskcache'
+               section of the config.
+        """
+        super(DiskCacheSource, self).__init__(parent)
+        self._rawSource = rawSource
+        self._identity = identity
+        self._cache = cache if cache is not None else diskcache.diskCache()
+        self._rawSource.isDirty.connect( self._onDirty )
+
+    def request( self, slicing ):
+        if not is_pure_slicing(slicing) or not is_bounded(slicing):
+            return self._rawSource.request(slicing)
+        return DiskCacheRequest( self._rawSource.request(slicing), self._cache,
+                                 self._identity, slicing )
+
+    def _onDirty( self, slicing ):
+        self._cache.invalidate( self._identity, slicing )
+        self.isDirty.emit( slicing )
+
+    def setDirty( self, slicing ):
+        self._rawSource.setDirty( slicing )
+
+    def __eq__( self, other ):
+        return isinstance( other, DiskCacheSource ) and \
+               self._identity == other._identity and \
+               self._rawSource == other._rawSource
+
+    def __ne__( self, other ):
+        return not ( self == other )
+
+assert issubclass(DiskCacheSource, SourceABC)
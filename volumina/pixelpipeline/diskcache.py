@@ -0,0 +1,215 @@
+'''Persistent, compressed cache of data source results on disk.
+
+Results of slow data sources (e.g. classifier predictions computed by a
+lazyflow pipeline) are lost after every eviction from the tile caches
+and at the end of every session. A DiskCache stores the arrays
+delivered for a slicing in compressed files, so that previously viewed
+slices show up immediately, even after reopening a project.
+
+Entries are grouped by a source identity, a string chosen by the
+caller that has to identify the data persistently across sessions
+(e.g. project file, operator and version of its parameters). Every
+identity owns a subdirectory; the name of an entry's file encodes its
+slicing, so that dirty regions can be invalidated without reading
+the files. The cache is bounded in size and evicts the least recently
+used entries; file modification times record the order of use across
+sessions.
+
+Wrap a data source in a datasources.DiskCacheSource to use the cache.
+
+'''
+import os
+import hashlib
+import threading
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from volumina.config import cfg
+from volumina.slicingtools import intersection
+
+def _sliceName( s ):
+    return '-'.join('n' if v is None else str(v) for v in (s.start, s.stop, s.step))
+
+def _parseSlice( name ):
+    return slice(*[None if v == 'n' else int(v) for v in name.split('-')])
+
+def slicingName( slicing ):
+    '''File name of the entry for slicing, e.g. '0-1_0-256-2_...'.'''
+    return '_'.join(_sliceName(s) for s in slicing) + '.npz'
+
+def parseSlicingName( name ):
+    return tuple(_parseSlice(s) for s in name[:-len('.npz')].split('_'))
+
+#*******************************************************************************
+# D i s k C a c h e                                                            *
+#*******************************************************************************
+
+class DiskCache( object ):
+    '''Bounded LRU cache of arrays on disk.
+
+    directory -- where the entries are stored; created if necessary
+    maxBytes  -- size of all compressed entries that is not exceeded
+
+    Thread safe: get() and put() may be called from several render
+    threads at once.
+
+    '''
+    def __init__( self, directory, maxBytes ):
+        self.directory = os.path.expanduser(directory)
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> bytes, least recently used first
+        self._slicings = {}            # identity directory -> {path : slicing}
+        self._generations = {}         # identity -> number of invalidations
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._scan()
+
+    def _scan( self ):
+        '''Index the entries stored by previous sessions.'''
+        found = []
+        for sub in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                path = os.path.join(subdir, name)
+                try:
+                    slicing = parseSlicingName(name)
+                    st = os.stat(path)
+                except (ValueError, OSError):
+                    # temporary files of interrupted writes and the like
+                    continue
+                found.append((st.st_mtime, path, st.st_size, subdir, slicing))
+        for mtime, path, size, subdir, slicing in sorted(found):
+            self._add(path, size, subdir, slicing)
+        self._evictIfNecessary()
+
+    def _subdir( self, identity ):
+        return os.path.join(self.directory, hashlib.sha1(identity).hexdigest())
+
+    def _path( self, identity, slicing ):
+        return os.path.join(self._subdir(identity), slicingName(slicing))
+
+    def __len__( self ):
+        return len(self._entries)
+
+    def stats( self ):
+        with self._lock:
+            return {'hits' : self._hits, 'misses' : self._misses,
+                    'entries' : len(self._entries), 'bytes' : self._bytes,
+                    'maxbytes' : self.maxBytes}
+
+    def generation( self, identity ):
+        '''Incremented whenever entries of identity are invalidated.
+
+        Pass the generation obtained before computing a result to put(),
+        so that results computed from outdated data are not stored.
+
+        '''
+        return self._generations.get(identity, 0)
+
+    def get( self, identity, slicing ):
+        '''Return the stored array or None.'''
+        path = self._path(identity, slicing)
+        with self._lock:
+            if path not in self._entries:
+                self._misses += 1
+                return None
+            self._entries[path] = self._entries.pop(path)
+            self._hits += 1
+        try:
+            with np.load(path) as f:
+                a = f['a']
+            os.utime(path, None)
+        except (IOError, OSError, KeyError, ValueError):
+            # removed or corrupted behind our back
+            with self._lock:
+                self._remove(path)
+            return None
+        return a
+
+    def put( self, identity, slicing, array, generation=None ):
+        '''Store array as the result for slicing of identity.'''
+        if generation is not None and generation != self.generation(identity):
+            return
+        subdir = self._subdir(identity)
+        path = os.path.join(subdir, slicingName(slicing))
+        try:
+            if not os.path.isdir(subdir):
+                os.makedirs(subdir)
+            # write to a temporary file first: other sessions or
+            # threads never see half written entries
+            fd, tmp = tempfile.mkstemp(dir=subdir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, a=array)
+            os.rename(tmp, path)
+            size = os.path.getsize(path)
+        except (IOError, OSError):
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation(identity):
+                # invalidated while writing
+                self._remove(path)
+                return
+            self._remove(path, deleteFile=False)
+            self._add(path, size, subdir, slicing)
+            self._evictIfNecessary()
+
+    def invalidate( self, identity, slicing=None ):
+        '''Remove the entries of identity that intersect slicing
+        (all entries if slicing is None).'''
+        subdir = self._subdir(identity)
+        with self._lock:
+            self._generations[identity] = self.generation(identity) + 1
+            entries = self._slicings.get(subdir, {})
+            for path, s in entries.items():
+                if slicing is None or (len(s) == len(slicing) and
+                                       intersection(s, tuple(slicing)) is not None):
+                    self._remove(path)
+
+    def clear( self ):
+        with self._lock:
+            for path in list(self._entries):
+                self._remove(path)
+
+    def _add( self, path, size, subdir, slicing ):
+        self._entries[path] = size
+        self._slicings.setdefault(subdir, {})[path] = slicing
+        self._bytes += size
+
+    def _remove( self, path, deleteFile=True ):
+        if deleteFile:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if path in self._entries:
+            self._bytes -= self._entries.pop(path)
+            del self._slicings[os.path.dirname(path)][path]
+
+    def _evictIfNecessary( self ):
+        while self._bytes > self.maxBytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+_diskCache = None
+_diskCacheLock = threading.Lock()
+
+def diskCache():
+    '''Return the DiskCache shared by all DiskCacheSources.
+
+    Configured by the 'directory' and 'size_mb' options of the
+    'diskcache' section.
+
+    '''
+    global _diskCache
+    with _diskCacheLock:
+        if _diskCache is None:
+            _diskCache = DiskCache(cfg.get('diskcache', 'directory'),
+                                   int(cfg.getfloat('diskcache', 'size_mb') * 2**20))
+        return _diskCache
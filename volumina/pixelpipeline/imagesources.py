@@ -7,11 +7,110 @@ except:
 
 from PyQt4.QtCore import QObject, QRect, pyqtSignal, QMutex
 from PyQt4.QtGui import QImage, QColor
-from qimage2ndarray import gray2qimage, array2qimage, alpha_view, rgb_view
+from qimage2ndarray import gray2qimage, array2qimage, alpha_view, rgb_view, raw_view
 from asyncabcs import SourceABC, RequestABC
 from volumina.slicingtools import is_bounded, slicing2rect, rect2slicing, slicing2shape, is_pure_slicing
+from volumina.pixelpipeline.conversion import convertInPool
 from volumina.config import cfg
 import numpy as np
+import threading
+from contextlib import contextmanager
+
+def orient( a, transform ):
+    '''Return a view of a 2D (or 2D multichannel) array oriented like
+    an image transformed by transform.
+
+    a is laid out like the image it is converted to, i.e. the first
+    axis are the image rows. transform must be axis-aligned: it may
+    only swap and flip the axes (and translate, which is ignored, as in
+    QImage.transformed). None leaves the array as it is.
+
+    '''
+    if transform is None:
+        return a
+    if transform.m12() == 0 and transform.m21() == 0:
+        sx, sy = transform.m11(), transform.m22()
+    elif transform.m11() == 0 and transform.m22() == 0:
+        a = a.swapaxes(0, 1)
+        sx, sy = transform.m21(), transform.m12()
+    else:
+        raise ValueError('orient(): transform is not axis-aligned')
+    assert abs(sx) == 1 and abs(sy) == 1, 'orient(): transform must not scale'
+    if sx < 0:
+        a = a[:, ::-1]
+    if sy < 0:
+        a = a[::-1]
+    return a
+
+#*******************************************************************************
+# U n i f o r m I m a g e                                                      *
+#*******************************************************************************
+
+class UniformImage( QImage ):
+    '''An image whose pixels all have the same color.
+
+    Image requests return UniformImages for uniform arrays, e.g. the
+    empty tiles of sparse label layers or tiles of ConstantSources.
+    They are shared between all tiles of the same size and color (see
+    uniformImage()), so never paint on them. The tile caches do not
+    count their bytes and compositing fills them with their color or
+    skips them if they are transparent.
+
+    '''
+    def __init__( self, width, height, format, rawPixel ):
+        QImage.__init__( self, width, height, format )
+        self.fill(rawPixel)
+        # straight (not premultiplied) color, as painted by fillRect
+        pixel = self.copy(0, 0, 1, 1).convertToFormat(QImage.Format_ARGB32)
+        self.color = QColor.fromRgba(pixel.pixel(0, 0))
+
+    @property
+    def transparent( self ):
+        return self.color.alpha() == 0
+
+_uniformImages = {}
+_uniformImagesLock = threading.Lock()
+
+def uniformImage( pixelImage, shape ):
+    '''Return the shared UniformImage of shape (rows, columns) filled
+    with the single pixel of the 1x1 image pixelImage.'''
+    height, width = shape
+    fmt = pixelImage.format()
+    rawPixel = int(raw_view(pixelImage)[0, 0])
+    key = (width, height, fmt, rawPixel)
+    with _uniformImagesLock:
+        img = _uniformImages.get(key)
+        if img is None:
+            if len(_uniformImages) > 4096:
+                # many different colors, e.g. a grayscale ConstantSource
+                # whose constant is animated; start over
+                _uniformImages.clear()
+            img = _uniformImages[key] = UniformImage(width, height, fmt, rawPixel)
+        return img
+
+def isUniform( a ):
+    '''Check whether all elements of the 2D array a are equal.'''
+    if a.size == 0:
+        return False
+    v = a[0, 0]
+    # most non-uniform tiles already differ in a corner or the center
+    if a[-1, -1] != v or a[0, -1] != v or a[-1, 0] != v \
+       or a[a.shape[0] // 2, a.shape[1] // 2] != v:
+        return False
+    return bool((a == v).all())
+
+def sourceKey( source ):
+    '''Hashable key of a 2D array source for ImageSource.sharingKey().'''
+    if source is None:
+        return None
+    if hasattr(source, 'sharingKey'):
+        return source.sharingKey()
+    return source
+
+def _hashable( v ):
+    if hasattr(v, '__iter__'):
+        return tuple(_hashable(x) for x in v)
+    return v
 
 #*******************************************************************************
 # I m a g e S o u r c e                                                        *
@@ -37,9 +136,52 @@ class ImageSource( QObject ):
         self._opaque = guarantees_opaqueness
         self.direct = direct
 
-    def request( self, rect, through=None ):
+    def request( self, rect, through=None, downsample=1, transform=None ):
+        '''Request the image of a rectangular region.
+
+        rect       -- QRect in data coordinates
+        through    -- slicing position; the current one if None
+        downsample -- only every downsample-th pixel along both axes
+                      is rendered; the resulting image has a size of
+                      ceil(rect.size() / downsample)
+        transform  -- axis-aligned QTransform the image is rendered
+                      with (see orient()); applied to the data array
+                      before the conversion, which is cheaper than
+                      transforming the finished image
+
+        '''
         raise NotImplementedError
 
+    def arraySources( self ):
+        '''The 2D array sources the images are made of.'''
+        return []
+
+    @contextmanager
+    def coalesced( self, requests, downsample=1 ):
+        '''Merge the reads of the following requests.
+
+        requests -- the (rect, through) pairs about to be requested
+
+        Within the context, the announced requests are served by a few
+        large reads of the array sources instead of one read each: the
+        rects of adjacent tiles are merged, and so are adjacent slices
+        (see SliceSource.coalesced). Announced requests that are never
+        made cost a part of a larger read. Array sources that cannot
+        merge reads are requested as usual.
+
+        '''
+        requests = [(rect2slicing(rect, step=downsample), through)
+                    for rect, through in requests]
+        contexts = [src.coalesced(requests) for src in self.arraySources()
+                    if hasattr(src, 'coalesced')]
+        for context in contexts:
+            context.__enter__()
+        try:
+            yield
+        finally:
+            for context in reversed(contexts):
+                context.__exit__(None, None, None)
+
     def setDirty( self, slicing ):
         '''Mark a region of the image as dirty.
 
@@ -67,6 +209,16 @@ class ImageSource( QObject ):
 
         '''
         return self._opaque
+
+    def sharingKey( self ):
+        '''Hashable key that is equal for image sources rendering the
+        same images, e.g. in different editors showing the same data.
+
+        Image sources with equal keys share their layer tiles (see
+        tiling.LayerTileRegistry). None, the default, shares nothing.
+
+        '''
+        return None
 assert issubclass(ImageSource, SourceABC)
 
 #*******************************************************************************
@@ -84,7 +236,7 @@ class GrayscaleImageSource( ImageSource ):
         self._arraySource2D.isDirty.connect(self.setDirty)
         self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
 
-    def request( self, qrect, through=None ):
+    def request( self, qrect, through=None, downsample=1, transform=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  GrayscaleImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -93,17 +245,25 @@ class GrayscaleImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=downsample)
         req = self._arraySource2D.request(s, through)
-        return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct )
+        return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct,
+                                      transform=transform )
+
+    def arraySources( self ):
+        return [self._arraySource2D]
+
+    def sharingKey( self ):
+        return ('grayscale', sourceKey(self._arraySource2D), _hashable(self._layer.normalize[0]))
 assert issubclass(GrayscaleImageSource, SourceABC)
 
 class GrayscaleImageRequest( object ):
-    def __init__( self, arrayrequest, normalize=None, direct=False ):
+    def __init__( self, arrayrequest, normalize=None, direct=False, transform=None ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._normalize = normalize
         self.direct = direct
+        self._transform = transform
 
     def wait(self):
         self._arrayreq.wait()
@@ -112,11 +272,26 @@ class GrayscaleImageRequest( object ):
     def toImage( self ):
         a = self._arrayreq.getResult()
         assert a.ndim == 2, "GrayscaleImageRequest.toImage(): result has shape %r, which is not 2-D" % (a.shape,)
-        
+        a = orient(a, self._transform)
+        if isUniform(a):
+            return uniformImage(self._convert(a[:1, :1]), a.shape)
+
+        img = convertInPool('grayscale', [a], self._normalize)
+        if img is not None:
+            return img
+        return self._convert(a)
+
+    def _convert( self, a ):
         normalize = self._normalize 
         img = gray2qimage(a, normalize)
         return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
+    def adjustPriority( self, delta ):
+        self._arrayreq.adjustPriority(delta)
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -140,7 +315,7 @@ class AlphaModulatedImageSource( ImageSource ):
 
         self._arraySource2D.isDirty.connect(self.setDirty)
 
-    def request( self, qrect, through=None ):
+    def request( self, qrect, through=None, downsample=1, transform=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  AlphaModulatedImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -149,24 +324,43 @@ class AlphaModulatedImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=downsample)
         req = self._arraySource2D.request(s, through)
-        return AlphaModulatedImageRequest( req, self._layer.tintColor, self._layer.normalize[0] )
+        return AlphaModulatedImageRequest( req, self._layer.tintColor, self._layer.normalize[0],
+                                           transform=transform )
+
+    def arraySources( self ):
+        return [self._arraySource2D]
+
+    def sharingKey( self ):
+        return ('alphamodulated', sourceKey(self._arraySource2D), self._layer.tintColor.rgba(),
+                _hashable(self._layer.normalize[0]))
 assert issubclass(AlphaModulatedImageSource, SourceABC)
 
 class AlphaModulatedImageRequest( object ):
-    def __init__( self, arrayrequest, tintColor, normalize=(0,255)):
+    def __init__( self, arrayrequest, tintColor, normalize=(0,255), transform=None ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._normalize = normalize
         self._tintColor = tintColor
+        self._transform = transform
 
     def wait(self):
         self._arrayreq.wait()
         return self.toImage()
 
     def toImage( self ):
-        a = self._arrayreq.getResult()
+        a = orient(self._arrayreq.getResult(), self._transform)
+        if isUniform(a):
+            return uniformImage(self._convert(a[:1, :1]), a.shape)
+
+        tint = (self._tintColor.redF(), self._tintColor.greenF(), self._tintColor.blueF())
+        img = convertInPool('alphamodulated', [a], (tint, self._normalize))
+        if img is not None:
+            return img
+        return self._convert(a)
+
+    def _convert( self, a ):
         shape = a.shape + (4,)
         d = np.empty(shape, dtype=np.float32)
         d[:,:,0] = a[:,:]*self._tintColor.redF()
@@ -178,6 +372,12 @@ class AlphaModulatedImageRequest( object ):
         img = array2qimage(d, normalize)
         return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
+    def adjustPriority( self, delta ):
+        self._arrayreq.adjustPriority(delta)
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -216,7 +416,7 @@ class ColortableImageSource( ImageSource ):
             self._colorTable[i,3] = color.alpha() 
         self.isDirty.emit(QRect()) # empty rect == everything is dirty
         
-    def request( self, qrect, through=None ):
+    def request( self, qrect, through=None, downsample=1, transform=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  ColortableImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d) = %r" \
@@ -225,17 +425,24 @@ class ColortableImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=downsample)
         req = self._arraySource2D.request(s, through)
-        return ColortableImageRequest( req, self._colorTable, self.direct )
+        return ColortableImageRequest( req, self._colorTable, self.direct, transform )
+
+    def arraySources( self ):
+        return [self._arraySource2D]
+
+    def sharingKey( self ):
+        return ('colortable', sourceKey(self._arraySource2D), self._colorTable.tostring())
 assert issubclass(ColortableImageSource, SourceABC)
 
 class ColortableImageRequest( object ):
-    def __init__( self, arrayrequest, colorTable, direct=False ):
+    def __init__( self, arrayrequest, colorTable, direct=False, transform=None ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._colorTable = colorTable
         self.direct = direct
+        self._transform = transform
 
     def wait(self):
         self._arrayreq.wait()
@@ -244,7 +451,16 @@ class ColortableImageRequest( object ):
     def toImage( self ):
         a = self._arrayreq.getResult()
         assert a.ndim == 2
+        a = orient(a, self._transform)
+        if isUniform(a):
+            return uniformImage(self._convert(a[:1, :1]), a.shape)
+
+        img = convertInPool('colortable', [a, self._colorTable])
+        if img is not None:
+            return img
+        return self._convert(a)
 
+    def _convert( self, a ):
         #make sure that a has values in range [0, colortable_length)
         a = np.remainder(a, len(self._colorTable))
         #apply colortable
@@ -253,6 +469,12 @@ class ColortableImageRequest( object ):
 
         return img 
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
+    def adjustPriority( self, delta ):
+        self._arrayreq.adjustPriority(delta)
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -287,7 +509,7 @@ class RGBAImageSource( ImageSource ):
         for arraySource in self._channels:
             arraySource.isDirty.connect(self.setDirty)
 
-    def request( self, qrect, through=None ):
+    def request( self, qrect, through=None, downsample=1, transform=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  RGBAImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -296,7 +518,7 @@ class RGBAImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing( qrect )
+        s = rect2slicing( qrect, step=downsample )
         r = self._channels[0].request(s, through)
         g = self._channels[1].request(s, through)
         b = self._channels[2].request(s, through)
@@ -304,17 +526,26 @@ class RGBAImageSource( ImageSource ):
         shape = list( slicing2shape(s) )
         assert len(shape) == 2
         assert all([x > 0 for x in shape])
-        return RGBAImageRequest( r, g, b, a, shape, *self._layer._normalize )
+        return RGBAImageRequest( r, g, b, a, shape, *self._layer._normalize,
+                                 transform=transform )
+
+    def arraySources( self ):
+        return list(self._channels)
+
+    def sharingKey( self ):
+        return ('rgba', tuple(sourceKey(c) for c in self._channels),
+                _hashable(self._layer._normalize))
 assert issubclass(RGBAImageSource, SourceABC)
 
 class RGBAImageRequest( object ):
     def __init__( self, r, g, b, a, shape,
-                  normalizeR=None, normalizeG=None, normalizeB=None, normalizeA=None ):
+                  normalizeR=None, normalizeG=None, normalizeB=None, normalizeA=None,
+                  transform=None ):
         self._mutex = QMutex()
         self._requests = r, g, b, a
         self._normalize = [normalizeR, normalizeG, normalizeB, normalizeA]
-        shape.append(4)
-        self._data = np.empty(shape, dtype=np.uint8)
+        self._transform = transform
+        self._shape = tuple(shape)
         self._requestsFinished = 4 * [False,]
 
     def wait(self):
@@ -323,8 +554,20 @@ class RGBAImageRequest( object ):
         return self.toImage()
 
     def toImage( self ):
-        for i, req in enumerate(self._requests):
-            a = self._requests[i].getResult()
+        results = [req.getResult() for req in self._requests]
+        assert all(a.shape == self._shape for a in results)
+        channels = [orient(a, self._transform) for a in results]
+        if all(isUniform(a) for a in channels):
+            return uniformImage(self._convert([a[:1, :1] for a in channels]), channels[0].shape)
+
+        img = convertInPool('rgba', channels, self._normalize)
+        if img is not None:
+            return img
+        return self._convert(channels)
+
+    def _convert( self, channels ):
+        data = np.empty(channels[0].shape + (4,), dtype=np.uint8)
+        for i, a in enumerate(channels):
             if self._normalize[i] is not None:
 
                 normalize = self._normalize[i]
@@ -333,10 +576,18 @@ class RGBAImageRequest( object ):
                 a[a > 255] = 255
                 a[a < 0]   = 0
                 a = a.astype(np.uint8)
-            self._data[:,:,i] = a
-        img = array2qimage(self._data)
+            data[:,:,i] = a
+        img = array2qimage(data)
         return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
 
+    def cancel( self ):
+        for req in self._requests:
+            req.cancel()
+
+    def adjustPriority( self, delta ):
+        for req in self._requests:
+            req.adjustPriority(delta)
+
     def notify( self, callback, **kwargs ):
         for i in xrange(4):
             self._requests[i].notify(self._onNotify, package = (i, callback, kwargs))
@@ -357,23 +608,31 @@ assert issubclass(RGBAImageRequest, RequestABC)
 
 class RandomImageSource( ImageSource ):
     '''Random noise image for testing and debugging.'''
-    def request( self, qrect, through=None ):
+    def request( self, qrect, through=None, downsample=1, transform=None ):
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=downsample)
         shape = slicing2shape( s )
-        return RandomImageRequest( shape )
+        return RandomImageRequest( shape, transform )
 assert issubclass(RandomImageSource, SourceABC)
 
 class RandomImageRequest( object ):
-    def __init__( self, shape ):
+    def __init__( self, shape, transform=None ):
         self.shape = shape
+        self._transform = transform
 
     def wait(self):
         d = (np.random.random(self.shape) * 255).astype(np.uint8)        
+        d = orient(d, self._transform)
         assert d.ndim == 2
         img = gray2qimage(d)
         return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
             
+    def cancel( self ):
+        pass
+
+    def adjustPriority( self, delta ):
+        pass
+
     def notify( self, callback, **kwargs ):
         img = self.wait()
         callback( img, **kwargs )
@@ -1,8 +1,11 @@
+import threading
+from contextlib import contextmanager
 from PyQt4.QtCore import QObject, pyqtSignal
 from asyncabcs import SourceABC, RequestABC
 import numpy as np
 import volumina
-from volumina.slicingtools import SliceProjection, is_pure_slicing, intersection, sl
+from volumina.slicingtools import SliceProjection, is_pure_slicing, intersection, sl, \
+                                  slicing2shape, slicing_key, coalesce_slicings
 from volumina.colorama import Fore
 
 projectionAlongTXC = SliceProjection( abscissa = 2, ordinate = 3, along = [0,1,4] )
@@ -44,11 +47,151 @@ class SliceRequest( object ):
         callback(self._sp(result), **kwargs)
 assert issubclass(SliceRequest, RequestABC)
 
+#*******************************************************************************
+# C o a l e s c e d R e q u e s t                                              *
+#*******************************************************************************
+
+def _slabs( throughs, maxDepth ):
+    '''Group through positions into slabs of adjacent slices along
+    a single axis, each at most maxDepth slices thick.'''
+    slabs = []
+    for through in sorted(throughs):
+        slab = slabs[-1] if slabs else None
+        if slab is not None and len(slab) < maxDepth:
+            last = slab[-1]
+            axes = [i for i in xrange(len(through)) if through[i] != last[i]]
+            if len(axes) == 1 and through[axes[0]] == last[axes[0]] + 1 \
+               and (len(slab) == 1 or slab[0][axes[0]] != slab[1][axes[0]]):
+                slab.append(through)
+                continue
+        slabs.append([through])
+    return slabs
+
+class _CoalescedRead( object ):
+    '''One read of a merged rectangle through a slab of adjacent slices,
+    shared by the requests of its parts.
+
+    The read is issued when the first part is requested and computed
+    once, by the first part that waits for it. It is cancelled when all
+    parts requested so far are cancelled.
+
+    '''
+    def __init__( self, slicesource, slicing2D, throughs ):
+        sp = slicesource.sliceProjection
+        self._source = slicesource
+        self._sp = sp
+        self.slicing = slicing2D
+        self.domain = list(sp.domain(throughs[0], slicing2D[0], slicing2D[1]))
+        self._first = throughs[0]
+        for i in xrange(len(sp.along)):
+            if throughs[-1][i] != throughs[0][i]:
+                self.domain[sp.along[i]] = slice(throughs[0][i], throughs[-1][i] + 1)
+        self.domain = tuple(self.domain)
+        self._lock = threading.Lock()
+        self._waitLock = threading.Lock() # held while the read is computed
+        self._req = None
+        self._result = None
+        self._users = 0
+        self._priorities = {} # part -> priority
+
+    def part( self, slicing2D, through ):
+        with self._lock:
+            if self._req is None:
+                self._req = self._source._read(self.domain)
+            self._users += 1
+            req = self._req
+        part = [slice(None)] * len(self.domain)
+        for axis, p, m in zip((self._sp.abscissa, self._sp.ordinate), slicing2D, self.slicing):
+            start = (p.start - m.start) // (m.step or 1)
+            part[axis] = slice(start, start + slicing2shape(p)[0])
+        for i, axis in enumerate(self._sp.along):
+            start = through[i] - self._first[i]
+            part[axis] = slice(start, start + 1)
+        request = CoalescedRequest(self, req, tuple(part), self._sp)
+        self.setPriority(request, 0.)
+        return request
+
+    def wait( self, req ):
+        with self._waitLock:
+            if self._result is None:
+                self._result = req.wait()
+            return self._result
+
+    def setPriority( self, part, priority ):
+        '''Set the priority of a part (None removes it) and pass the
+        change of the effective, i.e. smallest, priority on.'''
+        with self._lock:
+            if part._ar is not self._req:
+                return
+            old = min(self._priorities.values()) if self._priorities else 0.
+            if priority is None:
+                self._priorities.pop(part, None)
+            else:
+                self._priorities[part] = priority
+            if self._priorities:
+                new = min(self._priorities.values())
+                if new != old:
+                    self._req.adjustPriority(new - old)
+
+    def release( self, part ):
+        self.setPriority(part, None)
+        with self._lock:
+            self._users -= 1
+            if self._users == 0 and self._result is None and part._ar is self._req:
+                self._req.cancel()
+                self._req = None
+
+class CoalescedRequest( object ):
+    '''Request of a slice of a merged read (see SliceSource.coalesced).'''
+    def __init__( self, read, domainArrayRequest, part, sliceProjection ):
+        self._read = read
+        self._ar = domainArrayRequest
+        self._part = part
+        self._sp = sliceProjection
+        self._cancelled = False
+        self._priority = 0.
+
+    def wait( self ):
+        return self._sp(self._read.wait(self._ar)[self._part])
+
+    def getResult( self ):
+        return self._sp(self._ar.getResult()[self._part])
+
+    def notify( self, callback, **kwargs ):
+        self._ar.notify(self._onNotify, package = (callback, kwargs))
+        return self
+
+    def cancel( self ):
+        if not self._cancelled:
+            self._cancelled = True
+            self._read.release(self)
+
+    def submit( self ):
+        self._ar.submit()
+        return self
+
+    def adjustPriority( self, delta ):
+        # the shared read follows the most urgent of its parts
+        if not self._cancelled:
+            self._priority += delta
+            self._read.setPriority(self, self._priority)
+        return self
+
+    def _onNotify( self, result, package ):
+        callback, kwargs = package
+        callback(self._sp(result[self._part]), **kwargs)
+assert issubclass(CoalescedRequest, RequestABC)
+
 #*******************************************************************************
 # S l i c e S o u r c e                                                        *
 #*******************************************************************************
 
 class SliceSource( QObject ):
+    # merged reads of coalesced requests are limited to this many pixels
+    # and to slabs of this many slices
+    maxCoalescedSize = 2048 * 2048
+    maxSlabDepth = 16
+
     areaDirty = pyqtSignal( object )
     isDirty = pyqtSignal( object )
     throughChanged = pyqtSignal( tuple, tuple ) # old, new
@@ -78,6 +221,7 @@ class SliceSource( QObject ):
         self._datasource = datasource
         self._datasource.isDirty.connect(self._onDatasourceDirty)
         self._through = len(sliceProjection.along) * [0]
+        self._coalesced = {} # (slicing key, through) -> _CoalescedRead
 
     def setThrough( self, index, value ):
         assert index < len(self.through)
@@ -87,15 +231,71 @@ class SliceSource( QObject ):
 
     def request( self, slicing2D, through=None ):
         assert len(slicing2D) == 2
-        through = through if through else self.through 
+        through = through if through else self.through
+        read = self._coalesced.get((slicing_key(slicing2D), tuple(through)))
+        if read is not None:
+            return read.part(slicing2D, tuple(through))
+        return self._request(slicing2D, through)
+
+    @contextmanager
+    def coalesced( self, requests ):
+        '''Merge the following requests into a few large reads.
+
+        requests -- the (slicing2D, through) pairs about to be requested;
+                    a through of None is the current one
+
+        Within the context, request() serves the announced requests from
+        reads of slabs (see _slabs()) of adjacent slices, each through the
+        merged rectangle of the slicings requested on its slices (see
+        coalesce_slicings()), instead of one read per request. Chunked
+        data sources then decompress each chunk once, not once per tile
+        and slice.
+
+        '''
+        planned = {}
+        for slicing2D, through in requests:
+            through = tuple(through if through else self.through)
+            planned.setdefault(through, {})[slicing_key(slicing2D)] = tuple(slicing2D)
+        added = []
+        for throughs in _slabs(planned, self.maxSlabDepth):
+            slicings = {}
+            for through in throughs:
+                slicings.update(planned[through])
+            maxSize = self.maxCoalescedSize // len(throughs)
+            for merged, parts in coalesce_slicings(slicings.values(), maxSize):
+                if len(parts) * len(throughs) < 2:
+                    continue
+                read = _CoalescedRead(self, merged, throughs)
+                for part in parts:
+                    for through in throughs:
+                        key = (slicing_key(part), through)
+                        self._coalesced[key] = read
+                        added.append((key, read))
+        try:
+            yield
+        finally:
+            for key, read in added:
+                if self._coalesced.get(key) is read:
+                    del self._coalesced[key]
+
+    def _request( self, slicing2D, through ):
         slicing = self.sliceProjection.domain(through, slicing2D[0], slicing2D[1])
-        
+        return SliceRequest(self._read(slicing), self.sliceProjection)
+
+    def _read( self, slicing ):
         if volumina.verboseRequests:
             volumina.printLock.acquire()
             print Fore.RED + "SliceSource requests '%r' from data source '%s'" % (slicing, self._datasource.name) + Fore.RESET
             volumina.printLock.release()
-        return SliceRequest(self._datasource.request(slicing), self.sliceProjection)
-        
+        return self._datasource.request(slicing)
+
+    def sharingKey( self ):
+        '''Equal for slice sources of the same datasource and projection.'''
+        sp = self.sliceProjection
+        ds = self._datasource
+        key = ds.sharingKey() if hasattr(ds, 'sharingKey') else ds
+        return (key, sp.abscissa, sp.ordinate, tuple(sp.along))
+
     def setDirty( self, slicing ):
         assert isinstance(slicing, tuple)
         if not is_pure_slicing(slicing):
@@ -166,6 +366,19 @@ class SyncedSliceSources( QObject ):
         through[index] = value
         self.through = through
 
+    @contextmanager
+    def coalesced( self, requests ):
+        '''Merge the following requests of all slice sources into
+        slab reads (see SliceSource.coalesced).'''
+        contexts = [src.coalesced(requests) for src in self._srcs]
+        for context in contexts:
+            context.__enter__()
+        try:
+            yield
+        finally:
+            for context in reversed(contexts):
+                context.__exit__(None, None, None)
+
     def add( self, sliceSrc ):
         assert isinstance( sliceSrc, SliceSource ), 'wrong type: %s' % str(type(sliceSrc))
         sliceSrc.through = self.through
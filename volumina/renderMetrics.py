@@ -0,0 +1,162 @@
+import time
+import bisect
+from threading import Lock
+
+#*******************************************************************************
+# L a t e n c y H i s t o g r a m                                              *
+#*******************************************************************************
+
+class LatencyHistogram( object ):
+    '''Histogram of durations in seconds with logarithmic buckets.
+
+    counts[i] is the number of durations <= BOUNDS[i] (and > BOUNDS[i-1]);
+    the last bucket counts everything longer than BOUNDS[-1].
+
+    '''
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5.)
+
+    def __init__( self ):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.maximum = 0.
+
+    def add( self, seconds ):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    @property
+    def mean( self ):
+        return self.total / self.count if self.count else 0.
+
+    def percentile( self, q ):
+        '''Upper bound of the bucket that contains the q-quantile (0 < q <= 1).'''
+        if not self.count:
+            return 0.
+        needed = q * self.count
+        seen = 0
+        for bound, n in zip(self.BOUNDS, self.counts):
+            seen += n
+            if seen >= needed:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def copy( self ):
+        h = LatencyHistogram()
+        h.counts = list(self.counts)
+        h.count, h.total, h.maximum = self.count, self.total, self.maximum
+        return h
+
+#*******************************************************************************
+# R e n d e r M e t r i c s                                                    *
+#*******************************************************************************
+
+class RenderMetrics( object ):
+    '''Collects live metrics of a TileProvider.
+
+    The render threads report finished layer tiles and the time they
+    were busy; the scene reports whether its viewport is completely
+    rendered. snapshot() combines them into a dict of plain values.
+
+    '''
+    def __init__( self, n_threads ):
+        self._lock = Lock()
+        self._n_threads = n_threads
+        self._latency = {}  # layer name -> LatencyHistogram
+        self._compute = {}  # layer name -> LatencyHistogram
+        self._busy = 0.
+        self._lastSnapshot = (time.time(), 0.)
+        self._viewportStart = None
+        self._viewport = LatencyHistogram()
+        self._lastViewport = None
+
+    def layerTileDone( self, layer, latency, computeTime ):
+        '''A layer tile of the named layer arrived latency seconds after
+        it was requested; computing it took computeTime seconds.'''
+        with self._lock:
+            if layer not in self._latency:
+                self._latency[layer] = LatencyHistogram()
+                self._compute[layer] = LatencyHistogram()
+            self._latency[layer].add(latency)
+            self._compute[layer].add(computeTime)
+
+    def meanComputeTimes( self ):
+        '''Return layer name -> mean compute time of its layer tiles.'''
+        with self._lock:
+            return dict((name, h.mean) for name, h in self._compute.items())
+
+    def workerBusy( self, seconds ):
+        with self._lock:
+            self._busy += seconds
+
+    def viewportRendered( self, complete ):
+        '''Report whether all tiles of the viewport are up to date.
+
+        The time from the first incomplete report to the next complete
+        one is recorded as time-to-complete-viewport.
+
+        '''
+        with self._lock:
+            if not complete:
+                if self._viewportStart is None:
+                    self._viewportStart = time.time()
+            elif self._viewportStart is not None:
+                self._lastViewport = time.time() - self._viewportStart
+                self._viewport.add(self._lastViewport)
+                self._viewportStart = None
+
+    def snapshot( self ):
+        '''Return the metrics as a dict.
+
+        utilization -- fraction of time the render threads were busy
+                       since the previous snapshot
+        layers      -- layer name -> {'latency' : LatencyHistogram,
+                                      'compute' : LatencyHistogram}
+        viewport    -- {'last' : seconds or None, 'pending' : bool,
+                        'histogram' : LatencyHistogram}
+
+        '''
+        with self._lock:
+            now = time.time()
+            last, lastBusy = self._lastSnapshot
+            self._lastSnapshot = (now, self._busy)
+            elapsed = (now - last) * self._n_threads
+            utilization = min(1., (self._busy - lastBusy) / elapsed) if elapsed > 0 else 0.
+            layers = dict((name, {'latency' : self._latency[name].copy(),
+                                  'compute' : self._compute[name].copy()})
+                          for name in self._latency)
+            return {'utilization' : utilization,
+                    'layers' : layers,
+                    'viewport' : {'last' : self._lastViewport,
+                                  'pending' : self._viewportStart is not None,
+                                  'histogram' : self._viewport.copy()}}
+
+def formatMetrics( metrics ):
+    '''Format the dict returned by TileProvider.metrics() as lines of text.'''
+    def ms( seconds ):
+        return '%d ms' % round(1000 * seconds)
+
+    queue = metrics['queue']
+    cache = metrics['cache']
+    lookups = cache['hits'] + cache['misses']
+    lines = ['queue: %d display, %d prefetch, %d running'
+             % (queue['display'], queue['prefetch'], queue['running']),
+             'workers: %d%% busy' % round(100 * metrics['utilization']),
+             'cache: %d%% hits, %d MiB, %d evictions'
+             % (round(100. * cache['hits'] / lookups) if lookups else 0,
+                cache['bytes'] // 2**20, cache['evictions'])]
+    viewport = metrics['viewport']
+    status = 'rendering' if viewport['pending'] else 'done'
+    if viewport['last'] is not None:
+        lines.append('viewport: %s, last took %s' % (status, ms(viewport['last'])))
+    else:
+        lines.append('viewport: %s' % status)
+    # slowest layers first
+    layers = sorted(metrics['layers'].items(), key=lambda item: -item[1]['latency'].mean)
+    for name, h in layers:
+        lines.append('%s: %s latency (90%%: %s), %s compute, %d tiles'
+                     % (name, ms(h['latency'].mean), ms(h['latency'].percentile(0.9)),
+                        ms(h['compute'].mean), h['latency'].count))
+    return lines
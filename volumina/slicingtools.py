@@ -76,19 +76,97 @@ def slicing2rect(slicing):
                  h.stop - h.start,
                  v.stop - v.start)
 
-def rect2slicing(qrect, seq=tuple):
-    result = seq((slice(qrect.x(), qrect.x() + qrect.width()),
-                  slice(qrect.y(), qrect.y() + qrect.height())))
+def rect2slicing(qrect, seq=tuple, step=None):
+    '''Convert a QRect to a 2d slicing.
+
+    step -- optional stride along both axes; a step of None or 1
+            gives a plain slicing
+
+    '''
+    step = step if step != 1 else None
+    result = seq((slice(qrect.x(), qrect.x() + qrect.width(), step),
+                  slice(qrect.y(), qrect.y() + qrect.height(), step)))
     return result
 
 def slicing2shape( slicing ):
+    '''Shape of the array obtained by applying the slicing.
+
+    Slice steps are honored, e.g. slice(0,10,3) has a length of 4.
+
+    '''
     assert is_bounded( slicing )
     slicing = box(slicing)
     shape = []
     for sl in slicing:
-        shape.append(sl.stop - sl.start)
+        step = sl.step if sl.step else 1
+        shape.append((sl.stop - sl.start + step - 1) // step)
     return tuple(shape)
 
+def is_strided( slicing ):
+    '''Test if any slice in the slicing has a step other than 1.'''
+    slicing = box(slicing)
+    return any((sl.step not in (None, 1) for sl in slicing))
+
+def unstrided( slicing ):
+    '''Split a slicing into its bounding slicing and the strides.
+
+    Returns (bounding, strides): 'bounding' covers the same region
+    without steps and 'strides' can be applied to an array read with
+    'bounding' to obtain the result of the original slicing.
+
+    '''
+    slicing = box(slicing)
+    bounding = tuple(slice(sl.start, sl.stop) for sl in slicing)
+    strides = tuple(slice(None, None, sl.step) for sl in slicing)
+    return bounding, strides
+
+def slicing_key( slicing ):
+    '''Hashable key of a slicing (slice objects are not hashable).'''
+    return tuple((sl.start, sl.stop, sl.step) for sl in box(slicing))
+
+def _merge_touching( pieces, axis, max_size ):
+    '''Merge pieces that touch along axis; all pieces must have
+    the same extent along the other axes.'''
+    pieces = sorted(pieces, key=lambda piece: piece[0][axis].start)
+    merged = [pieces[0]]
+    for slicing, parts in pieces[1:]:
+        last, lastParts = merged[-1]
+        a, b = last[axis], slicing[axis]
+        joined = list(last)
+        joined[axis] = slice(a.start, b.stop, a.step)
+        joined = tuple(joined)
+        if b.start == a.stop and b.step == a.step \
+           and (b.start - a.start) % (a.step or 1) == 0 \
+           and (max_size is None or np.prod(slicing2shape(joined)) <= max_size):
+            merged[-1] = (joined, lastParts + parts)
+        else:
+            merged.append((slicing, parts))
+    return merged
+
+def coalesce_slicings( slicings, max_size=None ):
+    '''Merge bounded 2d slicings of adjacent rectangles (e.g. the tiles
+    of a grid) into a few larger rectangles.
+
+    Rectangles are first joined into rows and the rows into blocks.
+    Only rectangles that touch and have the same step are merged, so
+    each merged rectangle is exactly covered by its parts. No merged
+    rectangle exceeds max_size elements, unless a single part does.
+
+    Returns a list of (merged, parts) pairs; every slicing is a part of
+    exactly one merged slicing.
+
+    '''
+    pieces = [(tuple(s), [tuple(s)]) for s in slicings]
+    assert all(is_bounded(piece[0]) and len(piece[0]) == 2 for piece in pieces)
+    for axis in (0, 1):
+        groups = {}
+        for piece in pieces:
+            groups.setdefault(slicing_key(piece[0][1 - axis]), []).append(piece)
+        pieces = []
+        for key in sorted(groups):
+            pieces.extend(_merge_touching(groups[key], axis, max_size))
+    return pieces
+
 def index2slice( slicing ):
     '''Convert integer indices to proper slice instances.
 
@@ -1,18 +1,25 @@
 import time
+import math
+import heapq
 import collections
 import warnings
+import weakref
+import multiprocessing
+from contextlib import contextmanager
 from collections import deque, defaultdict, OrderedDict
-from Queue import Queue, Empty, Full, LifoQueue, PriorityQueue
+from Queue import Empty, Full
 
-from threading import Thread, Event, Lock
+from threading import Thread, Event, Lock, Condition
 
-import numpy
 from PyQt4.QtCore import QRect, QRectF, QMutex, \
-    QPointF, Qt, QSizeF, QObject, pyqtSignal, \
+    QPointF, QLineF, Qt, QSize, QSizeF, QObject, pyqtSignal, \
     QThread, QEvent, QCoreApplication
 from PyQt4.QtGui import QImage, QPainter, QTransform
 
 from patchAccessor import PatchAccessor
+from renderMetrics import RenderMetrics
+from volumina.config import cfg
+from volumina.pixelpipeline.imagesources import UniformImage, uniformImage
 
 
 #*******************************************************************************
@@ -73,17 +80,32 @@ class Tiling(object):
     blockSize  -- base tile size: blockSize x blockSize (default 256)
     overlap    -- overlap between tiles positive number prevents rendering
                   artifacts between tiles for certain zoom levels (default 1)
+    downsample -- each tile covers blockSize*downsample data pixels
+                  along each axis, but its image has only blockSize
+                  pixels (default 1)
+    levels     -- number of levels in the resolution pyramid; level l
+                  is a Tiling with a downsample factor of 2**l
+                  (default 1, i.e. full resolution only)
 
     '''
 
+    @staticmethod
+    def pyramidDepth(sliceShape, blockSize=256):
+        '''Number of levels until a single tile covers the whole slice.'''
+        extent = max(sliceShape) if len(sliceShape) else 0
+        if extent <= blockSize:
+            return 1
+        return int(math.ceil(math.log(float(extent) / blockSize, 2))) + 1
+
     def __init__(self, sliceShape, data2scene=QTransform(),
                  blockSize=256, overlap=0, overlap_draw=1e-3,
-                 name="Unnamed Tiling"):
+                 name="Unnamed Tiling", downsample=1, levels=1):
         self.blockSize = blockSize
         self.overlap = overlap
+        self.downsample = downsample
         self._patchAccessor = PatchAccessor(sliceShape[0],
                                             sliceShape[1],
-                                            blockSize=self.blockSize)
+                                            blockSize=self.blockSize*downsample)
         self._overlap_draw = overlap_draw
         self._overlap = overlap
 
@@ -93,12 +115,37 @@ class Tiling(object):
         self.dataRectFs  = [None]*numPatches
         self.tileRectFs  = [None]*numPatches
         self.imageRects  = [None]*numPatches
+        self.imageSizes  = [None]*numPatches
         self.dataRects   = [None]*numPatches
         self.tileRects   = [None]*numPatches
         self.sliceShape  = sliceShape
         self.name = name
+
+        # coarser levels of the resolution pyramid; level 0 is self
+        self._levels = [self]
+        for l in range(1, levels):
+            self._levels.append(Tiling(sliceShape, data2scene, blockSize,
+                                       overlap, overlap_draw,
+                                       name="%s (level %d)" % (name, l),
+                                       downsample=downsample*2**l))
         self.data2scene = data2scene
 
+    @property
+    def levelCount(self):
+        return len(self._levels)
+
+    def level(self, l):
+        '''Tiling of pyramid level l (level 0 is the tiling itself).'''
+        return self._levels[l]
+
+    def levelForScale(self, scale):
+        '''Coarsest pyramid level that still has at least one image
+        pixel per device pixel at the given view scale.'''
+        if scale <= 0 or scale >= 1:
+            return 0
+        l = int(math.floor(math.log(1.0 / scale, 2)))
+        return max(0, min(l, self.levelCount - 1))
+
     @property
     def data2scene(self):
         return self._data2scene
@@ -109,6 +156,9 @@ class Tiling(object):
         self.scene2data, isInvertible = data2scene.inverted()
         assert isInvertible
 
+        for tiling in self._levels[1:]:
+            tiling.data2scene = data2scene
+
         for patchNr in range(self._patchAccessor.patchCount):
             # the patch accessor uses the data coordinate system.
             # because the patch is drawn on the screen, its holds coordinates
@@ -142,10 +192,17 @@ class Tiling(object):
                               round(imageRectF.width()),
                               round(imageRectF.height()))
 
+            # size of the tile's image in pixels; it is smaller than
+            # imageRect if the tiling is downsampled
+            d = self.downsample
+            imageSize = QSize(int(math.ceil(imageRect.width() / float(d))),
+                              int(math.ceil(imageRect.height() / float(d))))
+
             self.imageRectFs[patchNr] = imageRectF
             self.dataRectFs[ patchNr] = imageRectF
             self.tileRectFs[ patchNr] = patchRectF
             self.imageRects[ patchNr] = imageRect
+            self.imageSizes[ patchNr] = imageSize
             self.tileRects[  patchNr] = patchRect
 
 
@@ -167,11 +224,21 @@ class Tiling(object):
             return range(len(self.tileRects))
 
         # Patch accessor uses data coordinates
-        rect = self.data2scene.inverted()[0].mapRect(sceneRect)
-        patchNumbers = self._patchAccessor.getPatchesForRect(
-                            rect.topLeft().x(), rect.topLeft().y(),
-                            rect.bottomRight().x(), rect.bottomRight().y() )
-        return patchNumbers
+        return self.intersectedData(self.scene2data.mapRect(QRectF(sceneRect)))
+
+    def intersectedData(self, dataRect, margin=0):
+        '''Tiles intersecting with a rectangle in data coordinates.
+
+        The tiles are found by arithmetic on the block grid, so the
+        cost only depends on the number of intersecting tiles.
+
+        margin -- grow dataRect by this many pixels on each side
+
+        '''
+        rect = QRectF(dataRect).adjusted(-margin, -margin, margin, margin)
+        return self._patchAccessor.getPatchesForRect(
+                    rect.topLeft().x(), rect.topLeft().y(),
+                    rect.bottomRight().x(), rect.bottomRight().y() )
 
     def __len__(self):
         return len(self.imageRectFs)
@@ -194,32 +261,6 @@ class TiledImageLayer(object):
         for i in range(len(self._tiling)):
             yield self[i]
 
-class _MultiCache( object ):
-    def __init__( self, first_uid, default_factory=lambda:None,
-                  maxcaches=None ):
-        self._maxcaches = maxcaches
-        self.caches = OrderedDict()
-        self.add( first_uid, default_factory=default_factory)
-
-    def add( self, uid, default_factory=lambda:None ):
-        if uid not in self.caches:
-            cache = defaultdict(default_factory)
-            self.caches[uid] = cache
-        else:
-            raise Exception('MultiCache.add: uid %s is already in use' % str(uid))
-
-        # remove oldest cache, if necessary
-        old_uid = None
-        if self._maxcaches and len(self.caches) > self._maxcaches:
-            old_uid, v = self.caches.popitem(False) # removes item in LIFO order
-        return old_uid
-
-    def touch( self, uid ):
-        c = self.caches[uid]
-        del self.caches[uid]
-        self.caches[uid] = c
-
-
 from functools import wraps
 def synchronous( tlockname ):
     """A decorator to place an instance based lock around a method """
@@ -237,112 +278,1031 @@ def synchronous( tlockname ):
     return _synched
 
 
+def _imageBytes( img ):
+    # UniformImages are shared by many tiles and take no extra memory
+    if img is None or isinstance(img, UniformImage):
+        return 0
+    return img.byteCount()
+
+
+def _orientation( transform ):
+    '''The axis-aligned linear part of transform, which determines how
+    a layer tile rendered with it is oriented (see orient()).'''
+    return (transform.m11(), transform.m12(), transform.m21(), transform.m22())
+
+def _reoriented( img, old, new ):
+    '''Turn img, rendered in orientation old, into orientation new.'''
+    m11, m12, m21, m22 = old
+    t = QTransform(m11, m12, m21, m22, 0, 0).inverted()[0] * QTransform(*(new + (0, 0)))
+    if isinstance(img, UniformImage):
+        if t.m11() == 0:
+            shape = (img.width(), img.height())
+        else:
+            shape = (img.height(), img.width())
+        return uniformImage( img.copy(0, 0, 1, 1), shape )
+    return img.transformed(t)
+
+# layer id under which partial composites are accounted in a _TilesCache
+_PARTIAL = '_partial'
+
+class _PartialComposite( object ):
+    '''Composites of the layers below and above a pivot layer of a tile.
+
+    below -- the layers below the pivot painted on white
+    above -- the layers above the pivot painted on a transparent image
+    states -- layer states (see TileProvider._layerStates) the composites
+              were painted from
+
+    As long as only the state of the pivot layer changes, the tile is
+    repainted from these two images and the pivot layer.
+
+    '''
+    __slots__ = ('pivot', 'below', 'above', 'states')
+
+    def __init__( self, pivot, below, above, states ):
+        self.pivot = pivot
+        self.below = below
+        self.above = above
+        self.states = states
+
+    def matches( self, states ):
+        k = self.pivot
+        return len(states) == len(self.states) \
+               and states[:k] == self.states[:k] \
+               and states[k+1:] == self.states[k+1:]
+
+    def byteCount( self ):
+        return _imageBytes(self.below) + _imageBytes(self.above)
+
+
+class _StackCache( object ):
+    '''Tiles of a single stack; one shard of a _TilesCache.
+
+    Lookups are plain dictionary reads and never block. Compound
+    updates are serialized by the shard's own lock, so workers filling
+    different stacks do not contend with each other.
+
+    '''
+    def __init__( self ):
+        self.lock = Lock()
+        self.tiles = {}          # tile_id -> (img, progress)
+        self.tileClean = {}      # tile_id -> generation the tile was rendered in
+        self.layers = {}         # (layer_id, tile_id) -> img
+        self.layerDirty = {}     # (layer_id, tile_id) -> bool
+        self.layerTimestamp = {} # (layer_id, tile_id) -> float
+        self.layerOrientation = {} # (layer_id, tile_id) -> orientation of the img
+        self.tileStates = {}     # tile_id -> layer states of the last rendering
+        self.partials = {}       # tile_id -> _PartialComposite
+
+
 class _TilesCache( object ):
-    def __init__(self, first_stack_id, sims, maxstacks=None):
-        self._lock = Lock()
-        self._sims = sims
+    '''Cache of composited tiles and layer tiles, organized in stacks.
+
+    Arguments:
+    first_stack_id -- id of the initial stack
+    sims           -- StackedImageSources
+    maxstacks      -- maximal number of stacks; the least recently
+                      used stack is dropped as a whole (default: no limit)
+    maxbytes       -- byte budget for the cached images (default: no
+                      limit)
+
+    Every stack is a separate shard (see _StackCache). Reading tiles,
+    layer tiles, dirty flags and timestamps takes no lock, so the paint
+    path never waits for a worker that is inserting a freshly rendered
+    image. Only the byte accounting is global; it is updated after the
+    shard has been written.
+
+    When the budget is exceeded, single layer tiles, composited tiles
+    and partial composites (see _PartialComposite) are evicted. The
+    victim is chosen by the GreedyDual-Size policy: every entry gets a
+    priority of L + cost/size, where cost is the measured time it took
+    to compute the entry and L is the priority of the last evicted
+    entry. Cheap and big entries go first; among equally expensive
+    entries the least recently used one is evicted. Cache hits are
+    recorded in a lock-free buffer and applied to the priorities on the
+    next insertion.
+
+    A composited tile is clean if it was rendered in the current
+    generation of the cache. setAllTilesDirty() starts a new generation,
+    which marks every tile of every stack dirty in constant time.
 
-        kwargs = {'first_uid' : first_stack_id,
-                  'maxcaches' : maxstacks}
-        self._tileCache = _MultiCache(default_factory=lambda: (None, 0.), **kwargs)
-        self._tileCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
-        self._layerCache = _MultiCache(**kwargs)
-        self._layerCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
-        self._layerCacheTimestamp = _MultiCache(default_factory=float, **kwargs)
+    '''
+    def __init__(self, first_stack_id, sims, maxstacks=None, maxbytes=None):
+        self._sims = sims
+        self._maxstacks = maxstacks
+        self._maxbytes = maxbytes
+
+        self._generation = 0
+        # image sources that are visible and not occluded; computed
+        # on demand after every change of the generation
+        self._contributing = None
+
+        # lookups only use the plain dict; the LRU order of the stacks
+        # is maintained separately
+        self._stacks = {}
+        self._stackOrder = OrderedDict()
+        self._stacksLock = Lock()
+
+        # byte accounting and eviction bookkeeping
+        # entry key: (stack_id, layer_id, tile_id); layer_id is None
+        # for composited tiles and _PARTIAL for partial composites
+        self._accountLock = Lock()
+        self._bytes = 0
+        self._entries = {}    # key -> (nbytes, cost, priority, img)
+        self._stackEntries = defaultdict(set)
+        self._heap = []
+        self._inflation = 0.
+        self._seq = 0
+        self._accessed = deque(maxlen=4096)
+
+        # hits and misses are counted without locking and may be
+        # slightly off under concurrent access
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        self.addStack( first_stack_id )
 
-    @synchronous('_lock')
     def __contains__( self, stack_id ):
-        return stack_id in self._tileCache.caches
+        return stack_id in self._stacks
 
-    @synchronous('_lock')
     def __len__( self ):
-        return len(self._tileCache.caches)
+        return len(self._stacks)
+
+    @synchronous('_accountLock')
+    def stats( self ):
+        '''Return a dict with cache hits, misses, evictions, and the
+        current and maximal number of cached bytes.'''
+        return {'hits' : self._hits,
+                'misses' : self._misses,
+                'evictions' : self._evictions,
+                'bytes' : self._bytes,
+                'maxbytes' : self._maxbytes}
 
-    @synchronous('_lock')
     def tile( self, stack_id, tile_id ):
-        return self._tileCache.caches[stack_id][tile_id]
-    @synchronous('_lock')
-    def setTile( self, stack_id, tile_id, img, stack_visible, stack_occluded ):
-        if len(stack_visible) > 0:
-            visible = numpy.asarray(stack_visible)
-            occluded = numpy.asarray(stack_occluded)
-            visibleAndNotOccluded = numpy.logical_and(visible, numpy.logical_not(occluded))
-            if numpy.count_nonzero(visibleAndNotOccluded) > 0:
-                dirty = numpy.asarray([self._layerCacheDirty.caches[stack_id][(ims, tile_id)]
-                                       for ims in self._sims.viewImageSources()])
-                num = numpy.count_nonzero(numpy.logical_and(dirty, visibleAndNotOccluded) == True)
-                denom = float(numpy.count_nonzero(visibleAndNotOccluded))
-                progress = 1.0 - num / denom
-            else:
-                progress = 1.0
+        img, progress = self._stacks[stack_id].tiles.get(tile_id, (None, 0.))
+        self._countLookup( (stack_id, None, tile_id), img )
+        return img, progress
+    def tileProgress( self, stack_id, tile_id ):
+        '''Like tile(), but only returns the progress and does not count
+        as a cache lookup.'''
+        return self._stacks[stack_id].tiles.get(tile_id, (None, 0.))[1]
+    def setTile( self, stack_id, tile_id, img, cost=0. ):
+        shard = self._stacks[stack_id]
+        # progress: fraction of the contributing layers that are done
+        contributing = self._contributingLayers()
+        if contributing:
+            layerDirty = shard.layerDirty
+            num = sum(1 for ims in contributing if layerDirty.get((ims, tile_id), True))
+            progress = 1.0 - num / float(len(contributing))
         else:
             progress = 1.0
-        self._tileCache.caches[stack_id][tile_id] = (img, progress)
+        with shard.lock:
+            shard.tiles[tile_id] = (img, progress)
+        self._account( (stack_id, None, tile_id), img, cost )
 
-    @synchronous('_lock')
     def tileDirty( self, stack_id, tile_id ):
-        return self._tileCacheDirty.caches[stack_id][tile_id]
-    @synchronous('_lock')
+        return self._stacks[stack_id].tileClean.get(tile_id) != self._generation
     def setTileDirty( self, stack_id, tile_id, b):
-        self._tileCacheDirty.caches[stack_id][tile_id] = b
-    @synchronous('_lock')
+        self._stacks[stack_id].tileClean[tile_id] = None if b else self._generation
     def setTileDirtyAll( self, tile_id, b):
-        for stack_id in self._tileCacheDirty.caches:
-            self._tileCacheDirty.caches[stack_id][tile_id] = b
+        for shard in self._stacks.values():
+            shard.tileClean[tile_id] = None if b else self._generation
+    def setTilesDirtyAll( self, tile_ids, b ):
+        '''Like setTileDirtyAll(), for many tiles at once.'''
+        flags = dict.fromkeys(tile_ids, None if b else self._generation)
+        for shard in self._stacks.values():
+            shard.tileClean.update(flags)
+    def setAllTilesDirty( self ):
+        '''Mark all tiles of all stacks dirty in constant time.
+
+        Has to be called whenever the visibility, opacity, occlusion or
+        order of the layers changes.
+
+        '''
+        self._generation += 1
+        self._contributing = None
+
+    def _contributingLayers( self ):
+        contributing = self._contributing
+        if contributing is None:
+            contributing = [ims for ims, visible, occluded
+                            in zip(self._sims.viewImageSources(),
+                                   self._sims.viewVisible(),
+                                   self._sims.viewOccluded())
+                            if visible and not occluded]
+            self._contributing = contributing
+        return contributing
 
-    @synchronous('_lock')
     def layer(self, stack_id, layer_id, tile_id ):
-        return self._layerCache.caches[stack_id][(layer_id,tile_id)]
-    @synchronous('_lock')
-    def setLayer( self, stack_id, layer_id, tile_id, img ):
-        self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
+        img = self._stacks[stack_id].layers.get((layer_id, tile_id))
+        self._countLookup( (stack_id, layer_id, tile_id), img )
+        return img
+    def setLayer( self, stack_id, layer_id, tile_id, img, cost=0. ):
+        shard = self._stacks[stack_id]
+        with shard.lock:
+            shard.layers[(layer_id, tile_id)] = img
+        self._account( (stack_id, layer_id, tile_id), img, cost )
+
+    def layerOrientation( self, stack_id, layer_id, tile_id ):
+        return self._stacks[stack_id].layerOrientation.get((layer_id, tile_id))
+    def reorientLayer( self, stack_id, layer_id, tile_id, old, img, orientation ):
+        '''Replace the layer tile old by img, the same tile turned into
+        another orientation, unless a new layer tile arrived meanwhile.'''
+        shard = self._stacks[stack_id]
+        key = (layer_id, tile_id)
+        with shard.lock:
+            if shard.layers.get(key) is not old:
+                return
+            shard.layers[key] = img
+            shard.layerOrientation[key] = orientation
+        with self._accountLock:
+            entry = self._entries.get((stack_id, layer_id, tile_id))
+        # the tile keeps the cost of computing it
+        cost = entry[1] if entry is not None else 0.
+        self._account( (stack_id, layer_id, tile_id), img, cost )
 
-    @synchronous('_lock')
     def layerDirty(self, stack_id, layer_id, tile_id ):
-        return self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)]
-    @synchronous('_lock')
+        return self._stacks[stack_id].layerDirty.get((layer_id, tile_id), True)
     def setLayerDirty( self, stack_id, layer_id, tile_id, b ):
-        self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
-    @synchronous('_lock')
+        self._stacks[stack_id].layerDirty[(layer_id, tile_id)] = b
     def setLayerDirtyAll( self, layer_id, tile_id, b ):
-        for stack_id in self._layerCacheDirty.caches:
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
+        for shard in self._stacks.values():
+            shard.layerDirty[(layer_id, tile_id)] = b
+    def setLayersDirtyAll( self, layer_ids, tile_ids, b ):
+        '''Like setLayerDirtyAll(), for all combinations of many layers
+        and tiles at once.'''
+        flags = dict.fromkeys([(layer_id, tile_id) for layer_id in layer_ids
+                                                   for tile_id in tile_ids], b)
+        for shard in self._stacks.values():
+            shard.layerDirty.update(flags)
 
-    @synchronous('_lock')
     def layerTimestamp(self, stack_id, layer_id, tile_id ):
-        return self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]
-    @synchronous('_lock')
+        return self._stacks[stack_id].layerTimestamp.get((layer_id, tile_id), 0.)
     def setLayerTimestamp( self, stack_id, layer_id, tile_id, time):
-        self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = time
+        self._stacks[stack_id].layerTimestamp[(layer_id, tile_id)] = time
+
+    def tileStates( self, stack_id, tile_id ):
+        return self._stacks[stack_id].tileStates.get(tile_id)
+    def setTileStates( self, stack_id, tile_id, states ):
+        self._stacks[stack_id].tileStates[tile_id] = states
+
+    def partialComposite( self, stack_id, tile_id ):
+        partial = self._stacks[stack_id].partials.get(tile_id)
+        if partial is not None:
+            self._countLookup( (stack_id, _PARTIAL, tile_id), partial )
+        return partial
+    def setPartialComposite( self, stack_id, tile_id, partial, cost=0. ):
+        shard = self._stacks[stack_id]
+        with shard.lock:
+            shard.partials[tile_id] = partial
+        self._account( (stack_id, _PARTIAL, tile_id), partial, cost )
+    def dropPartialComposites( self ):
+        '''Drop the partial composites of all stacks.'''
+        for stack_id, shard in self._stacks.items():
+            with shard.lock:
+                tile_ids = list(shard.partials)
+                shard.partials.clear()
+            for tile_id in tile_ids:
+                self._account( (stack_id, _PARTIAL, tile_id), None, 0. )
 
-    @synchronous('_lock')
     def addStack( self, stack_id ):
-        self._tileCache.add( stack_id )
-        self._tileCacheDirty.add( stack_id, default_factory=lambda:True )
-        self._layerCache.add( stack_id )
-        self._layerCacheDirty.add( stack_id, default_factory=lambda:True )
-        self._layerCacheTimestamp.add( stack_id, default_factory=float )
+        old_id = None
+        with self._stacksLock:
+            if stack_id in self._stacks:
+                raise Exception('_TilesCache.addStack: stack %s is already in use' % str(stack_id))
+            self._stacks[stack_id] = _StackCache()
+            self._stackOrder[stack_id] = None
+            # remove least recently used stack, if necessary
+            if self._maxstacks and len(self._stacks) > self._maxstacks:
+                old_id, _ = self._stackOrder.popitem(False)
+                del self._stacks[old_id]
+        if old_id is not None:
+            self._forgetStack( old_id )
 
-    @synchronous('_lock')
     def touchStack( self, stack_id ):
-        self._tileCache.touch( stack_id )
-        self._tileCacheDirty.touch( stack_id )
-        self._layerCache.touch( stack_id )
-        self._layerCacheDirty.touch( stack_id )
-        self._layerCacheTimestamp.touch( stack_id )
+        with self._stacksLock:
+            del self._stackOrder[stack_id]
+            self._stackOrder[stack_id] = None
 
-    @synchronous('_lock')
     def updateTileIfNecessary( self, stack_id, layer_id, tile_id,
-                               req_timestamp, img):
-        if req_timestamp > self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]:
-            self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = False
-            self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = req_timestamp
-            self._tileCacheDirty.caches[stack_id][tile_id] = True
+                               req_timestamp, img, cost=0., orientation=None ):
+        '''Store a layer tile unless a newer request already did.
+
+        cost        -- time in seconds it took to compute img; expensive
+                       entries are kept longer when the byte budget is
+                       exceeded
+        orientation -- orientation img was rendered in (see
+                       _orientation())
+
+        '''
+        shard = self._stacks[stack_id]
+        key = (layer_id, tile_id)
+        with shard.lock:
+            if req_timestamp <= shard.layerTimestamp.get(key, 0.):
+                return
+            shard.layers[key] = img
+            shard.layerOrientation[key] = orientation
+            shard.layerDirty[key] = False
+            shard.layerTimestamp[key] = req_timestamp
+            shard.tileClean[tile_id] = None
+        self._account( (stack_id, layer_id, tile_id), img, cost )
+
+    ##
+    ## byte accounting
+    ##
+    ## Lock order: the account lock may be held while taking a shard
+    ## lock (eviction), never the other way round.
+    ##
+    def _countLookup( self, key, img ):
+        if img is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+            self._accessed.append(key)
+
+    @synchronous('_accountLock')
+    def _account( self, key, img, cost ):
+        self._applyAccesses()
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[0]
+            self._stackEntries[key[0]].discard(key)
+        nbytes = _imageBytes(img)
+        if nbytes == 0 or key[0] not in self._stacks:
+            return
+        self._bytes += nbytes
+        self._stackEntries[key[0]].add(key)
+        self._push( key, nbytes, cost, img )
+        self._evictIfNecessary( protect=key )
+
+    def _applyAccesses( self ):
+        # a hit restores the priority of the entry
+        while self._accessed:
+            key = self._accessed.popleft()
+            entry = self._entries.get(key)
+            if entry is not None:
+                nbytes, cost, priority, img = entry
+                self._push( key, nbytes, cost, img )
+
+    def _push( self, key, nbytes, cost, img ):
+        priority = self._inflation + float(cost) / nbytes
+        self._entries[key] = (nbytes, cost, priority, img)
+        self._seq += 1
+        heapq.heappush(self._heap, (priority, self._seq, key))
+        if len(self._heap) > 4 * len(self._entries) + 64:
+            # drop stale items left behind by re-prioritized entries
+            self._heap = [(e[2], i, k) for i, (k, e) in enumerate(self._entries.iteritems())]
+            heapq.heapify(self._heap)
+
+    def _evictIfNecessary( self, protect=None ):
+        if self._maxbytes is None:
+            return
+        deferred = None
+        while self._bytes > self._maxbytes and self._heap:
+            item = heapq.heappop(self._heap)
+            priority, seq, key = item
+            entry = self._entries.get(key)
+            if entry is None or entry[2] != priority:
+                continue # stale heap item
+            if key == protect:
+                # never evict the entry that is just being inserted
+                deferred = item
+                continue
+            self._inflation = priority
+            self._evict( key )
+        if deferred is not None:
+            heapq.heappush(self._heap, deferred)
+
+    def _evict( self, key ):
+        stack_id, layer_id, tile_id = key
+        nbytes, cost, priority, img = self._entries.pop(key)
+        self._bytes -= nbytes
+        self._stackEntries[stack_id].discard(key)
+        self._evictions += 1
+
+        shard = self._stacks.get(stack_id)
+        if shard is None:
+            return
+        with shard.lock:
+            # a worker may have replaced the image in the meantime;
+            # the new image is accounted separately
+            if layer_id is None:
+                if shard.tiles.get(tile_id, (None,))[0] is img:
+                    shard.tiles[tile_id] = (None, 0.)
+                    shard.tileClean[tile_id] = None
+            elif layer_id is _PARTIAL:
+                if shard.partials.get(tile_id) is img:
+                    del shard.partials[tile_id]
+            elif shard.layers.get((layer_id, tile_id)) is img:
+                shard.layers[(layer_id, tile_id)] = None
+                shard.layerDirty[(layer_id, tile_id)] = True
+
+    @synchronous('_accountLock')
+    def _forgetStack( self, stack_id ):
+        for key in self._stackEntries.pop(stack_id, ()):
+            self._bytes -= self._entries.pop(key)[0]
+
+
+class _LayerTileRequest( object ):
+    '''A pending request for the image of one layer tile.'''
+    __slots__ = ('ims', 'tile_nr', 'stack_id', 'image_req',
+                 'timestamp', 'cache', 'level', 'prefetch', 'priority',
+                 'orientation')
+
+    def __init__( self, ims, tile_nr, stack_id, image_req,
+                  timestamp, cache, level, prefetch, orientation=None ):
+        self.ims = ims
+        self.tile_nr = tile_nr
+        self.stack_id = stack_id
+        self.image_req = image_req
+        self.timestamp = timestamp
+        self.cache = cache
+        self.level = level
+        self.prefetch = prefetch
+        self.priority = 0.
+        self.orientation = orientation
+
+
+class _RenderQueue( object ):
+    '''Priority queue of _LayerTileRequests.
+
+    Requests with a smaller priority are served first; among equal
+    priorities the most recent request wins. Priorities of waiting
+    requests can be changed with reprioritize().
+
+    Like Queue.Queue, every get() has to be matched by a task_done().
+    join() only waits for display requests, not for prefetch requests.
+
+    Consumers block in get() without polling until a request arrives or
+    the queue is closed. Alternatively, a RenderExecutor serving many
+    queues is told about new requests by the onPut callback.
+
+    '''
+    def __init__( self, maxsize=0, onPut=None ):
+        self.maxsize = maxsize
+        self.onPut = onPut
+        self._mutex = Lock()
+        self._notEmpty = Condition(self._mutex)
+        self._displayDone = Condition(self._mutex)
+        self._heap = []
+        self._seq = 0
+        self._unfinishedDisplay = 0
+        self._closed = False
+
+    def qsize( self ):
+        with self._mutex:
+            return len(self._heap)
+
+    def depths( self ):
+        '''Return the numbers of waiting display and prefetch requests.'''
+        with self._mutex:
+            prefetch = sum(1 for item in self._heap if item[2].prefetch)
+            return len(self._heap) - prefetch, prefetch
+
+    def put( self, req ):
+        with self._mutex:
+            closed = self._closed
+            if not closed:
+                if self.maxsize > 0 and len(self._heap) >= self.maxsize:
+                    raise Full
+                self._push( req )
+                if not req.prefetch:
+                    self._unfinishedDisplay += 1
+                self._notEmpty.notify()
+        if closed:
+            req.image_req.cancel()
+        elif self.onPut is not None:
+            self.onPut()
+
+    def peek( self ):
+        '''Return the most urgent request without removing it, or None.'''
+        with self._mutex:
+            if self._closed or not self._heap:
+                return None
+            return self._heap[0][2]
+
+    def get( self, timeout=None ):
+        '''Remove and return the most urgent request.
+
+        Blocks until a request is available; with a timeout, raises
+        Empty if none arrived in time. Returns None once the queue
+        has been closed.
+
+        '''
+        with self._mutex:
+            if timeout is None:
+                # an untimed wait blocks on a lock instead of polling
+                while not self._heap and not self._closed:
+                    self._notEmpty.wait()
+            elif not self._heap and not self._closed:
+                self._notEmpty.wait(timeout)
+            if self._closed:
+                return None
+            if not self._heap:
+                raise Empty
+            return heapq.heappop(self._heap)[2]
+
+    def close( self ):
+        '''Drop all waiting requests and wake up all blocked threads.
+
+        Afterwards get() returns None and put() is ignored. The image
+        requests of dropped requests are cancelled.
+
+        '''
+        with self._mutex:
+            self._closed = True
+            dropped = [item[2] for item in self._heap]
+            self._heap = []
+            self._unfinishedDisplay = 0
+            self._notEmpty.notify_all()
+            self._displayDone.notify_all()
+        for req in dropped:
+            req.image_req.cancel()
+
+    def task_done( self, req ):
+        if req.prefetch:
+            return
+        with self._mutex:
+            self._finishDisplay( 1 )
+
+    def join( self ):
+        with self._mutex:
+            while self._unfinishedDisplay:
+                self._displayDone.wait()
+
+    def discard( self, predicate ):
+        '''Remove all waiting requests for which predicate(req) is True.
+
+        The image requests of the removed requests are cancelled.
+
+        '''
+        with self._mutex:
+            keep = []
+            dropped = []
+            for item in self._heap:
+                if not predicate(item[2]):
+                    keep.append(item)
+                else:
+                    dropped.append(item[2])
+            if dropped:
+                self._heap = keep
+                heapq.heapify(self._heap)
+                self._finishDisplay( sum(1 for req in dropped if not req.prefetch) )
+        for req in dropped:
+            req.image_req.cancel()
+        return len(dropped)
+
+    def reprioritize( self, priority ):
+        '''Recompute the priorities of all waiting requests.
+
+        priority -- function that maps a request to its new priority
+
+        Changes are passed on to the image requests via adjustPriority()
+        so that backends with their own scheduling follow suit.
+
+        '''
+        with self._mutex:
+            heap = self._heap
+            self._heap = []
+            for item in heap:
+                req = item[2]
+                new = priority(req)
+                if new != req.priority:
+                    req.image_req.adjustPriority(new - req.priority)
+                    req.priority = new
+                heapq.heappush(self._heap, (req.priority, item[1], req))
+
+    def _push( self, req ):
+        self._seq += 1
+        # negative sequence number: LIFO among equal priorities
+        heapq.heappush(self._heap, (req.priority, -self._seq, req))
+
+    def _finishDisplay( self, n ):
+        if n == 0:
+            return
+        self._unfinishedDisplay -= n
+        if self._unfinishedDisplay <= 0:
+            self._unfinishedDisplay = 0
+            self._displayDone.notify_all()
+
+
+class _SharedImageRequest( object ):
+    '''An image request that several TileProviders may wait for.
+
+    The image is computed by the first waiter; the others get the same
+    QImage. Every user holds its own _SharedImageUser. The wrapped
+    request is only cancelled when all users cancelled it, and it
+    follows the priority of its most urgent user.
+
+    '''
+    def __init__( self, registry, key, request ):
+        self.key = key
+        self.users = 1
+        self.nbytes = 0
+        self.cancelled = False
+        self._registry = registry
+        self._request = request
+        self._lock = Lock()
+        self._priorityLock = Lock()
+        self._priorities = {} # user -> priority
+        self._img = None
+
+    def user( self ):
+        '''A new handle for one user (see LayerTileRegistry.request()).'''
+        user = _SharedImageUser( self )
+        self._setPriority( user, 0. )
+        return user
+
+    def wait( self ):
+        with self._lock:
+            if self._img is None:
+                self._img = self._request.wait()
+                self._registry._finished( self )
+        return self._img
+
+    def _cancel( self, user ):
+        self._setPriority( user, None )
+        if self._registry._release( self ):
+            self._request.cancel()
+
+    def _setPriority( self, user, priority ):
+        '''Set the priority of user (None removes it) and pass the
+        change of the effective, i.e. smallest, priority on.'''
+        with self._priorityLock:
+            old = min(self._priorities.values()) if self._priorities else 0.
+            if priority is None:
+                self._priorities.pop( user, None )
+            else:
+                self._priorities[user] = priority
+            if not self._priorities:
+                return
+            new = min(self._priorities.values())
+            if new != old:
+                self._request.adjustPriority( new - old )
+
+    @property
+    def finished( self ):
+        return self._img is not None
+
+class _SharedImageUser( object ):
+    '''One user's handle on a _SharedImageRequest.'''
+    def __init__( self, shared ):
+        self.shared = shared
+        self.priority = 0.
+        self._cancelled = False
+
+    def wait( self ):
+        return self.shared.wait()
+
+    def notify( self, callback, **kwargs ):
+        t = Thread(target=lambda: callback(self.wait(), **kwargs))
+        t.start()
+
+    def cancel( self ):
+        if not self._cancelled:
+            self._cancelled = True
+            self.shared._cancel( self )
+
+    def adjustPriority( self, delta ):
+        if not self._cancelled:
+            self.priority += delta
+            self.shared._setPriority( self, self.priority )
+
+    @property
+    def cancelled( self ):
+        return self.shared.cancelled
+
+    @property
+    def finished( self ):
+        return self.shared.finished
+
+
+class LayerTileRegistry( object ):
+    '''Process-wide registry of layer tiles shared between TileProviders.
+
+    Editors showing the same data (see ImageSource.sharingKey()) at the
+    same position need the same layer tiles. The first TileProvider
+    that asks for a tile creates the image request, the others get the
+    same _SharedImageRequest, so the tile is computed once and all
+    caches hold the same QImage. Finished tiles stay in the registry
+    within a byte budget (least recently used ones are dropped first),
+    so that scenes and editors opened later find them as well.
+
+    '''
+    def __init__( self, maxbytes, maxpending=4096 ):
+        '''maxbytes   -- budget of the finished tiles
+        maxpending -- number of pending requests that can be shared;
+                      the least recently used ones are forgotten (but
+                      not cancelled) beyond that'''
+        self.maxbytes = maxbytes
+        self.maxpending = maxpending
+        self._lock = Lock()
+        self._entries = OrderedDict()  # key -> _SharedImageRequest, least recently used first
+        self._pending = OrderedDict()  # the unfinished subset of _entries, same order
+        self._bySource = defaultdict(set)  # sharing key of the image source -> keys
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def __len__( self ):
+        return len(self._entries)
+
+    def stats( self ):
+        with self._lock:
+            return {'hits' : self._hits, 'misses' : self._misses,
+                    'entries' : len(self._entries), 'bytes' : self._bytes,
+                    'maxbytes' : self.maxbytes}
+
+    def request( self, ims, through, dataRect, downsample=1, transform=None ):
+        '''Return a handle on a shared request for a layer tile of ims
+        (see ImageSource.request()) or None if ims does not share its
+        tiles.'''
+        if not self.maxbytes:
+            return None
+        sourceKey = ims.sharingKey()
+        if sourceKey is None:
+            return None
+        t = transform
+        key = (sourceKey, tuple(through) if through is not None else None,
+               (dataRect.x(), dataRect.y(), dataRect.width(), dataRect.height()), downsample,
+               (t.m11(), t.m12(), t.m21(), t.m22(), t.dx(), t.dy()) if t is not None else None)
+        try:
+            shared = self._lookup( key )
+        except TypeError:
+            # unhashable key
+            return None
+        if shared is not None:
+            return shared.user()
+        candidate = _SharedImageRequest( self, key, ims.request(dataRect, through, downsample, transform) )
+        with self._lock:
+            shared = self._entries.get(key)
+            if shared is not None and not shared.cancelled:
+                # someone else was faster; our request has not started yet
+                shared.users += 1
+                return shared.user()
+            self._entries[key] = candidate
+            self._pending[key] = candidate
+            self._bySource[sourceKey].add(key)
+            while len(self._pending) > self.maxpending:
+                self._remove( next(iter(self._pending)) )
+        return candidate.user()
+
+    def _lookup( self, key ):
+        with self._lock:
+            shared = self._entries.pop(key, None)
+            if shared is None:
+                self._misses += 1
+                return None
+            self._entries[key] = shared
+            if self._pending.pop(key, None) is not None:
+                self._pending[key] = shared
+            self._hits += 1
+            shared.users += 1
+            return shared
+
+    def invalidate( self, ims, dataRect ):
+        '''Forget the tiles of ims intersecting dataRect (all of them if
+        dataRect is invalid).'''
+        sourceKey = ims.sharingKey()
+        if sourceKey is None:
+            return
+        with self._lock:
+            try:
+                keys = list(self._bySource.get(sourceKey, ()))
+            except TypeError:
+                return
+            for key in keys:
+                if not dataRect.isValid() or QRect(*key[2]).intersects(dataRect):
+                    self._remove( key )
+
+    def clear( self ):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove( key )
+
+    def _finished( self, shared ):
+        with self._lock:
+            if self._entries.get(shared.key) is not shared:
+                return
+            self._pending.pop(shared.key, None)
+            shared.nbytes = _imageBytes(shared._img)
+            self._bytes += shared.nbytes
+            for key, entry in list(self._entries.items()):
+                if self._bytes <= self.maxbytes:
+                    break
+                # pending requests are never dropped; they cost nothing
+                if entry.finished and entry is not shared:
+                    self._remove( key )
+
+    def _release( self, shared ):
+        '''One user cancelled shared; returns True if it was the last.'''
+        with self._lock:
+            shared.users -= 1
+            if shared.users > 0 or shared.finished:
+                return False
+            shared.cancelled = True
+            if self._entries.get(shared.key) is shared:
+                self._remove( shared.key )
+            return True
+
+    def _remove( self, key ):
+        shared = self._entries.pop(key)
+        self._pending.pop(key, None)
+        self._bytes -= shared.nbytes
+        keys = self._bySource.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._bySource[key[0]]
+
+_registry = None
+_registryLock = Lock()
+
+def layerTileRegistry():
+    '''Return the LayerTileRegistry shared by all TileProviders.
+
+    Its byte budget is the 'shared_tiles_mb' option of the 'tiling'
+    section; 0 disables sharing.
+
+    '''
+    global _registry
+    with _registryLock:
+        if _registry is None:
+            _registry = LayerTileRegistry(int(cfg.getfloat('tiling', 'shared_tiles_mb') * 2**20))
+        return _registry
+
+
+#*******************************************************************************
+# R e n d e r E x e c u t o r                                                  *
+#*******************************************************************************
+
+class _ExecutorEntry( object ):
+    __slots__ = ('provider', 'owner', 'served')
+
+    def __init__( self, provider, owner ):
+        self.provider = provider
+        # weak, so that the executor does not keep a closed scene alive
+        self.owner = weakref.ref(owner) if owner is not None else None
+        self.served = 0
+
+    @property
+    def orphaned( self ):
+        return self.owner is not None and self.owner() is None
+
+class RenderExecutor( object ):
+    '''Render threads shared by many TileProviders.
+
+    Every TileProvider created with an executor registers its render
+    queue instead of starting threads of its own. The threads serve
+    display requests before prefetch requests. Among queues whose most
+    urgent requests are of the same kind, the queue of the focused
+    owner (see setFocus()) comes first, and the others take turns, so
+    that a busy view cannot starve the others.
+
+    '''
+    def __init__( self, n_threads ):
+        self.n_threads = n_threads
+        self._cond = Condition(Lock())
+        self._entries = {}  # id(provider) -> _ExecutorEntry
+        self._focus = None  # weak reference to the focused owner
+        self._seq = 0
+        self._closed = False
+        self._threads = [Thread(target=self._worker) for i in range(n_threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def register( self, provider, owner=None ):
+        '''Serve the render queue of provider.
+
+        owner -- object the provider renders for (e.g. its scene);
+                 compared with the owner passed to setFocus(). Only a
+                 weak reference is kept; once the owner is gone, the
+                 provider is stopped and unregistered.
+
+        Call unregister() (or TileProvider.notifyThreadsToStop()) when
+        the provider is not needed anymore.
+
+        '''
+        with self._cond:
+            self._entries[id(provider)] = _ExecutorEntry(provider, owner)
+            self._cond.notify_all()
+
+    def unregister( self, provider ):
+        with self._cond:
+            self._entries.pop(id(provider), None)
+
+    def setFocus( self, owner ):
+        '''Serve the providers of owner first, e.g. the view that has
+        the keyboard focus.'''
+        with self._cond:
+            self._focus = weakref.ref(owner) if owner is not None else None
+
+    def wake( self ):
+        '''Tell the threads that a request has arrived.'''
+        with self._cond:
+            self._cond.notify()
+
+    def close( self ):
+        '''Let the threads terminate after their current request.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def join( self, timeout=None ):
+        for thread in self._threads:
+            thread.join( timeout )
+
+    def _pick( self ):
+        focus = self._focus() if self._focus is not None else None
+        while True:
+            best = None
+            for key, entry in self._entries.items():
+                if entry.orphaned:
+                    # the owner was collected without stopping its provider
+                    del self._entries[key]
+                    entry.provider._renderQueue.close()
+                    continue
+                head = entry.provider._renderQueue.peek()
+                if head is None:
+                    continue
+                focused = focus is not None and entry.owner is not None \
+                          and entry.owner() is focus
+                rank = (head.prefetch, not focused, entry.served)
+                if best is None or rank < best[0]:
+                    best = (rank, entry)
+            if best is None:
+                return None
+            entry = best[1]
+            try:
+                req = entry.provider._renderQueue.get( 0 )
+            except Empty:
+                # discarded meanwhile
+                continue
+            if req is None:
+                # closed meanwhile
+                continue
+            self._seq += 1
+            entry.served = self._seq
+            return entry.provider, req
+
+    def _worker( self ):
+        while True:
+            with self._cond:
+                picked = None
+                while not self._closed:
+                    picked = self._pick()
+                    if picked is not None:
+                        break
+                    self._cond.wait()
+                if picked is None:
+                    return
+            provider, req = picked
+            provider._serve( req )
+
+_executor = None
+_executorLock = Lock()
+
+def renderExecutor():
+    '''Return the RenderExecutor shared by the TileProviders of all
+    views.
+
+    The number of threads is the 'render_threads' option of the
+    'tiling' section; 0 chooses it from the number of cores and of
+    conversion processes.
+
+    '''
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            n_threads = cfg.getint('tiling', 'render_threads')
+            if n_threads <= 0:
+                # render threads mostly wait for data and for the
+                # conversion processes; have enough of them to keep
+                # all cores and processes busy
+                n_threads = max(2, multiprocessing.cpu_count(),
+                                cfg.getint('pixelpipeline', 'conversion_processes'))
+            _executor = RenderExecutor(n_threads)
+        return _executor
+
+
+class _InFlightRequest( object ):
+    '''An image request that a render thread is waiting for.'''
+    def __init__( self, stack_id, request, prefetch ):
+        self.stack_id = stack_id
+        self.request = request
+        self.prefetch = prefetch
+        self.cancelled = False
 
 
 class TileProvider( QObject ):
-    THREAD_HEARTBEAT = 0.2
+    # Render priorities; requests with smaller priorities are served
+    # first. Within a class of requests, tiles are ordered by their
+    # distance (in tiles) to the priority center, see setPriorityCenter().
+    PRIORITY_PREFETCH = 1e6 # prefetch after all display requests
+    PRIORITY_SLICE = 1e3    # per slice between prefetched and current slice
+    PRIORITY_HIDDEN = 1e9   # layer became invisible or occluded meanwhile
 
     Tile = collections.namedtuple('Tile', 'id qimg rectF progress tiling')
     sceneRectChanged = pyqtSignal( QRectF )
@@ -360,8 +1320,26 @@ class TileProvider( QObject ):
                                  to the pixelpipeline (default: 2)
     layerIdChange_means_dirty -- layerId changes invalidate the cache; by default only
                                  stackId changes do that (default False)
+    cache_bytes               -- byte budget for cached tile images; it is divided
+                                 among the pyramid levels in proportion to their
+                                 image sizes (default None, i.e. unlimited)
+    registry                  -- LayerTileRegistry to share layer tiles with other
+                                 TileProviders (default: layerTileRegistry())
+    executor                  -- RenderExecutor whose threads render the layer tiles
+                                 instead of n_threads threads of the provider's own
+                                 (default None)
+    owner                     -- object the tiles are rendered for, e.g. the scene;
+                                 see RenderExecutor.setFocus() (default None)
     parent                    -- QObject
 
+    Every level of the tiling's resolution pyramid (see
+    Tiling.level()) has its own cache. Methods that take a 'level'
+    argument operate on the tiles of that level; level 0 is full
+    resolution.
+
+    Layer tile requests are rendered in order of their priority (see
+    the PRIORITY_* constants).
+
     '''
 
     @property
@@ -374,7 +1352,8 @@ class TileProvider( QObject ):
 
     def __init__( self, tiling, stackedImageSources, cache_size=100,
                   request_queue_size=100000, n_threads=2,
-                  layerIdChange_means_dirty=False, parent=None ):
+                  layerIdChange_means_dirty=False, cache_bytes=None, registry=None,
+                  executor=None, owner=None, parent=None ):
         QObject.__init__( self, parent = parent )
 
         self.tiling = tiling
@@ -382,15 +1361,26 @@ class TileProvider( QObject ):
         self._sims = stackedImageSources
         self._cache_size = cache_size
         self._request_queue_size = request_queue_size
-        self._n_threads = n_threads
+        self._executor = executor
+        self._n_threads = executor.n_threads if executor is not None else n_threads
         self._layerIdChange_means_dirty = layerIdChange_means_dirty
+        self._cache_bytes = cache_bytes
+        self._registry = registry if registry is not None else layerTileRegistry()
 
         self._current_stack_id = self._sims.stackId
-        self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
+        self._caches = self._createCaches()
+
+        # requests currently computed by the worker threads, and the
+        # stacks that have been prefetched since the last stack change
+        self._inFlight = {}
+        self._prefetchStacks = {} # stack id -> slice distance of the prefetch priority
 
-        self._dirtyLayerQueue = LifoQueue(self._request_queue_size)
-        self._prefetchQueue = Queue(self._request_queue_size)
+        self._renderQueue = _RenderQueue(self._request_queue_size,
+                                         executor.wake if executor is not None else None)
+        self._serving = 0
+        self._servingDone = Condition(Lock())
+        self._priorityCenter = None
+        self._metrics = RenderMetrics(self._n_threads)
 
         self._sims.layerDirty.connect(self._onLayerDirty)
         self._sims.visibleChanged.connect(self._onVisibleChanged)
@@ -403,13 +1393,22 @@ class TileProvider( QObject ):
 
         self._keepRendering = True
 
-        self._dirtyLayerThreads = [Thread(target=self._dirtyLayersWorker)
-                                   for i in range(self._n_threads)]
+        if executor is not None:
+            executor.register(self, owner)
+            self._dirtyLayerThreads = []
+        else:
+            self._dirtyLayerThreads = [Thread(target=self._dirtyLayersWorker)
+                                       for i in range(self._n_threads)]
         for thread in self._dirtyLayerThreads:
             thread.daemon = True
         [ thread.start() for thread in self._dirtyLayerThreads ]
 
-    def getTiles( self, rectF ):
+    @property
+    def _cache(self):
+        # the full resolution cache
+        return self._caches[0]
+
+    def getTiles( self, rectF, level=0 ):
         '''Get tiles in rect and request a refresh.
 
         Returns tiles intersecting with rectF immediately and requests
@@ -417,49 +1416,127 @@ class TileProvider( QObject ):
         tiles may be already (partially) updated. If you want to wait
         until the rendering is fully complete, call join().
 
+        The images of tiles of a level > 0 are smaller than their
+        rectF and have to be scaled up when drawn.
+
         '''
-        self.requestRefresh( rectF )
-        tile_nos = self.tiling.intersected( rectF )
+        self.requestRefresh( rectF, level )
+        tiling = self.tiling.level(level)
+        cache = self._caches[level]
+        tile_nos = tiling.intersected( rectF )
         stack_id = self._current_stack_id
         for tile_no in tile_nos:
-            qimg, progress = self._cache.tile(stack_id, tile_no)
+            qimg, progress = cache.tile(stack_id, tile_no)
             yield TileProvider.Tile(
                 tile_no,
                 qimg,
-                QRectF(self.tiling.imageRects[tile_no]),
+                QRectF(tiling.imageRects[tile_no]),
                 progress,
-                self.tiling)
+                tiling)
 
-    def requestRefresh( self, rectF ):
+    def requestRefresh( self, rectF, level=0 ):
         '''Requests tiles to be refreshed.
 
         Returns immediately. Call join() to wait for
         the end of the rendering.
 
         '''
-        tile_nos = self.tiling.intersected( rectF )
-        for tile_no in tile_nos:
-            stack_id = self._current_stack_id
-            self._refreshTile( stack_id, tile_no )
+        tile_nos = self.tiling.level(level).intersected( rectF )
+        self._refreshTiles( [self._current_stack_id], tile_nos, level=level )
 
-    def prefetch( self, rectF, through ):
+    def prefetch( self, rectF, through, level=0 ):
         '''Request fetching of tiles in advance.
 
         Returns immediately. Prefetch will commence after all regular
         tiles are refreshed (see requestRefresh() and getTiles() ).
         The prefetch is reset when the 'through' value of the slicing
-        changes. Several calls to prefetch are handeled in Fifo
-        order.
+        changes. Slices closer to the current one are rendered
+        first (see PRIORITY_SLICE). A through of None prefetches rectF on the current
+        slice, e.g. the tiles next to the viewport while panning.
+
+        '''
+        if through is None:
+            tile_nos = self.tiling.level(level).intersected( rectF )
+            self._refreshTiles( [self._current_stack_id], tile_nos,
+                                prefetch=True, level=level )
+        elif self._cache_size > 1:
+            stack_id = self._prefetchStack( through, self._sliceDistance(
+                (self._current_stack_id[0], through) ), level )
+            tile_nos = self.tiling.level(level).intersected( rectF )
+            self._refreshTiles( [stack_id], tile_nos, prefetch=True, level=level )
+
+    def prefetchSlices( self, rectF, throughs, level=0 ):
+        '''Prefetch rectF on several slices (see prefetch()).
+
+        throughs are ordered nearest first: the i-th slice is rendered
+        with the priority of the i-th slice next to the current one,
+        whatever its actual distance (think of cine playback wrapping
+        around at the end).
+
+        The layer tiles of adjacent slices are read in slabs of several
+        slices at once, so that a chunk of the data is read once instead
+        of once per slice.
 
         '''
-        if self._cache_size > 1:
-            stack_id = (self._current_stack_id[0], through)
-            if stack_id not in self._cache:
-                self._cache.addStack(stack_id)
-                self._cache.touchStack( self._current_stack_id )
-            tile_nos = self.tiling.intersected( rectF )
-            for tile_no in tile_nos:
-                self._refreshTile( stack_id, tile_no, prefetch=True )
+        if self._cache_size < 2:
+            return
+        stack_ids = [self._prefetchStack( through, i + 1, level )
+                     for i, through in enumerate(throughs)]
+        tile_nos = self.tiling.level(level).intersected( rectF )
+        self._refreshTiles( stack_ids, tile_nos, prefetch=True, level=level )
+
+    def _prefetchStack( self, through, distance, level ):
+        '''Add the stack of through for prefetching at the priority of
+        the distance-th slice next to the current one.'''
+        stack_id = (self._current_stack_id[0], through)
+        self._prefetchStacks[stack_id] = distance
+        cache = self._caches[level]
+        if stack_id not in cache:
+            cache.addStack(stack_id)
+            cache.touchStack( self._current_stack_id )
+        return stack_id
+
+    def prefetched( self, rectF, through, level=0 ):
+        '''Return True if all layer tiles in rectF of the slice through
+        are up to date, so that its tiles can be composited at once.'''
+        stack_id = (self._current_stack_id[0], through)
+        cache = self._caches[level]
+        if stack_id not in cache:
+            return False
+        try:
+            for tile_no in self.tiling.level(level).intersected( rectF ):
+                for ims in self._sims.viewImageSources():
+                    if self._sims.isVisible(ims) and not self._sims.isOccluded(ims) \
+                       and cache.layerDirty(stack_id, ims, tile_no):
+                        return False
+        except KeyError:
+            return False
+        return True
+
+    def cancelPrefetch( self, keep=() ):
+        '''Drop all waiting prefetch requests, except for the slices
+        whose through values are in keep.
+
+        Call this when prefetching became pointless, e.g. because the
+        user stopped scrolling. Running requests are finished.
+
+        '''
+        keep = set(tuple(through) for through in keep)
+        self._renderQueue.discard( lambda req: req.prefetch and req.stack_id[1] not in keep )
+        self._prefetchStacks = dict((stack_id, distance) for stack_id, distance
+                                    in self._prefetchStacks.items() if stack_id[1] in keep)
+
+    def estimatedRenderTime( self, rectF, level=0 ):
+        '''Estimate the seconds needed to render the layer tiles in rectF
+        of an uncached slice, from the measured compute times of the
+        visible layers.'''
+        n_tiles = len(self.tiling.level(level).intersected(rectF))
+        compute = self._metrics.meanComputeTimes()
+        total = 0.
+        for visible, opacity, ims in self._sims:
+            if visible and not self._sims.isOccluded(ims):
+                total += compute.get(self._layerName(ims), 0.)
+        return total * n_tiles / max(1, self._n_threads)
 
     def join( self ):
         '''Wait until all refresh request are processed.
@@ -468,7 +1545,20 @@ class TileProvider( QObject ):
         rendering finished.
 
         '''
-        return self._dirtyLayerQueue.join()
+        return self._renderQueue.join()
+
+    def setPriorityCenter( self, scenePoint ):
+        '''Render tiles close to scenePoint first.
+
+        Typically the mouse position or the center of the viewport.
+        Waiting requests are reordered if the center moved noticeably.
+
+        '''
+        old = self._priorityCenter
+        self._priorityCenter = QPointF(scenePoint)
+        if old is None or \
+           QLineF(old, scenePoint).length() > self.tiling.blockSize / 4.:
+            self._renderQueue.reprioritize( self._priority )
 
 
     def notifyThreadsToStop( self ):
@@ -478,8 +1568,15 @@ class TileProvider( QObject ):
         instance. Otherwise the garbage collector will not clean up
         the instance (even if you call del).
 
+        Waiting requests are dropped and idle threads terminate
+        immediately; busy threads terminate as soon as their current
+        request is finished.
+
         '''
         self._keepRendering = False
+        self._renderQueue.close()
+        if self._executor is not None:
+            self._executor.unregister(self)
 
     def threadsAreNotifiedToStop( self ):
         '''Check if NotifyThreadsToStop() was called at least once.'''
@@ -497,6 +1594,15 @@ class TileProvider( QObject ):
         '''
         for thread in self._dirtyLayerThreads:
             thread.join( timeout )
+        if self._executor is not None:
+            # wait for the requests the executor is still rendering
+            with self._servingDone:
+                deadline = time.time() + timeout if timeout is not None else None
+                while self._serving:
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._servingDone.wait( remaining )
 
     def aliveThreads( self ):
         '''Return a map of thread identifiers and their alive status.
@@ -512,72 +1618,292 @@ class TileProvider( QObject ):
                 at[thread.ident] = thread.isAlive()
         return at
 
+    def cacheStats( self ):
+        '''Return cache hits, misses, evictions and bytes summed over
+        all pyramid levels (see _TilesCache.stats()).'''
+        total = {'hits' : 0, 'misses' : 0, 'evictions' : 0, 'bytes' : 0,
+                 'maxbytes' : self._cache_bytes}
+        for cache in self._caches:
+            stats = cache.stats()
+            for k in ('hits', 'misses', 'evictions', 'bytes'):
+                total[k] += stats[k]
+        return total
+
+    def metrics( self ):
+        '''Return live metrics of the rendering pipeline as a dict.
+
+        queue       -- {'display' : n, 'prefetch' : n, 'running' : n}:
+                       waiting and running layer tile requests
+        cache       -- see cacheStats()
+        utilization -- fraction of time the render threads were busy
+                       since the previous call
+        layers      -- layer name -> {'latency' : LatencyHistogram,
+                       'compute' : LatencyHistogram}; latency is the time
+                       from request to arrival of a layer tile, compute
+                       the time spent waiting for its image source
+        viewport    -- time-to-complete-viewport, see
+                       RenderMetrics.snapshot() and viewportRendered()
+
+        volumina.renderMetrics.formatMetrics() turns the dict into text.
+
+        '''
+        display, prefetch = self._renderQueue.depths()
+        metrics = self._metrics.snapshot()
+        metrics['queue'] = {'display' : display,
+                            'prefetch' : prefetch,
+                            'running' : len(self._inFlight)}
+        metrics['cache'] = self.cacheStats()
+        return metrics
+
+    def viewportRendered( self, rectF, level=0 ):
+        '''Check whether all tiles in rectF are completely rendered.
+
+        Called by the scene after painting a viewport; the result is
+        recorded for the time-to-complete-viewport metric.
+
+        '''
+        cache = self._caches[level]
+        stack_id = self._current_stack_id
+        complete = all(cache.tileProgress(stack_id, tile_no) >= 1.0
+                       for tile_no in self.tiling.level(level).intersected(rectF))
+        self._metrics.viewportRendered( complete )
+        return complete
+
+    def _createCaches( self ):
+        n = self.tiling.levelCount
+        # each level has a quarter of the pixels of the previous one
+        weights = [4.0**-level for level in range(n)]
+        caches = []
+        for level in range(n):
+            maxbytes = None
+            if self._cache_bytes is not None:
+                maxbytes = int(self._cache_bytes * weights[level] / sum(weights))
+            caches.append(_TilesCache(self._current_stack_id, self._sims,
+                                      maxstacks=self._cache_size,
+                                      maxbytes=maxbytes))
+        return caches
+
     def _dirtyLayersWorker( self ):
+        renderQueue = self._renderQueue
         while self._keepRendering:
-            # Save reference to the queue in case self._dirtyLayerQueue reassigned during this pass.
-            # See onSizeChanged()
-            dirtyLayerQueue = self._dirtyLayerQueue
-            prefetchQueue = self._prefetchQueue
-
+            req = renderQueue.get()
+            if req is None:
+                # the queue was closed by notifyThreadsToStop()
+                return
+            self._serve( req )
+
+    def _serve( self, req ):
+        '''Render a request taken from the render queue.'''
+        with self._servingDone:
+            self._serving += 1
+        start = time.time()
+        try:
+            self._renderLayerTile( req )
+        finally:
+            self._renderQueue.task_done( req )
+            self._metrics.workerBusy( time.time() - start )
+            with self._servingDone:
+                self._serving -= 1
+                if not self._serving:
+                    self._servingDone.notify_all()
+
+    def _renderLayerTile( self, req ):
+        stack_id, tile_nr, cache = req.stack_id, req.tile_nr, req.cache
+        try:
+            if not req.prefetch and stack_id != self._current_stack_id:
+                # the slice was left before the request was started
+                self._supersede( req )
+                return
+            if req.timestamp <= cache.layerTimestamp( stack_id, req.ims, tile_nr ):
+                # a newer image is cached already
+                req.image_req.cancel()
+                return
+
+            inFlight = _InFlightRequest( stack_id, req.image_req, req.prefetch )
+            self._inFlight[id(inFlight)] = inFlight
             try:
+                start = time.time()
                 try:
-                    result = dirtyLayerQueue.get_nowait()
-                    queue = dirtyLayerQueue
-                except Empty:
-                    try:
-                        result = prefetchQueue.get_nowait()
-                        queue = prefetchQueue
-                    except Empty:
-                        try:
-                            result = dirtyLayerQueue.get(True, self.THREAD_HEARTBEAT)
-                            queue = dirtyLayerQueue
-                        except Empty:
-                            continue
-            except TypeError:
-                #the TypeError occurs when the queue
-                #is already None when the thread is being shut down
-                #on program exit.
-                #This avoids a lot of warnings.
-                continue
-
-            ims, transform, tile_nr, stack_id, image_req, timestamp, cache = result
-            try:
-                if timestamp > cache.layerTimestamp( stack_id, ims, tile_nr ):
-                    img = image_req.wait()
-                    img = img.transformed(transform)
-                    cache.updateTileIfNecessary( stack_id, ims, tile_nr, timestamp, img )
-                    if stack_id == self._current_stack_id and cache is self._cache:
-                        self.sceneRectChanged.emit(QRectF(self.tiling.imageRects[tile_nr]))
-            except KeyError:
-                pass
+                    img = req.image_req.wait()
+                except Exception:
+                    if not inFlight.cancelled:
+                        raise
             finally:
-                queue.task_done()
+                del self._inFlight[id(inFlight)]
+            if inFlight.cancelled:
+                # make sure the tile is requested again when its
+                # slice is shown
+                cache.setTileDirty( stack_id, tile_nr, True )
+                return
+
+            cost = time.time() - start
+            self._metrics.layerTileDone( self._layerName(req.ims),
+                                         time.time() - req.timestamp, cost )
+            cache.updateTileIfNecessary( stack_id, req.ims, tile_nr,
+                                         req.timestamp, img, cost, req.orientation )
+            if stack_id == self._current_stack_id and cache is self._caches[req.level]:
+                rect = self.tiling.level(req.level).imageRects[tile_nr]
+                self.sceneRectChanged.emit(QRectF(rect))
+        except KeyError:
+            # the stack or the layer is gone
+            req.image_req.cancel()
+
+    @staticmethod
+    def _layerName( ims ):
+        layer = getattr(ims, '_layer', None)
+        return layer.name if layer is not None else ims.objectName()
+
+    def _supersede( self, req ):
+        '''Demote a stale display request to a prefetch request if its
+        stack is still prefetched, drop it otherwise.'''
+        if req.stack_id in self._prefetchStacks:
+            demoted = _LayerTileRequest( req.ims, req.tile_nr,
+                                         req.stack_id, req.image_req,
+                                         req.timestamp, req.cache, req.level,
+                                         prefetch=True, orientation=req.orientation )
+            demoted.priority = req.priority
+            self._enqueue( demoted )
+            return
+        req.image_req.cancel()
+        # the layer tile stays dirty; make sure it is requested again
+        # when its slice is shown
+        req.cache.setTileDirty( req.stack_id, req.tile_nr, True )
+
+    def _enqueue( self, req ):
+        # req.priority is what has been passed on to image_req so far;
+        # adjustPriority() takes the change
+        priority = self._priority( req )
+        req.image_req.adjustPriority( priority - req.priority )
+        req.priority = priority
+        try:
+            self._renderQueue.put( req )
+        except Full:
+            req.image_req.cancel()
+            msg = " ".join(("Request queue full.",
+                            "Dropping tile refresh request.",
+                            "Increase queue size!"))
+            warnings.warn(msg)
+
+    def _priority( self, req ):
+        priority = 0.
+        if req.prefetch:
+            priority += self.PRIORITY_PREFETCH
+            distance = self._prefetchStacks.get( req.stack_id )
+            if distance is None:
+                distance = self._sliceDistance( req.stack_id )
+            priority += self.PRIORITY_SLICE * distance
+        try:
+            if not self._sims.isVisible( req.ims ) or self._sims.isOccluded( req.ims ):
+                priority += self.PRIORITY_HIDDEN
+        except KeyError:
+            # the image source has been removed
+            priority += self.PRIORITY_HIDDEN
+        if self._priorityCenter is not None:
+            tiling = self.tiling.level(req.level)
+            center = tiling.imageRectFs[req.tile_nr].center()
+            distance = QLineF(center, self._priorityCenter).length()
+            priority += distance / (tiling.blockSize * tiling.downsample)
+        return priority
+
+    def _sliceDistance( self, stack_id ):
+        current = self._current_stack_id[1]
+        through = stack_id[1]
+        try:
+            return sum(abs(a - b) for a, b in zip(through, current))
+        except TypeError:
+            return 0
+
+    def _cancelStaleRequests( self, stack_id ):
+        '''Cancel running display requests for stacks other than stack_id.
 
-    def _refreshTile( self, stack_id, tile_no, prefetch=False ):
+        Running prefetch requests are left alone: they most likely
+        belong to the slices around the new position.
+
+        '''
+        for inFlight in self._inFlight.values():
+            if not inFlight.prefetch and inFlight.stack_id != stack_id:
+                inFlight.cancelled = True
+                inFlight.request.cancel()
+
+    def _renderTransform( self ):
+        # the image sources render directly in scene orientation; the
+        # transform only swaps and flips axes
         if not self.axesSwapped:
             transform = QTransform(0,1,0,1,0,0,1,1,1)
         else:
             transform = QTransform().rotate(90).scale(1,-1)
-        transform *= self.tiling.data2scene
+        return transform * self.tiling.data2scene
+
+    def _refreshTiles( self, stack_ids, tile_nos, prefetch=False, level=0 ):
+        with self._coalesced( stack_ids, tile_nos, level ):
+            for stack_id in stack_ids:
+                for tile_no in tile_nos:
+                    self._refreshTile( stack_id, tile_no, prefetch, level )
+
+    @contextmanager
+    def _coalesced( self, stack_ids, tile_nos, level ):
+        '''Read the dirty layer tiles of each asynchronous image source
+        in a few large reads instead of one by one.
+
+        Adjacent tiles are merged into rectangles of whole tiles, so the
+        reads stay aligned to the tiling (and thereby to the chunks of
+        typical storage layouts). Adjacent slices are merged into slabs.
+
+        '''
+        tiling = self.tiling.level(level)
+        cache = self._caches[level]
+        sources = [ims for ims in self._sims.viewImageSources()
+                   if not ims.direct and hasattr(ims, 'coalesced')
+                   and not self._sims.isOccluded(ims) and self._sims.isVisible(ims)]
+        requests = defaultdict(list)
+        for stack_id in stack_ids:
+            try:
+                dirty = [tile_no for tile_no in tile_nos
+                         if cache.tileDirty( stack_id, tile_no )]
+                for ims in sources:
+                    requests[ims].extend(
+                        (tiling.scene2data.mapRect(tiling.imageRects[tile_no]), stack_id[1])
+                        for tile_no in dirty
+                        if cache.layerDirty( stack_id, ims, tile_no ))
+            except KeyError:
+                pass
+        contexts = [ims.coalesced(requests[ims], tiling.downsample)
+                    for ims in sources if len(requests[ims]) > 1]
+        for context in contexts:
+            context.__enter__()
+        try:
+            yield
+        finally:
+            for context in reversed(contexts):
+                context.__exit__(None, None, None)
+
+    def _refreshTile( self, stack_id, tile_no, prefetch=False, level=0 ):
+        transform = self._renderTransform()
+        orientation = _orientation( transform )
 
+        tiling = self.tiling.level(level)
+        cache = self._caches[level]
         try:
-            if self._cache.tileDirty( stack_id, tile_no ):
+            if cache.tileDirty( stack_id, tile_no ):
                 if not prefetch:
-                    self._cache.setTileDirty(stack_id, tile_no, False)
-                    img = self._renderTile( stack_id, tile_no )
-                    self._cache.setTile(stack_id, tile_no, img,
-                                        self._sims.viewVisible(),
-                                        self._sims.viewOccluded())
+                    cache.setTileDirty(stack_id, tile_no, False)
+                    self._updateTile( stack_id, tile_no, level )
 
                 # refresh dirty layer tiles
                 for ims in self._sims.viewImageSources():
-                    if self._cache.layerDirty(stack_id, ims, tile_no) \
+                    if cache.layerDirty(stack_id, ims, tile_no) \
                        and not self._sims.isOccluded(ims) \
                        and self._sims.isVisible(ims):
 
-                        rect = self.tiling.imageRects[tile_no]
-                        dataRect = self.tiling.scene2data.mapRect(rect)
-                        ims_req = ims.request(dataRect, stack_id[1])
+                        rect = tiling.imageRects[tile_no]
+                        dataRect = tiling.scene2data.mapRect(rect)
+                        ims_req = None
+                        if not ims.direct:
+                            ims_req = self._registry.request(ims, stack_id[1], dataRect,
+                                                             tiling.downsample, transform)
+                        if ims_req is None:
+                            ims_req = ims.request(dataRect, stack_id[1],
+                                                  tiling.downsample, transform)
                         if ims.direct:
                             # The ImageSource 'ims' is fast (it has the
                             # direct flag set to true) so we process
@@ -586,104 +1912,220 @@ class TileProvider( QObject ):
                             # that have the data readily available.
                             start = time.time()
                             img = ims_req.wait()
-
-                            img = img.transformed(transform)
                             stop = time.time()
 
-                            ims._layer.timePerTile(stop-start,
-                                                   self.tiling.imageRects[tile_no])
+                            ims._layer.timePerTile(stop-start, rect)
+                            self._metrics.layerTileDone( self._layerName(ims),
+                                                         stop-start, stop-start )
 
-                            self._cache.updateTileIfNecessary(
-                                stack_id, ims, tile_no, time.time(), img )
-                            img = self._renderTile( stack_id, tile_no )
-                            self._cache.setTile(stack_id, tile_no,
-                                                img, self._sims.viewVisible(),
-                                                self._sims.viewOccluded() )
+                            cache.updateTileIfNecessary(
+                                stack_id, ims, tile_no, time.time(), img,
+                                stop-start, orientation )
+                            self._updateTile( stack_id, tile_no, level )
                         else:
-                            req = (ims, transform, tile_no, stack_id,
-                                   ims_req, time.time(), self._cache)
-                            try:
-                                if prefetch:
-                                    self._prefetchQueue.put_nowait( req )
-                                else:
-                                    self._dirtyLayerQueue.put_nowait( req )
-                            except Full:
-                                msg = " ".join(("Request queue full.",
-                                                "Dropping tile refresh request.",
-                                                "Increase queue size!"))
-                                warnings.warn(msg)
+                            self._enqueue( _LayerTileRequest(
+                                ims, tile_no, stack_id, ims_req,
+                                time.time(), cache, level, prefetch,
+                                orientation ) )
         except KeyError:
             pass
 
-    def _renderTile( self, stack_id, tile_nr ):
-        qimg = QImage(self.tiling.imageRects[tile_nr].size(),
-                      QImage.Format_ARGB32_Premultiplied)
-        #qimg.fill(Qt.white)  # Apparently, some difference between Qt 4.7 and 4.8 causes 
-                              #   QImage.fill(Qt.white) to do the wrong thing here.  It might be a Qt bug.
-        qimg.fill(0xffffffff) # Use a hex constant instead.
+    def _updateTile( self, stack_id, tile_nr, level=0 ):
+        start = time.time()
+        img = self._renderTile( stack_id, tile_nr, level )
+        self._caches[level].setTile(stack_id, tile_nr, img, time.time() - start)
+
+    def _renderTile( self, stack_id, tile_nr, level=0 ):
+        cache = self._caches[level]
+        size = self.tiling.level(level).imageSizes[tile_nr]
+        layers = self._layerStates( stack_id, tile_nr, cache )
+        states = [layer[0] for layer in layers]
+        previous = cache.tileStates( stack_id, tile_nr )
+        cache.setTileStates( stack_id, tile_nr, states )
+
+        # When only the visibility or opacity of a single layer changes
+        # (think of dragging an opacity slider), the composites of the
+        # layers below and above it are kept. Repainting the tile then
+        # takes two blends instead of one per layer.
+        partial = cache.partialComposite( stack_id, tile_nr )
+        if partial is None or not partial.matches( states ):
+            pivot = self._changedLayer( previous, states )
+            if pivot is None or len(layers) < 3:
+                if partial is not None:
+                    cache.setPartialComposite( stack_id, tile_nr, None )
+                return self._composite( size, layers )
+            start = time.time()
+            partial = _PartialComposite( pivot,
+                                         self._composite( size, layers[:pivot] ),
+                                         self._composite( size, layers[pivot+1:], background=0 ),
+                                         states )
+            cache.setPartialComposite( stack_id, tile_nr, partial, time.time() - start )
+
+        return self._composite( size, [layers[partial.pivot], (None, 1.0, partial.above)],
+                                qimg=partial.below.copy() )
+
+    def _layerStates( self, stack_id, tile_nr, cache ):
+        '''Return the layers of a tile as (state, opacity, patch) from
+        bottom to top.
+
+        Painting layers with equal states gives equal images. The state
+        is (ims, opacity, timestamp); opacity is None if the layer does
+        not contribute to the tile.
+
+        '''
+        layers = []
+        orientation = _orientation( self._renderTransform() )
+        for visible, layerOpacity, ims in reversed(self._sims):
+            # read the timestamp before the patch; a patch that is newer
+            # than the timestamp only causes a needless repaint later on
+            timestamp = cache.layerTimestamp( stack_id, ims, tile_nr )
+            patch = cache.layer( stack_id, ims, tile_nr ) if visible else None
+            if patch is not None:
+                patch = self._oriented( stack_id, ims, tile_nr, cache, patch, orientation )
+            opacity = layerOpacity if patch is not None else None
+            layers.append( ((ims, opacity, timestamp), layerOpacity, patch) )
+        return layers
+
+    def _oriented( self, stack_id, ims, tile_nr, cache, patch, orientation ):
+        '''Return the layer tile patch in the given orientation.
+
+        Layer tiles rendered before the axes were rotated or swapped
+        are turned once and cached again.
+
+        '''
+        old = cache.layerOrientation( stack_id, ims, tile_nr )
+        if old is None or old == orientation:
+            return patch
+        img = _reoriented( patch, old, orientation )
+        cache.reorientLayer( stack_id, ims, tile_nr, patch, img, orientation )
+        return img
+
+    @staticmethod
+    def _changedLayer( previous, states ):
+        '''Return the index of the only layer whose visibility or opacity
+        differs between the layer states previous and states.
+
+        Returns None if there is no such layer, if other layers changed,
+        or if the layer's image changed.
+
+        '''
+        if previous is None or len(previous) != len(states):
+            return None
+        changed = [i for i, (old, new) in enumerate(zip(previous, states)) if old != new]
+        if len(changed) != 1:
+            return None
+        old, new = previous[changed[0]], states[changed[0]]
+        if old[0] is not new[0] or old[2] != new[2]:
+            return None
+        return changed[0]
+
+    def _composite( self, size, layers, background=0xffffffff, qimg=None ):
+        '''Paint layers, given as (state, opacity, patch) from bottom to
+        top, on qimg or on a new image filled with background.
+
+        If all patches are uniform, so is the result: only a single
+        pixel is painted and a shared UniformImage is returned.
+
+        '''
+        if qimg is None:
+            if all(isinstance(patch, UniformImage) for state, opacity, patch in layers
+                   if patch is not None):
+                pixel = self._composite( QSize(1, 1), layers, background )
+                return uniformImage( pixel, (size.height(), size.width()) )
+            qimg = QImage(size, QImage.Format_ARGB32_Premultiplied)
+            #qimg.fill(Qt.white)  # Apparently, some difference between Qt 4.7 and 4.8 causes 
+                                  #   QImage.fill(Qt.white) to do the wrong thing here.  It might be a Qt bug.
+            qimg.fill(background) # Use a hex constant instead.
 
         p = QPainter(qimg)
-        for i, v in enumerate(reversed(self._sims)):
-            visible, layerOpacity, layerImageSource = v
-            if not visible:
+        for state, opacity, patch in layers:
+            if patch is None:
                 continue
-
-            patch = self._cache.layer(stack_id, layerImageSource, tile_nr )
-            if patch is not None:
-                p.setOpacity(layerOpacity)
+            if isinstance(patch, UniformImage):
+                # e.g. empty tiles of label layers
+                if not patch.transparent:
+                    p.setOpacity(opacity)
+                    p.fillRect(0, 0, patch.width(), patch.height(), patch.color)
+            else:
+                p.setOpacity(opacity)
                 p.drawImage(0,0, patch)
         p.end()
         return qimg
 
     def _onLayerDirty(self, dirtyImgSrc, dataRect ):
+        self._registry.invalidate( dirtyImgSrc, dataRect )
         sceneRect = self.tiling.data2scene.mapRect(dataRect)
         if dirtyImgSrc in self._sims.viewImageSources():
             visibleAndNotOccluded = self._sims.isVisible( dirtyImgSrc ) \
                                     and not self._sims.isOccluded( dirtyImgSrc )
-            for tile_no in xrange(len(self.tiling)):
-                # and invalid rect means everything is dirty
-                if not sceneRect.isValid() \
-                   or self.tiling.tileRects[tile_no].intersected( sceneRect ):
-                    for ims in self._sims.viewImageSources():
-                        self._cache.setLayerDirtyAll(ims, tile_no, True)
-                    if visibleAndNotOccluded:
-                        self._cache.setTileDirtyAll(tile_no, True)
+            layer_ids = list(self._sims.viewImageSources())
+            for level, cache in enumerate(self._caches):
+                tiling = self.tiling.level(level)
+                # an invalid rect means everything is dirty
+                if not sceneRect.isValid():
+                    tile_nos = range(len(tiling))
+                else:
+                    # the tile images include an overlap margin
+                    tile_nos = tiling.intersectedData( dataRect, tiling.overlap )
+                cache.setLayersDirtyAll(layer_ids, tile_nos, True)
+                if visibleAndNotOccluded:
+                    cache.setTilesDirtyAll(tile_nos, True)
             if visibleAndNotOccluded:
                 self.sceneRectChanged.emit( QRectF(sceneRect) )
 
     def _onStackIdChanged( self, oldId, newId ):
-        if newId in self._cache:
-            self._cache.touchStack( newId )
-        else:
-            self._cache.addStack( newId )
+        for cache in self._caches:
+            if newId in cache:
+                cache.touchStack( newId )
+            else:
+                cache.addStack( newId )
         self._current_stack_id = newId
-        self._prefetchQueue = Queue(self._request_queue_size)
+        # prefetching starts over from the new position
+        self._renderQueue.discard( lambda req: req.prefetch )
+        self._prefetchStacks = {}
+        self._cancelStaleRequests( newId )
         self.sceneRectChanged.emit(QRectF())
 
     def _onLayerIdChanged( self, ims, oldId, newId ):
         if self._layerIdChange_means_dirty:
             self._onLayerDirty( ims, QRect() )
 
+    def _setAllTilesDirty( self ):
+        for cache in self._caches:
+            cache.setAllTilesDirty()
+
     def _onVisibleChanged(self, ims, visible):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        self._setAllTilesDirty()
+        self._renderQueue.reprioritize( self._priority )
         if not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
     def _onOpacityChanged(self, ims, opacity):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        self._setAllTilesDirty()
+        self._renderQueue.reprioritize( self._priority )
         if self._sims.isVisible( ims ) and not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
+    def axesChanged( self ):
+        '''Call after the tiling's data2scene or axesSwapped changed.
+
+        The layer tiles are kept: tile numbers refer to patches of the
+        data, which do not move. Cached layer tiles are turned into the
+        new orientation when their tiles are composited again, so
+        rotating or swapping the view does not compute anything anew.
+
+        '''
+        for cache in self._caches:
+            cache.dropPartialComposites()
+            cache.setAllTilesDirty()
+        self.sceneRectChanged.emit(QRectF())
+
     def _onSizeChanged(self):
-        self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
-        self._dirtyLayerQueue = LifoQueue(self._request_queue_size)
-        self._prefetchQueue = Queue(self._request_queue_size)
+        self._caches = self._createCaches()
+        self._renderQueue.discard( lambda req: True )
         self.sceneRectChanged.emit(QRectF())
 
     def _onOrderChanged(self):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        self._setAllTilesDirty()
+        self._renderQueue.reprioritize( self._priority )
         self.sceneRectChanged.emit(QRectF())
@@ -11,6 +11,7 @@ from imageScene2D import ImageScene2D
 from imageView2D import ImageView2D
 from positionModel import PositionModel
 from navigationControler import NavigationControler, NavigationInterpreter
+from cinePlayer import CinePlayer
 from brushingcontroler import BrushingInterpreter, BrushingControler, \
                               CrosshairControler
 from brushingmodel import BrushingModel
@@ -50,6 +51,15 @@ class VolumeEditor( QObject ):
             s.showTileProgress = show
         self._showTileProgress = show
 
+    @property
+    def showMetrics(self):
+        return self._showMetrics
+    @showMetrics.setter
+    def showMetrics(self, show):
+        for s in self.imageScenes:
+            s.showMetrics = show
+        self._showMetrics = show
+
     @property
     def cacheSize(self):
         return self._cacheSize
@@ -62,6 +72,7 @@ class VolumeEditor( QObject ):
 
     def lastImageViewFocus(self, axis):
         self._lastImageViewFocus = axis
+        self.imageScenes[axis].takeRenderFocus()
         self.newImageView2DFocus.emit()
 
     @property
@@ -97,6 +108,7 @@ class VolumeEditor( QObject ):
         ##
         self._showDebugPatches = False
         self._showTileProgress = True
+        self._showMetrics = False
         self._lastImageViewFocus = None
 
         ##
@@ -137,6 +149,10 @@ class VolumeEditor( QObject ):
         self.navCtrl      = NavigationControler(self.imageViews, syncedSliceSources, self.posModel, view3d=v3d)
         self.navInterpret = NavigationInterpreter(self.navCtrl)
 
+        # playback through time or along an axis
+        self.cinePlayer = CinePlayer(self.posModel, self.imageScenes, parent=self)
+        self.navCtrl.cinePlayer = self.cinePlayer
+
         # brushing control
         self.crosshairControler = CrosshairControler(self.brushingModel, self.imageViews)
         self.brushingControler = BrushingControler(self.brushingModel, self.posModel, labelsink)
@@ -170,6 +186,9 @@ class VolumeEditor( QObject ):
         self.eventSwitch.interpreter = modes[name]
 
     def cleanUp(self):
+        self.cinePlayer.stop()
+        for scene in self.imageScenes:
+            scene.stopRendering()
         QApplication.processEvents()
         for scene in self._imageViews:
             scene.close()